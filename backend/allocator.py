@@ -0,0 +1,155 @@
+from beanie import UpdateResponse
+from beanie.operators import Set
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from beanie import PydanticObjectId
+
+from ipaddress import IPv4Address
+from typing import AsyncIterator, Optional, Sequence
+
+from config import WIREGUARD_SUBNET
+from scheams.allocator import IPAllocator
+from scheams.connection_info import ConnectionInfo, UNASSIGNED_FILTER
+from wireguard.keys import iter_keypairs
+
+ALLOCATOR_ID = "ip"
+# Retries when a fresh address is already taken, e.g. after a counter reset.
+MAX_CLAIM_RETRIES = 16
+# Documents per insert_many call when provisioning in bulk.
+INSERT_BATCH_SIZE = 1024
+
+
+def offset_to_ip(offset: int) -> Optional[str]:
+    # The first host of the subnet is the server itself.
+    address = WIREGUARD_SUBNET.network_address + 2 + offset
+    if address >= WIREGUARD_SUBNET.broadcast_address:
+        return None
+    return str(address)
+
+
+def ip_to_offset(ip: str) -> Optional[int]:
+    """Inverse of `offset_to_ip`, None if `ip` is not a client address of
+    the subnet."""
+    try:
+        address = IPv4Address(ip)
+    except ValueError:
+        return None
+
+    offset = int(address) - int(WIREGUARD_SUBNET.network_address) - 2
+    if offset < 0 or address >= WIREGUARD_SUBNET.broadcast_address:
+        return None
+    return offset
+
+
+async def reserve_offsets(count: int = 1) -> int:
+    """Atomically reserve `count` fresh addresses and return the first offset."""
+    collection = IPAllocator.get_motor_collection()
+    allocator = await collection.find_one_and_update(
+        {"_id": ALLOCATOR_ID},
+        {"$inc": {"next_offset": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return allocator["next_offset"] - count
+
+
+async def set_next_offset(offset: int):
+    await IPAllocator.get_motor_collection().update_one(
+        {"_id": ALLOCATOR_ID},
+        {"$set": {"next_offset": offset}},
+        upsert=True
+    )
+
+
+def gen_connection(ip: str, discord_user_id: Optional[str] = None) -> ConnectionInfo:
+    from pywgkey import WgKey
+    key = WgKey()
+    return ConnectionInfo(
+        private_key=key.privkey,
+        public_key=key.pubkey,
+        ip_address=ip,
+        discord_user_id=discord_user_id,
+    )
+
+
+async def allocate_connection(discord_user_id: Optional[str] = None) -> Optional[ConnectionInfo]:
+    """Create a connection on the next never-used address.
+
+    Keys are only generated here, when somebody actually needs an address.
+    Returns None once the subnet is exhausted.
+    """
+    for _ in range(MAX_CLAIM_RETRIES):
+        ip = offset_to_ip(await reserve_offsets())
+        if ip is None:
+            return None
+
+        connection = gen_connection(ip, discord_user_id)
+        try:
+            await connection.insert()
+            return connection
+        except DuplicateKeyError:
+            continue
+
+    return None
+
+
+async def claim_connection(discord_user_id: str) -> Optional[ConnectionInfo]:
+    """Assign a connection to `discord_user_id` without racing other joins.
+
+    A free connection is claimed with a single find_one_and_update on the
+    partial index of unassigned connections, otherwise a new one is allocated already
+    owned by the user. Returns None once the subnet is exhausted.
+    """
+    connection = await ConnectionInfo.find_one(UNASSIGNED_FILTER).update(
+        Set({ConnectionInfo.discord_user_id: discord_user_id}),
+        response_type=UpdateResponse.NEW_DOCUMENT
+    )
+    if connection is not None:
+        return connection
+
+    return await allocate_connection(discord_user_id)
+
+
+async def release_connection(connection: ConnectionInfo):
+    """Free a connection which was claimed but never handed out, e.g. by
+    losing a concurrent join. Connections of removed users are rekeyed by
+    setup.py instead, their old owner still has the private key."""
+    await ConnectionInfo.find_one(
+        ConnectionInfo.id == connection.id
+    ).update(Set({ConnectionInfo.discord_user_id: None}))
+
+
+async def provision_connections(
+    first_offset: int,
+    owners: Sequence[Optional[str]],
+    workers: Optional[int] = None
+) -> AsyncIterator[list[ConnectionInfo]]:
+    """Create one connection per entry of `owners` on the addresses starting
+    at `first_offset`, and yield every batch once it has been inserted.
+
+    Raises RuntimeError if the subnet runs out of addresses.
+    """
+    if owners and offset_to_ip(first_offset + len(owners) - 1) is None:
+        raise RuntimeError("IP Not Enough")
+
+    index = 0
+    batch: list[ConnectionInfo] = []
+    async for keypairs in iter_keypairs(len(owners), workers):
+        for private_key, public_key in keypairs:
+            batch.append(ConnectionInfo(
+                id=PydanticObjectId(),
+                private_key=private_key,
+                public_key=public_key,
+                ip_address=offset_to_ip(first_offset + index),
+                discord_user_id=owners[index],
+            ))
+            index += 1
+
+        if len(batch) >= INSERT_BATCH_SIZE:
+            await ConnectionInfo.insert_many(batch)
+            yield batch
+            batch = []
+
+    if batch:
+        await ConnectionInfo.insert_many(batch)
+        yield batch
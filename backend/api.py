@@ -2,17 +2,33 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from uvicorn import Config, Server
 
-from config import HOST, PORT
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from config import HOST, METRICS_ENABLED, PORT, STATUS_PER_MESSAGE_DEFLATE
+from discord_api import DISCORD
+from metrics import MetricsMiddleware
 
 from routers import (
     connection_router,
     oauth_router
 )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await DISCORD.start()
+    yield
+    await DISCORD.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(connection_router)
 app.include_router(oauth_router)
+if METRICS_ENABLED:
+    # GET /metrics is served by serve_metrics, not on the public port.
+    app.add_middleware(MetricsMiddleware)
 
 origins = [
     "http://localhost:3000"
@@ -23,14 +39,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 
-async def run_api():
+async def run_api(fd: Optional[int] = None):
+    """Serve the API, on an inherited listening socket `fd` if given."""
     config = Config(
         app=app,
         host=HOST,
         port=PORT,
+        fd=fd,
+        ws_per_message_deflate=STATUS_PER_MESSAGE_DEFLATE,
         timeout_graceful_shutdown=5
     )
     server = Server(config=config)
@@ -0,0 +1,119 @@
+from asyncio import Future, ensure_future, shield
+from collections import OrderedDict
+from time import monotonic
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """Bounded LRU cache whose entries expire after `ttl` seconds."""
+    maxsize: int
+    ttl: Optional[float]
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, shared: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[K, tuple[Optional[float], V]] = OrderedDict()
+        # Name of a cache which every API worker holds, see SharedCaches.
+        self.shared = shared
+        if shared is not None:
+            SHARED_CACHES.caches[shared] = self
+
+    def get(self, key: K) -> Optional[V]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+
+        expire_at, value = item
+        if expire_at is not None and expire_at <= monotonic():
+            del self.data[key]
+            return None
+
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self.data[key] = (None if ttl is None else monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key: K):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def invalidate(self, key: Optional[K] = None):
+        """Drop `key`, or every entry, in this and the other API workers."""
+        SHARED_CACHES.drop(self, key)
+        if self.shared is not None and SHARED_CACHES.on_invalidate is not None:
+            SHARED_CACHES.on_invalidate(self.shared, key)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class SharedCaches():
+    """Caches which every API worker process holds a copy of.
+
+    The status channel sets `on_invalidate` in worker mode and hands the
+    invalidations it receives to `receive`, so a change made through one
+    worker is not served stale by the others until the TTL runs out.
+    """
+
+    def __init__(self):
+        self.caches: dict[str, TTLCache] = {}
+        self.on_invalidate: Optional[Callable[[str, Optional[Hashable]], None]] = None
+
+    @staticmethod
+    def drop(cache: TTLCache, key: Optional[Hashable] = None):
+        if key is None:
+            cache.clear()
+        else:
+            cache.pop(key)
+
+    def receive(self, name: str, key: Optional[Hashable] = None):
+        cache = self.caches.get(name)
+        if cache is not None:
+            self.drop(cache, key)
+
+    def clear(self):
+        """Drop everything, e.g. after invalidations may have been missed."""
+        for cache in self.caches.values():
+            cache.clear()
+
+
+SHARED_CACHES = SharedCaches()
+
+
+class SingleFlight(Generic[K, V]):
+    """Coalesce concurrent calls with the same key into one.
+
+    Callers which arrive while a call for their key is running await the
+    same result instead of starting their own.
+    """
+
+    def __init__(self):
+        self.calls: dict[K, Future] = {}
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        future = self.calls.get(key)
+        if future is None:
+            future = self.calls[key] = ensure_future(func())
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        # A cancelled caller must not cancel the call the others wait for.
+        return await shield(future)
+
+
+# Pages of GET /connection, keyed by (cursor, limit). Cleared whenever a
+# user or a connection changes; the TTL covers changes made by setup.py.
+USER_LIST_CACHE: TTLCache[tuple[Optional[str], int], tuple[str, bytes, Optional[str]]] = \
+    TTLCache(maxsize=256, ttl=60, shared="user_list")
+
+# Rendered client configs keyed by discord id.
+CLIENT_CONF_CACHE: TTLCache[str, str] = TTLCache(maxsize=4096, ttl=300, shared="client_conf")
@@ -1,31 +1,57 @@
-from bcrypt import gensalt
-from orjson import dumps, loads, OPT_INDENT_2
-from pydantic import BaseModel
-from pywgkey import WgKey, WgPsk
+from orjson import dumps, loads, JSONDecodeError, OPT_INDENT_2
+from pydantic import BaseModel, Field, model_validator, ValidationError
 
-from inspect import currentframe, getouterframes
+from functools import cache
 from ipaddress import IPv4Network
-from logging import getLogger
 from os import urandom
-from typing import Optional
+from typing import Any, Literal, Optional
 
-psk = WgPsk()
-key_pair = WgKey()
+CONFIG_PATH = "config.json"
+# Default cap of recorded peers, about 56 MB of history.
+DEFAULT_HISTORY_MAX_PEERS = 1024
+
+
+# Keys and secrets are only generated when a config is created or misses
+# them, importing this module stays free of crypto work and disk writes.
+def gen_secret() -> str:
+    from bcrypt import gensalt
+    return gensalt().decode() + urandom(16).hex()
+
+
+def gen_preshared_key() -> str:
+    from pywgkey import WgPsk
+    return WgPsk().key
 
 
 class WireguardConfig(BaseModel):
     subnet: str = "192.168.250.0/24"
     mtu: int = 1500
     port: int = 51820
-    public_key: str = key_pair.pubkey
-    private_key: str = key_pair.privkey
-    preshared_key: str = psk.key
+    public_key: str = ""
+    private_key: str = ""
+    preshared_key: str = Field(default_factory=gen_preshared_key)
     post_up: Optional[str] = None
     post_down: Optional[str] = None
     interface_name: str = "wg0"
+    conf_path: Optional[str] = None
     endpoint: str = "example.com:51820"
     keep_alive: int = 30
     addition_ips: list[str] = []
+    # Remove peers which are not in the database when the API starts.
+    remove_unknown_peers: bool = False
+
+    @model_validator(mode="before")
+    @classmethod
+    def fill_key_pair(cls, data: Any) -> Any:
+        if isinstance(data, dict) and not data.get("private_key"):
+            from pywgkey import WgKey
+            key_pair = WgKey()
+            data = {
+                **data,
+                "public_key": key_pair.pubkey,
+                "private_key": key_pair.privkey,
+            }
+        return data
 
 
 class MongoDBConfig(BaseModel):
@@ -33,63 +59,169 @@ class MongoDBConfig(BaseModel):
     db_name: str = "wsm"
     use_tls: bool = False
     tls_cafile: Optional[str] = None
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+    # Any of "zstd", "snappy" and "zlib", in order of preference.
+    compressors: list[str] = []
+    # Read preference of GET /connection. Its pages stay cached until a join
+    # clears them, a lagging secondary would put an outdated page back in.
+    list_read_preference: Literal[
+        "primary",
+        "primaryPreferred",
+        "secondary",
+        "secondaryPreferred",
+        "nearest"
+    ] = "primary"
 
 
 class DiscordConfig(BaseModel):
+    api_base: str = "https://discord.com/api/v10/"
     redirect_uri: str = ""
     client_id: str = ""
     client_secret: str = ""
 
 
+class StatusConfig(BaseModel):
+    backend: Literal["auto", "netlink", "cli"] = "auto"
+    queue_size: int = 8
+    send_timeout: float = 10
+    # Compress websocket messages, trades CPU for bandwidth.
+    per_message_deflate: bool = True
+    poll_interval_min: float = 1
+    poll_interval_max: float = 15
+    history_enabled: bool = True
+    # The history takes about 55 KB per recorded peer. By default one per
+    # client address of the subnet, at most DEFAULT_HISTORY_MAX_PEERS.
+    history_max_peers: Optional[int] = None
+    history_file: Optional[str] = "history.bin"
+    # API worker processes, more than one moves polling into its own process.
+    workers: int = 1
+    socket_path: str = "status.sock"
+    # Publish the status in a shared memory table, see status_table.py.
+    shared_memory: bool = False
+    shared_memory_capacity: int = 65536
+
+
 class Config(BaseModel):
     host: str = "0.0.0.0"
     port: int = 8080
-    jwt_key: str = gensalt().decode() + urandom(16).hex()
-    join_key: str = gensalt().decode() + urandom(16).hex()
-    wireguard_config: WireguardConfig = WireguardConfig()
-    mongodb_config: MongoDBConfig = MongoDBConfig()
-    discord_config: DiscordConfig = DiscordConfig()
-
-
-if __name__ == "config":
-    logger = getLogger("config")
-    root_filename = getouterframes(currentframe(), 2)[-1].filename or ""
+    jwt_key: str = Field(default_factory=gen_secret)
+    join_key: str = Field(default_factory=gen_secret)
+    admin_ids: list[str] = []
+    metrics_enabled: bool = True
+    # Metrics are served on their own address, keep it private.
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 9108
+    # Peers exported with their own series, the most recently active first.
+    metrics_max_peers: int = 64
+    wireguard_config: WireguardConfig = Field(default_factory=WireguardConfig)
+    mongodb_config: MongoDBConfig = Field(default_factory=MongoDBConfig)
+    discord_config: DiscordConfig = Field(default_factory=DiscordConfig)
+    status_config: StatusConfig = Field(default_factory=StatusConfig)
+
+
+@cache
+def load_config() -> Config:
+    """Read config.json once, and write it back only if defaults had to be
+    filled in, e.g. for options added since it was created."""
+    try:
+        with open(CONFIG_PATH, "rb") as config_file:
+            data = loads(config_file.read())
+    except FileNotFoundError:
+        print("Config file not found, please run `python3 setup.py` first.")
+        exit(0)
+    except JSONDecodeError as error:
+        print(f"Config file {CONFIG_PATH} is not valid JSON: {error}")
+        exit(1)
 
     try:
-        with open("config.json", "rb") as config_file:
-            config = Config(**loads(config_file.read()))
-
-        HOST = config.host
-        PORT = config.port
-        JWT_KEY = config.jwt_key
-        JOIN_KEY = config.join_key
-
-        WIREGUARD_SUBNET = IPv4Network(config.wireguard_config.subnet)
-        WIREGUARD_MTU = config.wireguard_config.mtu
-        WIREGUARD_PORT = config.wireguard_config.port
-        WIREGUARD_PRIVATE_KEY = config.wireguard_config.private_key
-        WIREGUARD_PUBLIC_KEY = config.wireguard_config.public_key
-        WIREGUARD_PRESHARED_KEY = config.wireguard_config.preshared_key
-        WIREGUARD_POST_UP = config.wireguard_config.post_up
-        WIREGUARD_POST_DOWN = config.wireguard_config.post_down
-        WIREGUARD_INTERFACE = config.wireguard_config.interface_name
-        WIREGUARD_ENDPOINT = config.wireguard_config.endpoint
-        WIREGUARD_KEEP_ALIVE = config.wireguard_config.keep_alive
-        WIREGUARD_ADDITION_IPS = config.wireguard_config.addition_ips
-
-        MONGODB_URI = config.mongodb_config.uri
-        MONGODB_DB = config.mongodb_config.db_name
-        MONGODB_TLS = config.mongodb_config.use_tls
-        MONGODB_CAFILE = config.mongodb_config.tls_cafile
-
-        DISCORD_REDIRECT_URI = config.discord_config.redirect_uri
-        DISCORD_CLIENT_ID = config.discord_config.client_id
-        DISCORD_CLIENT_SECRET = config.discord_config.client_secret
-    except:
-        if not root_filename.endswith("setup.py"):
-            print("Config file not found, please run `python3 setup.py` first.")
-            exit(0)
-
-    if not root_filename.endswith("setup.py"):
-        with open("config.json", "wb") as config_file:
-            config_file.write(dumps(config.model_dump(), option=OPT_INDENT_2))
+        config = Config.model_validate(data)
+    except ValidationError as error:
+        print(f"Config file {CONFIG_PATH} is invalid: {error}")
+        exit(1)
+    filled = config.model_dump()
+    if filled != data:
+        with open(CONFIG_PATH, "wb") as config_file:
+            config_file.write(dumps(filled, option=OPT_INDENT_2))
+
+    return config
+
+
+@cache
+def settings() -> dict[str, Any]:
+    config = load_config()
+    return {
+        "HOST": config.host,
+        "PORT": config.port,
+        "JWT_KEY": config.jwt_key,
+        "JOIN_KEY": config.join_key,
+        "ADMIN_IDS": config.admin_ids,
+        "METRICS_ENABLED": config.metrics_enabled,
+        "METRICS_HOST": config.metrics_host,
+        "METRICS_PORT": config.metrics_port,
+        "METRICS_MAX_PEERS": config.metrics_max_peers,
+
+        "WIREGUARD_SUBNET": IPv4Network(config.wireguard_config.subnet),
+        "WIREGUARD_MTU": config.wireguard_config.mtu,
+        "WIREGUARD_PORT": config.wireguard_config.port,
+        "WIREGUARD_PRIVATE_KEY": config.wireguard_config.private_key,
+        "WIREGUARD_PUBLIC_KEY": config.wireguard_config.public_key,
+        "WIREGUARD_PRESHARED_KEY": config.wireguard_config.preshared_key,
+        "WIREGUARD_POST_UP": config.wireguard_config.post_up,
+        "WIREGUARD_POST_DOWN": config.wireguard_config.post_down,
+        "WIREGUARD_INTERFACE": config.wireguard_config.interface_name,
+        "WIREGUARD_CONF_PATH": config.wireguard_config.conf_path or (
+            f"/etc/wireguard/{config.wireguard_config.interface_name}.conf"
+        ),
+        "WIREGUARD_ENDPOINT": config.wireguard_config.endpoint,
+        "WIREGUARD_KEEP_ALIVE": config.wireguard_config.keep_alive,
+        "WIREGUARD_ADDITION_IPS": config.wireguard_config.addition_ips,
+        "WIREGUARD_REMOVE_UNKNOWN_PEERS": config.wireguard_config.remove_unknown_peers,
+
+        "MONGODB_URI": config.mongodb_config.uri,
+        "MONGODB_DB": config.mongodb_config.db_name,
+        "MONGODB_TLS": config.mongodb_config.use_tls,
+        "MONGODB_CAFILE": config.mongodb_config.tls_cafile,
+        "MONGODB_MAX_POOL_SIZE": config.mongodb_config.max_pool_size,
+        "MONGODB_MIN_POOL_SIZE": config.mongodb_config.min_pool_size,
+        "MONGODB_MAX_IDLE_TIME_MS": config.mongodb_config.max_idle_time_ms,
+        "MONGODB_WAIT_QUEUE_TIMEOUT_MS": config.mongodb_config.wait_queue_timeout_ms,
+        "MONGODB_COMPRESSORS": config.mongodb_config.compressors,
+        "MONGODB_LIST_READ_PREFERENCE": config.mongodb_config.list_read_preference,
+
+        "DISCORD_API_BASE": config.discord_config.api_base,
+        "DISCORD_REDIRECT_URI": config.discord_config.redirect_uri,
+        "DISCORD_CLIENT_ID": config.discord_config.client_id,
+        "DISCORD_CLIENT_SECRET": config.discord_config.client_secret,
+
+        "STATUS_BACKEND": config.status_config.backend,
+        "STATUS_QUEUE_SIZE": config.status_config.queue_size,
+        "STATUS_SEND_TIMEOUT": config.status_config.send_timeout,
+        "STATUS_PER_MESSAGE_DEFLATE": config.status_config.per_message_deflate,
+        "STATUS_POLL_INTERVAL_MIN": config.status_config.poll_interval_min,
+        "STATUS_POLL_INTERVAL_MAX": config.status_config.poll_interval_max,
+        "STATUS_HISTORY_ENABLED": config.status_config.history_enabled,
+        "STATUS_HISTORY_MAX_PEERS": config.status_config.history_max_peers or min(
+            # Without the network, broadcast and server addresses.
+            IPv4Network(config.wireguard_config.subnet).num_addresses - 3,
+            DEFAULT_HISTORY_MAX_PEERS
+        ),
+        "STATUS_HISTORY_FILE": config.status_config.history_file,
+        "STATUS_WORKERS": config.status_config.workers,
+        "STATUS_SOCKET_PATH": config.status_config.socket_path,
+        "STATUS_SHARED_MEMORY": config.status_config.shared_memory,
+        "STATUS_SHARED_MEMORY_CAPACITY": config.status_config.shared_memory_capacity,
+    }
+
+
+def __getattr__(name: str) -> Any:
+    # Settings are read from config.json on first access, e.g. by
+    # `from config import HOST`, so importing Config alone stays cheap.
+    if name.isupper():
+        try:
+            return settings()[name]
+        except KeyError:
+            pass
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,29 +1,144 @@
-from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
+from beanie import Document, init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import ReadPreference
+from pymongo.operations import DeleteOne, UpdateOne
+
+from asyncio import gather, Semaphore
+from logging import getLogger
+from typing import Any, Iterator, Sequence, Union
 
 from config import (
     MONGODB_URI,
     MONGODB_DB,
     MONGODB_TLS,
-    MONGODB_CAFILE
+    MONGODB_CAFILE,
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    MONGODB_MAX_IDLE_TIME_MS,
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+    MONGODB_COMPRESSORS,
+    MONGODB_LIST_READ_PREFERENCE
 )
-from scheams.connection_info import ConnectionInfo
+from scheams.allocator import IPAllocator
+from scheams.connection_info import ConnectionInfo, UNASSIGNED_FILTER
 from scheams.user import UserData
 
+from .pool_metrics import COMMAND_METRICS, POOL_METRICS
+
+client_options: dict[str, Any] = {
+    "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+    "minPoolSize": MONGODB_MIN_POOL_SIZE,
+    "maxIdleTimeMS": MONGODB_MAX_IDLE_TIME_MS,
+    "waitQueueTimeoutMS": MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+}
+if MONGODB_COMPRESSORS:
+    client_options["compressors"] = ",".join(MONGODB_COMPRESSORS)
+
 client = AsyncIOMotorClient(
     MONGODB_URI,
     tls=MONGODB_TLS,
-    tlsCAFile=MONGODB_CAFILE
+    tlsCAFile=MONGODB_CAFILE,
+    event_listeners=[POOL_METRICS, COMMAND_METRICS],
+    **client_options
 )
 
 DB = client[MONGODB_DB]
 
+logger = getLogger("database")
+
+# Read preference of the user list. Secondaries only fit if pages up to the
+# replication lag plus the cache TTL old are acceptable.
+LIST_READ_PREFERENCE = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}[MONGODB_LIST_READ_PREFERENCE]
+
+# Operations per bulk_write call and bulk_write calls in flight.
+BULK_CHUNK_SIZE = 1000
+BULK_CONCURRENCY = 4
+
+
+# Queries on request paths as (collection, filter, sort), each of them has
+# to be answered from an index declared in the document settings.
+HOT_QUERIES: list[tuple[str, dict[str, Any], list[tuple[str, int]]]] = [
+    (ConnectionInfo.Settings.name, {"discord_user_id": ""}, []),
+    (ConnectionInfo.Settings.name, UNASSIGNED_FILTER, []),
+    (ConnectionInfo.Settings.name, {"ip_address": ""}, []),
+    (UserData.Settings.name, {"discord_id": ""}, []),
+    (UserData.Settings.name, {"discord_id": {"$gt": ""}}, [("discord_id", 1)]),
+]
+
 
 async def setup():
+    # init_beanie creates every index declared on the documents.
     await init_beanie(
         database=DB,
         document_models=[
             ConnectionInfo,
+            IPAllocator,
             UserData
         ]
     )
+
+    try:
+        await check_query_plans()
+    except Exception as error:
+        logger.warning(f"Failed to check query plans: {error}")
+
+
+def iter_stages(plan: dict[str, Any]) -> Iterator[str]:
+    yield plan.get("stage", "")
+    # Plans of the slot based engine keep the classic tree in queryPlan.
+    if "queryPlan" in plan:
+        yield from iter_stages(plan["queryPlan"])
+    if "inputStage" in plan:
+        yield from iter_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        yield from iter_stages(input_stage)
+
+
+async def check_query_plans():
+    """Warn about hot queries which would scan a whole collection."""
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = DB[collection_name].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        # Sharded clusters wrap the plan of every shard.
+        plans = [shard.get("winningPlan", shard) for shard in plan.get("shards", [])] or [plan]
+        if any("COLLSCAN" in iter_stages(plan) for plan in plans):
+            logger.warning(
+                f"Query {query} on {collection_name} does a collection scan, "
+                f"check its indexes."
+            )
+
+
+def read_collection(model: type[Document]) -> AsyncIOMotorCollection:
+    """Collection of `model` for read-only queries."""
+    return model.get_motor_collection().with_options(
+        read_preference=LIST_READ_PREFERENCE
+    )
+
+
+async def bulk_write_chunked(
+    collection: AsyncIOMotorCollection,
+    requests: Sequence[Union[DeleteOne, UpdateOne]],
+    chunk_size: int = BULK_CHUNK_SIZE,
+    concurrency: int = BULK_CONCURRENCY
+):
+    """Send `requests` as ordered bulk_write chunks, at most `concurrency`
+    of them at once so a large setup does not drain the connection pool."""
+    semaphore = Semaphore(concurrency)
+
+    async def write(chunk: Sequence[Union[DeleteOne, UpdateOne]]):
+        async with semaphore:
+            await collection.bulk_write(chunk, ordered=True)
+
+    await gather(*[
+        write(requests[start:start + chunk_size])
+        for start in range(0, len(requests), chunk_size)
+    ])
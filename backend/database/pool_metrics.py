@@ -0,0 +1,118 @@
+from pymongo.monitoring import (
+    CommandFailedEvent,
+    CommandListener,
+    CommandStartedEvent,
+    CommandSucceededEvent,
+    ConnectionCheckedInEvent,
+    ConnectionCheckedOutEvent,
+    ConnectionCheckOutFailedEvent,
+    ConnectionCheckOutStartedEvent,
+    ConnectionClosedEvent,
+    ConnectionCreatedEvent,
+    ConnectionPoolListener,
+    ConnectionReadyEvent,
+    PoolClearedEvent,
+    PoolClosedEvent,
+    PoolCreatedEvent,
+    PoolReadyEvent,
+)
+
+from threading import Lock
+
+from metrics import Counter, GaugeFunc, Histogram
+
+MONGO_POOL_WAIT_SECONDS = Histogram(
+    "wsm_mongo_pool_wait_seconds",
+    "Time spent waiting for a pooled Mongo connection.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+MONGO_POOL_CHECK_OUT_FAILED = Counter(
+    "wsm_mongo_pool_check_out_failures_total",
+    "Failed Mongo connection check outs, e.g. wait queue timeouts.",
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "wsm_mongo_command_duration_seconds",
+    "Duration of Mongo commands.",
+    ("command", "result"),
+)
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """Collect how long operations wait for a pooled connection.
+
+    A wait time that keeps growing under load means `max_pool_size` is too
+    small. Pymongo calls the listener from its own threads, so the counts
+    are only changed under a lock.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.open = 0
+        self.in_use = 0
+
+    def connection_checked_out(self, event: ConnectionCheckedOutEvent):
+        with self.lock:
+            self.in_use += 1
+        MONGO_POOL_WAIT_SECONDS.observe(getattr(event, "duration", 0))
+
+    def connection_check_out_failed(self, event: ConnectionCheckOutFailedEvent):
+        MONGO_POOL_CHECK_OUT_FAILED.inc()
+        MONGO_POOL_WAIT_SECONDS.observe(getattr(event, "duration", 0))
+
+    def connection_checked_in(self, event: ConnectionCheckedInEvent):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event: ConnectionCreatedEvent):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event: ConnectionClosedEvent):
+        with self.lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event: ConnectionCheckOutStartedEvent):
+        pass
+
+    def connection_ready(self, event: ConnectionReadyEvent):
+        pass
+
+    def pool_created(self, event: PoolCreatedEvent):
+        pass
+
+    def pool_ready(self, event: PoolReadyEvent):
+        pass
+
+    def pool_cleared(self, event: PoolClearedEvent):
+        pass
+
+    def pool_closed(self, event: PoolClosedEvent):
+        pass
+
+
+class CommandMetrics(CommandListener):
+    """Time every Mongo command by its name, e.g. find or update."""
+
+    def started(self, event: CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: CommandSucceededEvent):
+        MONGO_COMMAND_SECONDS.observe(
+            event.duration_micros / 1e6, (event.command_name, "ok")
+        )
+
+    def failed(self, event: CommandFailedEvent):
+        MONGO_COMMAND_SECONDS.observe(
+            event.duration_micros / 1e6, (event.command_name, "error")
+        )
+
+
+POOL_METRICS = PoolMetrics()
+COMMAND_METRICS = CommandMetrics()
+
+GaugeFunc(
+    "wsm_mongo_pool_connections",
+    "Open Mongo connections by state.",
+    lambda: [(("open",), POOL_METRICS.open), (("in_use",), POOL_METRICS.in_use)],
+    ("state",),
+)
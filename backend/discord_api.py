@@ -0,0 +1,164 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from orjson import loads
+
+from asyncio import sleep as asleep
+from time import monotonic, perf_counter
+from typing import Any, Mapping, Optional
+
+from config import DISCORD_API_BASE
+from metrics import Histogram
+
+# Discord allows 50 requests per second per application.
+GLOBAL_LIMIT = 50
+# Retries of a request answered with 429.
+MAX_RETRIES = 3
+# Buckets kept before the ones which already reset are dropped.
+MAX_BUCKETS = 4096
+
+DISCORD_REQUEST_SECONDS = Histogram(
+    "wsm_discord_request_duration_seconds",
+    "Duration of Discord API requests, rate limit waits excluded.",
+    ("route", "status"),
+)
+
+
+class TokenBucket():
+    """Token bucket refilled from Discord's X-RateLimit-* headers.
+
+    Callers wait for a token instead of failing, so bursts queue up until
+    the bucket resets.
+    """
+    __slots__ = ("limit", "remaining", "reset_at", "period")
+
+    limit: int
+    remaining: int
+    reset_at: float
+    # Length of a window, the longest Reset-After Discord sent so far.
+    period: float
+
+    def __init__(self, limit: int, period: float = 1):
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at = monotonic() + period
+        self.period = period
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            if self.reset_at <= now:
+                self.remaining = self.limit
+                self.reset_at = now + self.period
+            if self.remaining > 0:
+                self.remaining -= 1
+                return
+            await asleep(self.reset_at - now)
+
+    def update(self, headers: Mapping[str, str]):
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = min(self.remaining, int(headers["X-RateLimit-Remaining"]))
+            if "X-RateLimit-Reset-After" in headers:
+                reset_after = float(headers["X-RateLimit-Reset-After"])
+                self.reset_at = monotonic() + reset_after
+                self.period = max(self.period, reset_after)
+        except ValueError:
+            pass
+
+    def block(self, retry_after: float):
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, monotonic() + retry_after)
+
+
+class DiscordClient():
+    """One keep-alive HTTP session to Discord for the whole app lifetime."""
+    base_url: str
+    session: Optional[ClientSession]
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.session = None
+        self.global_bucket = TokenBucket(GLOBAL_LIMIT)
+        # Per route and token, Discord limits every user's token separately.
+        self.buckets: dict[tuple[str, str, Optional[str]], TokenBucket] = {}
+
+    async def start(self):
+        if self.session is not None:
+            return
+
+        self.session = ClientSession(
+            connector=TCPConnector(
+                limit=100,
+                limit_per_host=30,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            ),
+            timeout=ClientTimeout(total=15),
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, method: str, route: str, **kwargs) -> tuple[int, Any]:
+        """Send a request to `route` (relative to the API base) and return
+        the status code with the decoded JSON body."""
+        await self.start()
+
+        key = f"{method} {route}"
+        bucket = self.bucket(method, route, kwargs.get("headers", {}).get("Authorization"))
+
+        for _ in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+
+            start = perf_counter()
+            async with self.session.request(
+                method, f"{self.base_url}/{route}", **kwargs
+            ) as response:
+                bucket.update(response.headers)
+                body = await response.read()
+                DISCORD_REQUEST_SECONDS.observe(
+                    perf_counter() - start, (key, str(response.status))
+                )
+
+                if response.status != 429:
+                    try:
+                        return response.status, loads(body)
+                    except:
+                        return response.status, None
+
+                try:
+                    retry_after = float(loads(body).get("retry_after", 1))
+                except:
+                    retry_after = float(response.headers.get("Retry-After", 1))
+
+                if response.headers.get("X-RateLimit-Global") == "true":
+                    self.global_bucket.block(retry_after)
+                else:
+                    bucket.block(retry_after)
+
+        return 429, None
+
+    def bucket(self, method: str, route: str, authorization: Optional[str]) -> TokenBucket:
+        key = (method, route, authorization)
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            return bucket
+
+        if len(self.buckets) >= MAX_BUCKETS:
+            # A bucket past its reset is full again and is simply created anew.
+            now = monotonic()
+            self.buckets = {
+                key: bucket
+                for key, bucket in self.buckets.items()
+                if bucket.reset_at > now
+            }
+
+        bucket = self.buckets[key] = TokenBucket(GLOBAL_LIMIT)
+        return bucket
+
+
+DISCORD = DiscordClient(DISCORD_API_BASE)
@@ -0,0 +1,346 @@
+from orjson import dumps, loads
+
+from array import array
+from logging import getLogger
+from os import fsync, replace
+from struct import Struct
+from typing import TYPE_CHECKING, Optional
+
+from config import (
+    STATUS_HISTORY_ENABLED,
+    STATUS_HISTORY_FILE,
+    STATUS_HISTORY_MAX_PEERS
+)
+
+if TYPE_CHECKING:
+    from wireguard_status import PeerRecord
+
+# (resolution in seconds, number of buckets): 10 minutes of 1 s samples,
+# a day of 1 min rollups and 30 days of 1 h rollups.
+TIERS = ((1, 600), (60, 1440), (3600, 720))
+# A peer counts as online while its last handshake is newer than this.
+ONLINE_TIMEOUT = 180
+# Seconds between samples while nobody watches the status, the history
+# only needs one per bucket of the minute tier.
+IDLE_INTERVAL = TIERS[1][0]
+# Gaps longer than this (e.g. the service was down) are not counted online.
+MAX_SAMPLE_GAP = 2 * IDLE_INTERVAL
+
+HEADER_SIZE = Struct("=I")
+# Bumped whenever the arrays of a snapshot change.
+SNAPSHOT_FORMAT = 2
+
+logger = getLogger("history")
+
+
+class HistoryTier():
+    """Ring buffers of one resolution, laid out as `slot * length + pos`.
+
+    The per peer buffers grow by one block of `length` buckets per slot.
+    """
+    __slots__ = ("resolution", "length", "buckets", "seconds", "online", "rx", "tx")
+
+    resolution: int
+    length: int
+    # Bucket number (`timestamp // resolution`) held at each position.
+    buckets: array
+    # Sampled seconds per position, shared by all peers.
+    seconds: array
+    # Online seconds and transferred bytes per peer and bucket.
+    online: array
+    rx: array
+    tx: array
+
+    def __init__(self, resolution: int, length: int):
+        self.resolution = resolution
+        self.length = length
+        self.buckets = array("q", [-1]) * length
+        self.seconds = array("I", [0]) * length
+        self.online = array("I")
+        self.rx = array("Q")
+        self.tx = array("Q")
+
+    def arrays(self) -> tuple[array, ...]:
+        return (self.buckets, self.seconds, self.online, self.rx, self.tx)
+
+    def add_slot(self):
+        self.online.extend(array("I", [0]) * self.length)
+        self.rx.extend(array("Q", [0]) * self.length)
+        self.tx.extend(array("Q", [0]) * self.length)
+
+    def clear_slot(self, slot: int):
+        base = slot * self.length
+        self.online[base:base + self.length] = array("I", [0]) * self.length
+        self.rx[base:base + self.length] = array("Q", [0]) * self.length
+        self.tx[base:base + self.length] = array("Q", [0]) * self.length
+
+    def clear(self, bucket: int):
+        pos = bucket % self.length
+        max_peers = len(self.online) // self.length
+        self.buckets[pos] = bucket
+        self.seconds[pos] = 0
+        self.online[pos::self.length] = array("I", [0]) * max_peers
+        self.rx[pos::self.length] = array("Q", [0]) * max_peers
+        self.tx[pos::self.length] = array("Q", [0]) * max_peers
+
+    def advance(self, now: float) -> int:
+        """Move to the bucket of `now` and return its position.
+
+        Buckets skipped since the last sample are cleared too, so the buckets
+        of any window stay contiguous in the ring.
+        """
+        bucket = int(now // self.resolution)
+        latest = max(self.buckets)
+        if bucket > latest:
+            first = bucket - self.length + 1 if latest < 0 else latest + 1
+            for skipped in range(max(first, bucket - self.length + 1), bucket + 1):
+                self.clear(skipped)
+        elif self.buckets[bucket % self.length] != bucket:
+            self.clear(bucket)
+        return bucket % self.length
+
+    def runs(self, start: float, end: float) -> list[tuple[int, int]]:
+        """Contiguous position ranges whose buckets fall into the window."""
+        first = int(start // self.resolution)
+        last = int(end // self.resolution)
+
+        result = []
+        run_start = None
+        for pos, bucket in enumerate(self.buckets):
+            if first <= bucket <= last:
+                if run_start is None:
+                    run_start = pos
+            elif run_start is not None:
+                result.append((run_start, pos))
+                run_start = None
+        if run_start is not None:
+            result.append((run_start, self.length))
+        return result
+
+
+class HistoryStore():
+    """Status history of up to `max_peers` peers, about 55 KB per peer.
+
+    Every sample is added to the current bucket of all tiers at once, so the
+    minute and hour tiers are rollups of the finer ones. Peers get a slot the
+    first time they are seen. Once all slots are taken, a new peer reuses the
+    slot of the peer which was seen least recently, e.g. a removed peer or a
+    rotated key. Peers are only left out while more than `max_peers` peers
+    are on the interface at once.
+    """
+    max_peers: int
+    tiers: list[HistoryTier]
+    slots: dict[str, int]
+    # Public key of every slot.
+    keys: list[str]
+    last_rx: array
+    last_tx: array
+    last_seen: array
+    last_sample: float
+    dropped: int
+
+    def __init__(self, max_peers: int):
+        self.max_peers = max_peers
+        self.tiers = [
+            HistoryTier(resolution, length)
+            for resolution, length in TIERS
+        ]
+        self.slots = {}
+        self.keys = []
+        # Counters of the previous sample, -1 for slots not seen yet.
+        self.last_rx = array("q")
+        self.last_tx = array("q")
+        self.last_seen = array("d")
+        self.last_sample = 0
+        # Peers left out of the last sample.
+        self.dropped = 0
+
+    def add_slot(self):
+        for tier in self.tiers:
+            tier.add_slot()
+        self.last_rx.append(-1)
+        self.last_tx.append(-1)
+        self.last_seen.append(0)
+
+    def slot(self, public_key: str, now: float) -> Optional[int]:
+        slot = self.slots.get(public_key)
+        if slot is None:
+            if len(self.keys) < self.max_peers:
+                slot = len(self.keys)
+                self.add_slot()
+                self.keys.append(public_key)
+            else:
+                slot = min(range(len(self.keys)), key=self.last_seen.__getitem__)
+                # Every slot is taken by a peer of this sample.
+                if self.last_seen[slot] >= now:
+                    return None
+
+                del self.slots[self.keys[slot]]
+                for tier in self.tiers:
+                    tier.clear_slot(slot)
+                self.last_rx[slot] = -1
+                self.last_tx[slot] = -1
+                self.keys[slot] = public_key
+            self.slots[public_key] = slot
+
+        self.last_seen[slot] = now
+        return slot
+
+    def record(self, status: dict[str, "PeerRecord"], now: float):
+        elapsed = now - self.last_sample
+        elapsed = round(elapsed) if 0 < elapsed <= MAX_SAMPLE_GAP else 0
+        self.last_sample = now
+
+        positions = [tier.advance(now) for tier in self.tiers]
+        for tier, pos in zip(self.tiers, positions):
+            tier.seconds[pos] += elapsed
+
+        dropped = 0
+        for public_key, record in status.items():
+            slot = self.slot(public_key, now)
+            if slot is None:
+                dropped += 1
+                continue
+
+            online = elapsed if now - record.latest_handshake < ONLINE_TIMEOUT else 0
+            rx = self.delta(self.last_rx, slot, record.rx_bytes)
+            tx = self.delta(self.last_tx, slot, record.tx_bytes)
+
+            for tier, pos in zip(self.tiers, positions):
+                index = slot * tier.length + pos
+                tier.online[index] += online
+                tier.rx[index] += rx
+                tier.tx[index] += tx
+
+        if dropped != self.dropped:
+            if dropped:
+                logger.warning(
+                    f"{dropped} peers are not recorded, raise "
+                    f"status_config.history_max_peers above {self.max_peers}."
+                )
+            self.dropped = dropped
+
+    @staticmethod
+    def delta(last: array, slot: int, value: int) -> int:
+        previous = last[slot]
+        last[slot] = value
+        if previous < 0:
+            return 0
+        # Counters restart from zero when the peer is re-added.
+        return value - previous if value >= previous else value
+
+    def query(self, start: float, end: float) -> tuple[int, dict[str, dict]]:
+        """Aggregate every peer over `[start, end]`.
+
+        Uses the finest tier which still covers `start` and returns its
+        resolution together with online minutes, transferred bytes and the
+        95th percentile of per-bucket throughput (bytes per sampled second).
+
+        Runs on an executor thread while the event loop keeps recording, so
+        the result may already include part of a newer sample.
+        """
+        tier = self.tiers[-1]
+        for candidate in self.tiers:
+            if self.last_sample - candidate.resolution * candidate.length <= start:
+                tier = candidate
+                break
+
+        runs = tier.runs(start, end)
+        result = {}
+        for public_key, slot in self.slots.items():
+            base = slot * tier.length
+            online = 0
+            rx = 0
+            tx = 0
+            throughput = []
+            for run_start, run_end in runs:
+                online += sum(tier.online[base + run_start:base + run_end])
+                bucket_rx = tier.rx[base + run_start:base + run_end]
+                bucket_tx = tier.tx[base + run_start:base + run_end]
+                rx += sum(bucket_rx)
+                tx += sum(bucket_tx)
+                throughput.extend(
+                    (bucket_rx[index] + bucket_tx[index]) / seconds
+                    for index, seconds in enumerate(tier.seconds[run_start:run_end])
+                    if seconds
+                )
+
+            p95 = 0
+            if throughput:
+                throughput.sort()
+                p95 = throughput[min(
+                    int(len(throughput) * 0.95), len(throughput) - 1
+                )]
+
+            result[public_key] = {
+                "online_minutes": online / 60,
+                "rx_bytes": rx,
+                "tx_bytes": tx,
+                "p95_throughput": p95,
+            }
+
+        return tier.resolution, result
+
+    def arrays(self) -> list[array]:
+        result = [self.last_rx, self.last_tx, self.last_seen]
+        for tier in self.tiers:
+            result.extend(tier.arrays())
+        return result
+
+    def save(self, path: str):
+        header = dumps({
+            "format": SNAPSHOT_FORMAT,
+            "tiers": TIERS,
+            "keys": self.keys,
+            "last_sample": self.last_sample,
+        })
+
+        with open(f"{path}.tmp", "wb") as history_file:
+            history_file.write(HEADER_SIZE.pack(len(header)))
+            history_file.write(header)
+            for data in self.arrays():
+                data.tofile(history_file)
+            history_file.flush()
+            fsync(history_file.fileno())
+        replace(f"{path}.tmp", path)
+
+    def load(self, path: str):
+        try:
+            with open(path, "rb") as history_file:
+                size = HEADER_SIZE.unpack(history_file.read(HEADER_SIZE.size))[0]
+                header = loads(history_file.read(size))
+                if header.get("format") != SNAPSHOT_FORMAT or \
+                        list(map(tuple, header["tiers"])) != list(TIERS) or \
+                        len(header["keys"]) > self.max_peers:
+                    logger.warning("History snapshot layout changed, ignored.")
+                    return
+
+                for _ in header["keys"]:
+                    self.add_slot()
+                for data in self.arrays():
+                    length = len(data)
+                    del data[:]
+                    data.fromfile(history_file, length)
+        except FileNotFoundError:
+            return
+        except Exception as error:
+            logger.warning(f"Failed to load history snapshot: {error}")
+            self.__init__(self.max_peers)
+            return
+
+        self.keys = header["keys"]
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+        self.last_sample = header["last_sample"]
+
+
+HISTORY = HistoryStore(STATUS_HISTORY_MAX_PEERS) if STATUS_HISTORY_ENABLED else None
+
+
+def load_history():
+    if HISTORY is not None and STATUS_HISTORY_FILE:
+        HISTORY.load(STATUS_HISTORY_FILE)
+
+
+def save_history():
+    if HISTORY is not None and STATUS_HISTORY_FILE:
+        HISTORY.save(STATUS_HISTORY_FILE)
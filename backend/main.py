@@ -1,26 +1,210 @@
-from asyncio import get_event_loop, run
+from argparse import ArgumentParser
+from asyncio import CancelledError, get_event_loop, run, sleep as asleep
+from contextlib import suppress
+from logging import getLogger
 from os import getpid
+from signal import signal, SIGINT, SIGTERM
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from subprocess import Popen, TimeoutExpired
+from sys import argv, executable
+from time import monotonic
+from typing import Callable, Optional, TYPE_CHECKING
 
-from api import run_api
-from database.database import setup
-from wireguard_status import status_update_task
+from config import (
+    HOST,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    PORT,
+    STATUS_SHARED_MEMORY,
+    STATUS_SHARED_MEMORY_CAPACITY,
+    STATUS_SOCKET_PATH,
+    STATUS_WORKERS,
+    WIREGUARD_INTERFACE,
+    WIREGUARD_REMOVE_UNKNOWN_PEERS
+)
 
+if TYPE_CHECKING:
+    from status_table import StatusTable
 
-async def main():
-    await setup()
+# FastAPI, uvicorn, beanie, motor and aiohttp are imported where they are
+# needed, so e.g. the poller of a multi-worker setup never loads the API.
+
+# Seconds between checks of the API worker processes.
+WORKER_CHECK_INTERVAL = 1
+# A worker is restarted at most this often, so one which crashes right
+# after its start does not spin.
+WORKER_RESTART_DELAY = 5
+
+
+async def supervise_workers(workers: list[Popen], spawn: Callable[[], Popen]):
+    """Restart workers which exited, e.g. after a crash or an OOM kill."""
+    logger = getLogger("main")
+    started = [monotonic()] * len(workers)
+    while True:
+        await asleep(WORKER_CHECK_INTERVAL)
+        now = monotonic()
+        for index, worker in enumerate(workers):
+            code = worker.poll()
+            if code is None or now - started[index] < WORKER_RESTART_DELAY:
+                continue
+
+            logger.warning(f"API worker {worker.pid} exited with {code}, restarting it.")
+            workers[index] = spawn()
+            started[index] = now
+
+
+async def run_poller(table: Optional["StatusTable"]):
+    """Poll the interface in this process and serve the API from
+    STATUS_WORKERS worker processes sharing one listening socket."""
+    from status_channel import ChannelServer
+    from wireguard_status import status_update_task
+
+    server = ChannelServer(table)
+    await server.start(STATUS_SOCKET_PATH)
+
+    loop = get_event_loop()
+    poll = loop.create_task(status_update_task(server.publish))
+    # Ctrl-C or a service stop only ends polling, so the cleanup below and
+    # in main still runs.
+    for signum in (SIGINT, SIGTERM):
+        loop.add_signal_handler(signum, poll.cancel)
+
+    metrics_server = None
+    supervisor = None
+    workers: list[Popen] = []
+    # Stays open, workers which are restarted need it again.
+    listener = socket(AF_INET, SOCK_STREAM)
+    try:
+        if METRICS_ENABLED:
+            from metrics import render, serve_metrics
+
+            async def collect_metrics() -> str:
+                return render(await server.collect_metrics())
+
+            metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT, collect_metrics)
+
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        listener.bind((HOST, PORT))
+        listener.listen(2048)
+
+        def spawn_worker() -> Popen:
+            return Popen(
+                [executable, argv[0], "--worker", str(listener.fileno())],
+                pass_fds=[listener.fileno()]
+            )
+
+        for _ in range(STATUS_WORKERS):
+            workers.append(spawn_worker())
+        supervisor = loop.create_task(supervise_workers(workers, spawn_worker))
+
+        with suppress(CancelledError):
+            await poll
+    finally:
+        poll.cancel()
+        if supervisor is not None:
+            supervisor.cancel()
+        for signum in (SIGINT, SIGTERM):
+            loop.remove_signal_handler(signum)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(5)
+            except TimeoutExpired:
+                worker.kill()
+        listener.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        await server.close()
+
+
+def exit_on_signal(signum: int, frame):
+    raise SystemExit(0)
+
+
+async def run_single(table: Optional["StatusTable"]):
+    """Poll the interface and serve the API in this process."""
+    from api import run_api
+    from wireguard_status import status_update_task
+
+    metrics_server = None
+    if METRICS_ENABLED:
+        from metrics import serve_metrics
+        metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
 
     loop = get_event_loop()
-    auto_update = loop.create_task(status_update_task())
+    auto_update = loop.create_task(status_update_task(
+        None if table is None else lambda peers, now: table.write(peers)
+    ))
+
+    # uvicorn handles SIGTERM while serving and raises it again once it shut
+    # down, which has to unwind through the cleanup instead of killing us.
+    signal(SIGTERM, exit_on_signal)
+    try:
+        await run_api()
+    finally:
+        auto_update.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+async def main(worker_fd: Optional[int] = None):
+    from database.database import setup
+    await setup()
+
+    if worker_fd is not None:
+        from api import run_api
+        from status_channel import CLIENT
 
-    await run_api()
+        channel = get_event_loop().create_task(CLIENT.run(STATUS_SOCKET_PATH))
+        await run_api(worker_fd)
+        channel.cancel()
+        return
 
-    auto_update.cancel()
+    from history import load_history, save_history
+    from peer_sync import sync_peers
+    from status_table import StatusTable, table_name
+
+    load_history()
+
+    try:
+        await sync_peers(WIREGUARD_REMOVE_UNKNOWN_PEERS)
+    except Exception as error:
+        getLogger("main").warning(f"Failed to sync peers: {error}")
+
+    table = None
+    try:
+        if STATUS_SHARED_MEMORY:
+            table = StatusTable.create(
+                table_name(WIREGUARD_INTERFACE), STATUS_SHARED_MEMORY_CAPACITY
+            )
+
+        if STATUS_WORKERS > 1:
+            await run_poller(table)
+        else:
+            await run_single(table)
+    finally:
+        if table is not None:
+            table.close()
+        save_history()
 
 
 if __name__ == "__main__":
-    with open("pid", "w") as pid_file:
-        pid_file.write(str(getpid()))
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--worker",
+        type=int,
+        default=None,
+        metavar="FD",
+        help="Run as an API worker serving the listening socket FD"
+    )
+    args = parser.parse_args()
+
+    if args.worker is None:
+        with open("pid", "w") as pid_file:
+            pid_file.write(str(getpid()))
     try:
-        run(main=main())
+        run(main=main(args.worker))
     except KeyboardInterrupt:
         exit(0)
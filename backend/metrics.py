@@ -0,0 +1,318 @@
+from asyncio import (
+    IncompleteReadError,
+    LimitOverrunError,
+    Server,
+    StreamReader,
+    StreamWriter,
+    TimeoutError as WaitTimeout,
+    start_server,
+    wait_for
+)
+from bisect import bisect_left
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Iterable, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Seconds a scraper gets to send its request.
+REQUEST_TIMEOUT = 10
+
+# Upper bounds in seconds of the default latency buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+Labels = tuple[str, ...]
+
+
+def format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{value}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric():
+    """Base of all metrics. Updates may come from other threads, e.g. the
+    Mongo listeners, so they and every read of the values take `lock`."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = (), shared: bool = False):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # The same in every process, e.g. read from the interface, so only
+        # the poller exports it in multi-worker mode.
+        self.shared = shared
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def rows(self) -> list[list[Any]]:
+        """Current values as [label values, value...] rows."""
+        return []
+
+    def snapshot(self) -> dict[str, Any]:
+        """Everything needed to merge and render this metric in another
+        process, see `render`."""
+        return {
+            "kind": self.kind,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "rows": self.rows(),
+        }
+
+
+class Counter(Metric):
+    """Monotonic counter, one value per label combination. By convention
+    the name ends with _total."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def rows(self) -> list[list[Any]]:
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """Fixed bucket histogram, an observation is a bisect and two adds."""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # Per label combination: bucket counts (last one is +Inf) and sum.
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            state[0][index] += 1
+            state[1][0] += value
+
+    def time(self, labels: Labels = ()) -> Callable:
+        """Decorator observing the duration of every call."""
+        def decorator(func: Callable) -> Callable:
+            if iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    start = perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(perf_counter() - start, labels)
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(perf_counter() - start, labels)
+            return wrapper
+        return decorator
+
+    def rows(self) -> list[list[Any]]:
+        with self.lock:
+            return [
+                [list(labels), list(counts), total[0]]
+                for labels, (counts, total) in self.values.items()
+            ]
+
+    def snapshot(self) -> dict[str, Any]:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+class GaugeFunc(Metric):
+    """Gauge read from `func` at scrape time, which yields
+    (label values, value) pairs."""
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        func: Callable[[], Iterable[tuple[Labels, float]]],
+        labelnames: Labels = (),
+        shared: bool = False
+    ):
+        super().__init__(name, help, labelnames, shared)
+        self.func = func
+
+    def rows(self) -> list[list[Any]]:
+        return [[list(labels), value] for labels, value in self.func()]
+
+
+REGISTRY: list[Metric] = []
+
+Snapshot = dict[str, dict[str, Any]]
+
+
+def snapshot(shared: bool = True) -> Snapshot:
+    """Metrics of this process by name, without the shared ones unless
+    `shared`."""
+    return {
+        metric.name: metric.snapshot()
+        for metric in REGISTRY
+        if shared or not metric.shared
+    }
+
+
+def merge(snapshots: Iterable[Snapshot]) -> Snapshot:
+    """Add up the values of equally named metrics and labels, e.g. the
+    request counts of all API workers."""
+    result: Snapshot = {}
+    for metrics in snapshots:
+        for name, metric in metrics.items():
+            target = result.get(name)
+            if target is None:
+                target = result[name] = {**metric, "values": {}}
+            values = target["values"]
+            for labels, *value in metric["rows"]:
+                labels = tuple(labels)
+                if metric["kind"] == "histogram":
+                    counts, total = values.get(labels, ([0] * len(value[0]), 0))
+                    values[labels] = (
+                        [a + b for a, b in zip(counts, value[0])], total + value[1]
+                    )
+                else:
+                    values[labels] = values.get(labels, 0) + value[0]
+    return result
+
+
+def samples(name: str, metric: dict[str, Any]) -> Iterable[str]:
+    labelnames = metric["labelnames"]
+    for labels, value in metric["values"].items():
+        labels = tuple(map(escape, labels))
+        if metric["kind"] != "histogram":
+            yield f"{name}{format_labels(labelnames, labels)} {value}"
+            continue
+
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(metric["buckets"] + [float("inf")], counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            bucket_labels = format_labels(labelnames, labels, f'le="{le}"')
+            yield f"{name}_bucket{bucket_labels} {cumulative}"
+        yield f"{name}_sum{format_labels(labelnames, labels)} {total}"
+        yield f"{name}_count{format_labels(labelnames, labels)} {cumulative}"
+
+
+def render(others: Iterable[Snapshot] = ()) -> str:
+    """Text exposition of the metrics of this process, added up with the
+    snapshots of `others`."""
+    lines = []
+    for name, metric in merge([snapshot(), *others]).items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        lines.extend(samples(name, metric))
+    return "\n".join(lines) + "\n"
+
+
+def http_response(status: str, body: bytes = b"") -> bytes:
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n"
+    ).encode() + body
+
+
+async def serve_metrics(
+    host: str,
+    port: int,
+    collect: Optional[Callable[[], Awaitable[str]]] = None
+) -> Server:
+    """Answer `GET /metrics` with `collect()`, or the metrics of this
+    process, on a listener of its own.
+
+    The API port is public, metrics stay on an address only the scraper
+    can reach. Every connection serves one request.
+    """
+    async def handle(reader: StreamReader, writer: StreamWriter):
+        try:
+            request = await wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            method, target = request.split(b" ", 2)[:2]
+            if target.split(b"?", 1)[0] != b"/metrics":
+                writer.write(http_response("404 Not Found"))
+            elif method != b"GET":
+                writer.write(http_response("405 Method Not Allowed"))
+            else:
+                body = render() if collect is None else await collect()
+                writer.write(http_response("200 OK", body.encode()))
+            await writer.drain()
+        except (IncompleteReadError, LimitOverrunError, ConnectionError, WaitTimeout, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await start_server(handle, host, port)
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "wsm_http_request_duration_seconds",
+    "Duration of HTTP requests by route template.",
+    ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware():
+    """ASGI middleware timing every HTTP request.
+
+    Requests are labelled with the route template instead of the raw path,
+    so the number of series stays bounded.
+    """
+
+    def __init__(self, app: "ASGIApp"):
+        self.app = app
+
+    async def __call__(self, scope: "Scope", receive: "Receive", send: "Send"):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code: Optional[int] = None
+
+        async def send_wrapper(message: "Message"):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(perf_counter() - start, (
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code or 500),
+            ))
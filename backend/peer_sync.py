@@ -0,0 +1,66 @@
+from asyncio import get_event_loop
+from logging import getLogger
+from typing import Optional
+
+from scheams.connection_info import ConnectionInfo
+from wireguard import PeerConfig, StatusBackend
+from wireguard.sync import diff_peers
+from wireguard_status import BACKEND
+
+logger = getLogger("peer_sync")
+
+
+async def desired_peers() -> dict[str, PeerConfig]:
+    """Peers of assigned connections, free addresses are not routed."""
+    result = {}
+    async for connection in ConnectionInfo.find(
+        ConnectionInfo.discord_user_id != None
+    ):
+        result[connection.public_key] = connection.to_peer_config()
+    return result
+
+
+async def sync_peers(
+    remove_unknown: bool,
+    backend: Optional[StatusBackend] = None
+) -> tuple[int, int]:
+    """Apply only the difference between the connections in the database
+    and the live interface, without restarting it.
+
+    Peers which are not in the database, e.g. a site-to-site peer added by
+    hand, are only removed with `remove_unknown`. Returns the number of added
+    or updated peers and of removed peers.
+    """
+    backend = backend or BACKEND
+    desired = await desired_peers()
+    loop = get_event_loop()
+    live = await loop.run_in_executor(None, backend.dump)
+
+    set_peers, remove_peers = diff_peers(desired, live)
+    if remove_peers and not remove_unknown:
+        logger.warning(
+            f"Peers not in the database left on the interface: {', '.join(remove_peers)}"
+        )
+        remove_peers = []
+
+    if set_peers or remove_peers:
+        await loop.run_in_executor(None, backend.apply, set_peers, remove_peers)
+        logger.info(f"Peers synced, {len(set_peers)} set and {len(remove_peers)} removed.")
+    for public_key in remove_peers:
+        logger.info(f"Peer {public_key} removed, it is not in the database.")
+    return len(set_peers), len(remove_peers)
+
+
+async def add_peers(
+    connections: list[ConnectionInfo],
+    backend: Optional[StatusBackend] = None
+):
+    """Add or update `connections` on the live interface, leaving every
+    other peer untouched."""
+    loop = get_event_loop()
+    await loop.run_in_executor(
+        None,
+        (backend or BACKEND).apply,
+        [connection.to_peer_config() for connection in connections],
+        []
+    )
@@ -1,43 +1,138 @@
 from fastapi import (
     APIRouter,
+    Header,
     HTTPException,
+    Query,
+    Response,
     status,
     WebSocket,
     WebSocketDisconnect,
 )
-from starlette.websockets import WebSocketState
+from fastapi.responses import StreamingResponse
+from orjson import dumps
 
-from asyncio import CancelledError, create_task, gather, sleep as asleep
+from asyncio import get_event_loop, TimeoutError as WaitTimeout, wait_for
+from hashlib import blake2b
+from io import BytesIO
+from time import time
+from typing import Annotated, AsyncIterator, Optional
+from zipfile import ZipFile, ZIP_DEFLATED
 
+try:
+    from qrcode import make as make_qrcode
+except ImportError:
+    make_qrcode = None
+
+from cache import CLIENT_CONF_CACHE, USER_LIST_CACHE
+from database.database import read_collection
+from history import HISTORY
 from scheams.connection_info import ConnectionInfo
+from scheams.history import PeerHistory, StatusHistory
 from scheams.user import (
+    DiscordUserData,
     DiscordUserDataWithConnectionInfo,
     UserData
 )
-from wireguard_status import PUBLISHER
+from server_conf import write_server_conf
+from status_channel import query_history
+from status_frames import PROTOCOL as BINARY_PROTOCOL
+from wireguard_status import peer_endpoints, PUBLISHER
 
-from .oauth import UserDepends, user_depends, valid_token_string
+from .oauth import admin_depends, UserDepends, user_depends, valid_token_string
 
 
 IP_NOT_ENOUGH = HTTPException(
     status_code=status.HTTP_400_BAD_REQUEST,
     detail="IP on host not enough"
 )
+QRCODE_UNAVAILABLE = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="QR code export requires the qrcode package"
+)
+HISTORY_DISABLED = HTTPException(
+    status_code=status.HTTP_404_NOT_FOUND,
+    detail="Status history is disabled"
+)
+HISTORY_UNAVAILABLE = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Status history is temporarily unavailable"
+)
 
 router = APIRouter(
     prefix="/connection",
     tags=["Connection"]
 )
 
+# Only public profile fields ever leave the database, never the tokens.
+USER_LIST_PROJECTION = {
+    "_id": 0,
+    "connection": 1,
+    **{field: 1 for field in DiscordUserData.model_fields}
+}
+CONNECTION_LIST_PROJECTION = {"public_key": 1, "ip_address": 1}
+
+
+async def load_user_page(
+    cursor: Optional[str],
+    limit: int
+) -> tuple[str, bytes, Optional[str]]:
+    query = {} if cursor is None else {"discord_id": {"$gt": cursor}}
+    users = await read_collection(UserData).find(
+        query, USER_LIST_PROJECTION
+    ).sort("discord_id").limit(limit).to_list(length=limit)
+
+    connection_ids = [user["connection"].id for user in users if user.get("connection")]
+    connections = {
+        connection["_id"]: connection
+        async for connection in read_collection(ConnectionInfo).find(
+            {"_id": {"$in": connection_ids}}, CONNECTION_LIST_PROJECTION
+        )
+    }
+
+    result = []
+    for user in users:
+        link = user.pop("connection", None)
+        connection = connections.get(link.id) if link is not None else None
+        if connection is None:
+            continue
+        user["connection"] = {
+            "public_key": connection["public_key"],
+            "ip_address": connection["ip_address"],
+        }
+        result.append(user)
+
+    body = dumps(result)
+    etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+    next_cursor = users[-1]["discord_id"] if len(users) == limit else None
+    return etag, body, next_cursor
+
 
 @router.get(
     path="",
     response_model=list[DiscordUserDataWithConnectionInfo],
     status_code=status.HTTP_200_OK,
-    dependencies=[user_depends]
+    dependencies=[user_depends],
+    description="Users ordered by discord id, the next page cursor is in the X-Next-Cursor header",
+    responses={304: {"description": "The page matches If-None-Match"}}
 )
-async def get_users() -> list[DiscordUserDataWithConnectionInfo]:
-    return await UserData.find(fetch_links=True).project(DiscordUserDataWithConnectionInfo).to_list()
+async def get_users(
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 500,
+    if_none_match: Annotated[Optional[str], Header()] = None
+) -> Response:
+    page = USER_LIST_CACHE.get((cursor, limit))
+    if page is None:
+        page = await load_user_page(cursor, limit)
+        USER_LIST_CACHE.set((cursor, limit), page)
+
+    etag, body, next_cursor = page
+    headers = {"ETag": etag}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+
+    if if_none_match is not None and etag in map(str.strip, if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.get(
@@ -45,41 +140,147 @@ async def get_users() -> list[DiscordUserDataWithConnectionInfo]:
     status_code=status.HTTP_200_OK
 )
 async def get_connection_string(user: UserDepends) -> str:
+    client_conf = CLIENT_CONF_CACHE.get(user.discord_id)
+    if client_conf is not None:
+        return client_conf
+
     connection_data = await ConnectionInfo.find_one(
         ConnectionInfo.discord_user_id == user.discord_id
     )
 
     if connection_data is None:
         return ""
-    return connection_data.to_client_conf()
+
+    client_conf = connection_data.to_client_conf()
+    CLIENT_CONF_CACHE.set(user.discord_id, client_conf)
+    return client_conf
+
+
+class ZipChunks():
+    """Write-only file which hands out what was written since the last
+    `pop`, so a zip archive can be streamed while it is built."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def render_qrcode(text: str) -> bytes:
+    buffer = BytesIO()
+    make_qrcode(text).save(buffer)
+    return buffer.getvalue()
+
+
+async def export_client_confs(qrcode: bool) -> AsyncIterator[bytes]:
+    loop = get_event_loop()
+    chunks = ZipChunks()
+    with ZipFile(chunks, "w", ZIP_DEFLATED) as zip_file:
+        async for connection in ConnectionInfo.find(
+            ConnectionInfo.discord_user_id != None
+        ):
+            client_conf = connection.to_client_conf()
+            zip_file.writestr(f"{connection.ip_address}.conf", client_conf)
+            if qrcode:
+                zip_file.writestr(
+                    f"{connection.ip_address}.png",
+                    await loop.run_in_executor(None, render_qrcode, client_conf)
+                )
+            yield chunks.pop()
+    yield chunks.pop()
+
+
+@router.get(
+    path="/export",
+    status_code=status.HTTP_200_OK,
+    dependencies=[admin_depends],
+    response_class=StreamingResponse,
+    description="Zip of every assigned client config, optionally with QR codes"
+)
+async def export_connections(qrcode: bool = False) -> StreamingResponse:
+    if qrcode and make_qrcode is None:
+        raise QRCODE_UNAVAILABLE
+
+    return StreamingResponse(
+        export_client_confs(qrcode),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="connections.zip"'}
+    )
+
+
+@router.post(
+    path="/server-conf",
+    status_code=status.HTTP_200_OK,
+    dependencies=[admin_depends],
+    description="Rewrite the server side wireguard config, returns the number of peers"
+)
+async def regenerate_server_conf() -> int:
+    return await write_server_conf()
+
+
+@router.get(
+    path="/endpoints",
+    status_code=status.HTTP_200_OK,
+    dependencies=[admin_depends],
+    description="Last known endpoint of every peer, which the status stream leaves out"
+)
+async def get_endpoints() -> dict[str, Optional[str]]:
+    return peer_endpoints()
+
+
+@router.get(
+    path="/history",
+    response_model=StatusHistory,
+    status_code=status.HTTP_200_OK,
+    dependencies=[user_depends],
+    description="Aggregated peer status between two unix timestamps, last hour by default"
+)
+async def get_history(
+    start: Optional[int] = None,
+    end: Optional[int] = None
+) -> StatusHistory:
+    if HISTORY is None:
+        raise HISTORY_DISABLED
+
+    end = int(time()) if end is None else end
+    start = end - 3600 if start is None else start
+
+    try:
+        resolution, peers = await query_history(start, end)
+    except (ConnectionError, WaitTimeout):
+        raise HISTORY_UNAVAILABLE
+    return StatusHistory(
+        start=start,
+        end=end,
+        resolution=resolution,
+        peers=[
+            PeerHistory(public_key=public_key, **data)
+            for public_key, data in peers.items()
+        ]
+    )
 
 
 @router.websocket(
     path="/ws"
 )
 async def subscribe(ws: WebSocket):
-    async def timeout():
-        try:
-            await asleep(5)
-            raise TimeoutError
-        except CancelledError:
-            return
-
+    # JSON stays the default, clients opt in to the binary frames.
+    binary = BINARY_PROTOCOL in ws.scope.get("subprotocols", [])
     try:
-        await ws.accept()
+        await ws.accept(subprotocol=BINARY_PROTOCOL if binary else None)
 
         try:
-            timeout_task = create_task(timeout())
-            async def wait_token():
-                token = await ws.receive_text()
-                timeout_task.cancel()
-                return token
-            
-            token = (await gather(
-                create_task(wait_token()),
-                timeout_task
-            ))[0]
-
+            token = await wait_for(ws.receive_text(), 5)
             valid_token_string(token)
         except:
             try:
@@ -87,9 +288,18 @@ async def subscribe(ws: WebSocket):
             except:
                 pass
             return
-
-        await PUBLISHER.add_subscriber(ws)
-        while ws.client_state == WebSocketState.CONNECTED:
-            await asleep(1)
     except WebSocketDisconnect:
+        return
+
+    PUBLISHER.add_subscriber(ws, binary)
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("text") == "resync":
+                PUBLISHER.resync(ws)
+    except (RuntimeError, WebSocketDisconnect):
+        pass
+    finally:
         PUBLISHER.remove_subscriber(ws)
@@ -1,4 +1,3 @@
-from aiohttp import ClientSession
 from fastapi import (
     APIRouter,
     Depends,
@@ -10,20 +9,28 @@ from fastapi.security import (
     HTTPAuthorizationCredentials,
     HTTPBearer
 )
-from jwt import encode, decode
-from orjson import loads
+from jwt import encode, PyJWT
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 
+from hashlib import blake2b
+from logging import getLogger
+from time import time
 from typing import Annotated, Optional
 
+from allocator import claim_connection, release_connection
+from cache import CLIENT_CONF_CACHE, SingleFlight, TTLCache, USER_LIST_CACHE
 from config import (
+    ADMIN_IDS,
     JWT_KEY,
     JOIN_KEY,
     DISCORD_REDIRECT_URI,
     DISCORD_CLIENT_ID,
     DISCORD_CLIENT_SECRET
 )
-from scheams.connection_info import ConnectionInfo
+from discord_api import DISCORD
+from metrics import Histogram
+from peer_sync import add_peers
 from scheams.jwt import JWT, JWTPayload
 from scheams.user import (
     DiscordTokenData,
@@ -37,8 +44,6 @@ class OAuthData(BaseModel):
     join_key: Optional[str] = None
 
 
-DISCORD_API = "https://discord.com/api/v10/"
-
 AUTHORIZE_FAILED = HTTPException(
     status_code=status.HTTP_400_BAD_REQUEST,
     detail="Authorize failed"
@@ -47,6 +52,10 @@ JOIN_KEY_WRONG = HTTPException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="The join key is wrong"
 )
+PERMISSION_DENIED = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Permission denied"
+)
 INVALIDE_AUTHENTICATION_CREDENTIALS = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Invalid authentication credentials"
@@ -61,27 +70,46 @@ SECURITY = HTTPBearer(
     description="JWT which get from posting discord oauth code to /oauth"
 )
 
+VALID_CODE_SECONDS = Histogram(
+    "wsm_oauth_valid_code_duration_seconds",
+    "Duration of exchanging a Discord code or refresh token for a user.",
+)
+
 router = APIRouter(
     prefix="/oauth",
     tags=["OAuth"]
 )
 
+logger = getLogger("oauth")
+
+JWT_DECODER = PyJWT(options={"require": ["exp", "iat"]})
+# Verified payloads keyed by token digest, each kept until the token expires.
+TOKEN_CACHE: TTLCache[bytes, JWTPayload] = TTLCache(maxsize=4096)
+# Recently refreshed users, so refreshes from many tabs hit Discord once.
+PROFILE_CACHE: TTLCache[str, UserData] = TTLCache(maxsize=4096, ttl=300)
+PROFILE_REFRESH: SingleFlight[str, UserData] = SingleFlight()
+PROFILE_FIELDS = set(DiscordUserData.model_fields)
+
+
+def valid_token_string(jwt: str) -> JWTPayload:
+    digest = blake2b(jwt.encode(), digest_size=32).digest()
+    payload = TOKEN_CACHE.get(digest)
+    if payload is not None:
+        return payload
 
-def valid_token_string(jwt: str):
     try:
-        decode_data = JWTPayload(**decode(
+        claims = JWT_DECODER.decode(
             jwt=jwt,
             key=JWT_KEY,
-            algorithms=["HS256"],
-            options={
-                "require": ["exp", "iat"]
-            }
-        ))
-
-        return decode_data
+            algorithms=["HS256"]
+        )
+        payload = JWTPayload.from_claims(claims)
     except:
         raise INVALIDE_AUTHENTICATION_CREDENTIALS
 
+    TOKEN_CACHE.set(digest, payload, ttl=claims["exp"] - time())
+    return payload
+
 
 def valid_token(token: HTTPAuthorizationCredentials = Security(SECURITY)) -> JWTPayload:
     jwt = token.credentials
@@ -92,20 +120,33 @@ user_depends = Depends(valid_token)
 UserDepends = Annotated[JWTPayload, user_depends]
 
 
+def valid_admin(user: UserDepends) -> JWTPayload:
+    if user.discord_id not in ADMIN_IDS:
+        raise PERMISSION_DENIED
+    return user
+
+
+admin_depends = Depends(valid_admin)
+
+
 async def fetch_user_data(token_data: DiscordTokenData) -> DiscordUserData:
-    async with ClientSession(
+    status_code, data = await DISCORD.request(
+        "GET",
+        "users/@me",
         headers={
             "Authorization": f"{token_data.token_type} {token_data.access_token}"
         }
-    ) as client:
-        response = await client.get(f"{DISCORD_API}/users/@me")
-        data = loads(await response.content.read())
-        data["discord_id"] = data["id"]
-        return DiscordUserData(
-            **data
-        )
+    )
+    if status_code != 200 or data is None:
+        raise AUTHORIZE_FAILED
+
+    data["discord_id"] = data["id"]
+    return DiscordUserData(
+        **data
+    )
 
 
+@VALID_CODE_SECONDS.time()
 async def valid_code(
     code: Optional[str] = None,
     token: Optional[str] = None,
@@ -114,31 +155,26 @@ async def valid_code(
     if code is None and token is None:
         raise ValueError
 
-    async with ClientSession(
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    ) as client:
-        data = {
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": DISCORD_REDIRECT_URI,
-        } if code else {
-            "grant_type": "refresh_token",
-            "refresh_token": token
-        }
-        data["client_id"] = DISCORD_CLIENT_ID
-        data["client_secret"] = DISCORD_CLIENT_SECRET
-
-        response = await client.post(
-            f"{DISCORD_API}/oauth2/token",
-            data=data
-        )
-
-        if response.status != 200:
-            raise AUTHORIZE_FAILED
+    data = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": DISCORD_REDIRECT_URI,
+    } if code else {
+        "grant_type": "refresh_token",
+        "refresh_token": token
+    }
+    data["client_id"] = DISCORD_CLIENT_ID
+    data["client_secret"] = DISCORD_CLIENT_SECRET
+
+    status_code, response_data = await DISCORD.request(
+        "POST",
+        "oauth2/token",
+        data=data
+    )
+    if status_code != 200 or response_data is None:
+        raise AUTHORIZE_FAILED
 
-        token_data = DiscordTokenData(**loads(
-            await response.content.read()
-        ))
+    token_data = DiscordTokenData(**response_data)
 
     if "identify" not in token_data.scope:
         raise AUTHORIZE_FAILED
@@ -152,26 +188,64 @@ async def valid_code(
         if join_key != JOIN_KEY:
             raise JOIN_KEY_WRONG
 
-        connection = await ConnectionInfo.find_one(
-            ConnectionInfo.discord_user_id == None
-        )
+        connection = await claim_connection(discord_data.discord_id)
         if connection is None:
             raise IP_NOT_ENOUGH
 
-        user_data = UserData(
-            **new_data,
-            connection=connection
-        )
-        connection.discord_user_id = user_data.discord_id
-
-        await connection.save()
-        await user_data.save()
+        try:
+            user_data = await UserData(
+                **new_data,
+                connection=connection
+            ).insert()
+        except DuplicateKeyError:
+            # The same user joined concurrently and has a connection already.
+            await release_connection(connection)
+            user_data = await UserData.find_one(
+                UserData.discord_id == discord_data.discord_id
+            )
+            await user_data.set(new_data)
+            return user_data
+        except:
+            await release_connection(connection)
+            raise
+        finally:
+            USER_LIST_CACHE.invalidate()
+            CLIENT_CONF_CACHE.invalidate(discord_data.discord_id)
+
+        try:
+            await add_peers([connection])
+        except Exception as error:
+            logger.warning(f"Failed to add peer of {user_data.discord_id}: {error}")
     else:
-        await user_data.set(new_data)
+        # Tokens rotate on every refresh, the profile rarely changes.
+        changed = {
+            key: value
+            for key, value in new_data.items()
+            if getattr(user_data, key) != value
+        }
+        if changed:
+            await user_data.set(changed)
+        if PROFILE_FIELDS.intersection(changed):
+            USER_LIST_CACHE.invalidate()
 
+    PROFILE_CACHE.set(user_data.discord_id, user_data)
     return user_data
 
 
+async def refresh_user(discord_id: str) -> UserData:
+    user_data = PROFILE_CACHE.get(discord_id)
+    if user_data is not None:
+        return user_data
+
+    async def refresh_from_discord() -> UserData:
+        user_data = await UserData.find_one(UserData.discord_id == discord_id)
+        if user_data is None:
+            raise INVALIDE_AUTHENTICATION_CREDENTIALS
+        return await valid_code(token=user_data.refresh_token)
+
+    return await PROFILE_REFRESH.do(discord_id, refresh_from_discord)
+
+
 @router.post(
     path="",
     response_model=JWT,
@@ -201,9 +275,7 @@ async def oauth(data: OAuthData) -> JWT:
     description="Refresh token",
 )
 async def refresh(user: UserDepends) -> JWT:
-    user_data = await UserData.find_one(UserData.discord_id == user.discord_id)
-
-    new_data = await valid_code(token=user_data.refresh_token)
+    new_data = await refresh_user(user.discord_id)
 
     jwt_payload = JWTPayload(**new_data.model_dump())
 
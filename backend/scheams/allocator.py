@@ -0,0 +1,10 @@
+from beanie import Document
+
+
+class IPAllocator(Document):
+    # Offset of the next never-used address, counted from the first client
+    # address of the subnet.
+    next_offset: int = 0
+
+    class Settings:
+        name = "Allocator"
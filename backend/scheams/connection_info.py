@@ -1,7 +1,8 @@
-from beanie import Document
+from beanie import Document, Indexed
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
-from typing import Optional
+from typing import Annotated, Optional
 
 from config import (
     WIREGUARD_ENDPOINT,
@@ -11,28 +12,36 @@ from config import (
     WIREGUARD_SUBNET,
     WIREGUARD_ADDITION_IPS
 )
+from wireguard import PeerConfig
+
+
+# Matches free connections, the partial index below only holds those.
+UNASSIGNED_FILTER = {"discord_user_id": {"$type": "null"}}
+
+# The server side [Peer] block is the same for every client.
+CLIENT_PEER_BLOCK = "\n".join([
+    f"[Peer]",
+    f"PublicKey = {WIREGUARD_PUBLIC_KEY}",
+    f"PresharedKey = {WIREGUARD_PRESHARED_KEY}",
+    f"AllowedIPs = {', '.join([WIREGUARD_SUBNET.with_prefixlen] + WIREGUARD_ADDITION_IPS)}",
+    f"Endpoint = {WIREGUARD_ENDPOINT}",
+    f"PersistentKeepalive = {WIREGUARD_KEEP_ALIVE}",
+])
 
 
 class ConnectionInfo(Document):
     private_key: str
     public_key: str
-    ip_address: str
-    discord_user_id: Optional[str] = None
+    ip_address: Annotated[str, Indexed(unique=True)]
+    discord_user_id: Annotated[Optional[str], Indexed()] = None
 
     def to_client_conf(self) -> str:
-        allowed_ips = [WIREGUARD_SUBNET.with_prefixlen] + WIREGUARD_ADDITION_IPS
-
         result = [
             f"[Interface]",
             f"PrivateKey = {self.private_key}",
             f"Address = {self.ip_address}/{WIREGUARD_SUBNET.prefixlen}",
             f"",
-            f"[Peer]",
-            f"PublicKey = {WIREGUARD_PUBLIC_KEY}",
-            f"PresharedKey = {WIREGUARD_PRESHARED_KEY}",
-            f"AllowedIPs = {', '.join(allowed_ips)}",
-            f"Endpoint = {WIREGUARD_ENDPOINT}",
-            f"PersistentKeepalive = {WIREGUARD_KEEP_ALIVE}",
+            CLIENT_PEER_BLOCK,
         ]
 
         return "\n".join(result)
@@ -47,8 +56,22 @@ class ConnectionInfo(Document):
 
         return "\n".join(result)
 
+    def to_peer_config(self) -> PeerConfig:
+        return PeerConfig(
+            public_key=self.public_key,
+            preshared_key=WIREGUARD_PRESHARED_KEY,
+            allowed_ips=(f"{self.ip_address}/32",)
+        )
+
     class Settings:
         name = "Connections"
+        indexes = [
+            IndexModel(
+                [("discord_user_id", ASCENDING), ("ip_address", ASCENDING)],
+                name="unassigned_connections",
+                partialFilterExpression=UNASSIGNED_FILTER
+            ),
+        ]
 
 
 class ConnectionInfoPublic(BaseModel):
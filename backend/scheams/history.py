@@ -0,0 +1,31 @@
+from pydantic import BaseModel, Field
+
+
+class PeerHistory(BaseModel):
+    public_key: str
+    online_minutes: float = Field(
+        title="Online Minutes",
+        description="Minutes the peer had a recent handshake in the window."
+    )
+    rx_bytes: int = Field(
+        title="Received Bytes",
+        description="Bytes received from the peer in the window."
+    )
+    tx_bytes: int = Field(
+        title="Transmitted Bytes",
+        description="Bytes sent to the peer in the window."
+    )
+    p95_throughput: float = Field(
+        title="P95 Throughput",
+        description="95th percentile of rx + tx bytes per second."
+    )
+
+
+class StatusHistory(BaseModel):
+    start: int
+    end: int
+    resolution: int = Field(
+        title="Resolution",
+        description="Bucket size in seconds the aggregates are computed from."
+    )
+    peers: list[PeerHistory]
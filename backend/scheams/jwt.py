@@ -36,6 +36,18 @@ class JWTPayload(DiscordUserData):
         except:
             raise ValidationError
 
+    @classmethod
+    def from_claims(cls, claims: dict[str, Any]) -> "JWTPayload":
+        """Build a payload from claims whose signature was already verified.
+
+        Skips validation, the display fields were computed when the token
+        was issued.
+        """
+        claims = dict(claims)
+        claims["iat"] = datetime.fromtimestamp(claims["iat"], tz=UTC)
+        claims["exp"] = datetime.fromtimestamp(claims["exp"], tz=UTC)
+        return cls.model_construct(**claims)
+
 
 class JWT(BaseModel):
     token_type: str = "Bearer"
@@ -0,0 +1,57 @@
+from typing import AsyncIterator, Optional
+
+from config import (
+    WIREGUARD_CONF_PATH,
+    WIREGUARD_MTU,
+    WIREGUARD_PORT,
+    WIREGUARD_POST_DOWN,
+    WIREGUARD_POST_UP,
+    WIREGUARD_PRIVATE_KEY,
+    WIREGUARD_SUBNET,
+)
+from scheams.connection_info import ConnectionInfo
+from wireguard.sync import atomic_writer
+
+
+def interface_section() -> str:
+    server_ip = next(WIREGUARD_SUBNET.hosts())
+    result = [
+        f"[Interface]",
+        f"Address = {server_ip}/{WIREGUARD_SUBNET.prefixlen}",
+        f"PrivateKey = {WIREGUARD_PRIVATE_KEY}",
+        f"ListenPort = {WIREGUARD_PORT}",
+        f"MTU = {WIREGUARD_MTU}",
+    ]
+    if WIREGUARD_POST_UP and WIREGUARD_POST_DOWN:
+        result.append(f"PostUp = {WIREGUARD_POST_UP}")
+        result.append(f"PostDown = {WIREGUARD_POST_DOWN}")
+
+    return "\n".join(result) + "\n"
+
+
+async def render_server_conf() -> AsyncIterator[str]:
+    """Yield the server side config section by section.
+
+    Only assigned connections become peers, and they are read from a cursor
+    so memory does not grow with the subnet size.
+    """
+    yield interface_section()
+
+    async for connection in ConnectionInfo.find(
+        ConnectionInfo.discord_user_id != None
+    ):
+        yield "\n" + connection.gen_server_side_config() + "\n"
+
+
+async def write_server_conf(path: Optional[str] = None) -> int:
+    """Atomically replace the server side config at `path`.
+
+    Returns the number of written peers.
+    """
+    peer_count = -1
+    with atomic_writer(path or WIREGUARD_CONF_PATH) as conf_file:
+        async for section in render_server_conf():
+            conf_file.write(section)
+            peer_count += 1
+
+    return peer_count
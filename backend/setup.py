@@ -1,11 +1,11 @@
 from orjson import dumps, loads
-from pywgkey import WgKey
 
 from argparse import ArgumentParser
-from asyncio import create_task, gather, run as run_sync
+from asyncio import run as run_sync
 from ipaddress import IPv4Address, IPv4Network
 from subprocess import PIPE, run
-from typing import Any, Callable, Optional
+from time import monotonic
+from typing import Any, Callable, Optional, Union
 
 from config import Config
 
@@ -30,80 +30,139 @@ def minmax(min: int, max: int):
     return wrap
 
 
-async def setup_keypair():
-    from config import (
-        WIREGUARD_SUBNET,
-        WIREGUARD_PRIVATE_KEY,
-        WIREGUARD_PORT,
-        WIREGUARD_MTU,
-        WIREGUARD_POST_UP,
-        WIREGUARD_POST_DOWN,
-        WIREGUARD_INTERFACE
+async def assign_connections(workers: Optional[int] = None, pregenerate: int = 0):
+    """Give every user a connection while keeping the addresses which are
+    already assigned, and link users to their connection in bulk."""
+    from bson import DBRef
+    from pymongo.operations import DeleteOne, UpdateOne
+
+    from allocator import (
+        ip_to_offset,
+        provision_connections,
+        reserve_offsets,
+        set_next_offset
     )
-    from database.database import setup
+    from database.database import bulk_write_chunked
     from scheams.connection_info import ConnectionInfo
     from scheams.user import UserData
+    from wireguard.keys import iter_keypairs
 
-    default_path = f"/etc/wireguard/{WIREGUARD_INTERFACE}.conf"
-    CONF_PATH = input(f"Your conf path [{default_path}]: ") or default_path
+    user_collection = UserData.get_motor_collection()
+    connection_collection = ConnectionInfo.get_motor_collection()
 
-    await setup()
+    linked = {
+        user["discord_id"]: user.get("connection")
+        async for user in user_collection.find(
+            {}, {"_id": 0, "discord_id": 1, "connection": 1}
+        )
+    }
+
+    kept: dict[str, Any] = {}
+    free: list[Any] = []
+    # Connections of users who are gone. Their old owner still has the
+    # private key, so they get a new key pair before anybody reuses them.
+    revoked: list[Any] = []
+    connection_updates: list[Union[DeleteOne, UpdateOne]] = []
+    max_offset = -1
+    async for conn in connection_collection.find(
+        {}, {"ip_address": 1, "discord_user_id": 1}
+    ):
+        offset = ip_to_offset(conn["ip_address"])
+        if offset is None:
+            # Left over from a previous subnet, a fresh one is provisioned.
+            connection_updates.append(DeleteOne({"_id": conn["_id"]}))
+            continue
+
+        max_offset = max(max_offset, offset)
+        owner = conn.get("discord_user_id")
+        if owner in linked and owner not in kept:
+            kept[owner] = conn["_id"]
+            continue
+
+        if owner is not None:
+            revoked.append(conn["_id"])
+        free.append(conn["_id"])
+
+    missing = [discord_id for discord_id in linked if discord_id not in kept]
+    new_owners: dict[Any, Optional[str]] = dict.fromkeys(revoked)
+    for discord_id, conn_id in zip(missing, free):
+        kept[discord_id] = conn_id
+        new_owners[conn_id] = discord_id
+    missing = missing[len(free):]
+
+    revoked_ids = iter(revoked)
+    async for keypairs in iter_keypairs(len(revoked), workers):
+        for (private_key, public_key), conn_id in zip(keypairs, revoked_ids):
+            connection_updates.append(UpdateOne({"_id": conn_id}, {"$set": {
+                "private_key": private_key,
+                "public_key": public_key,
+                "discord_user_id": new_owners.pop(conn_id),
+            }}))
+    for conn_id, discord_id in new_owners.items():
+        connection_updates.append(UpdateOne(
+            {"_id": conn_id},
+            {"$set": {"discord_user_id": discord_id}}
+        ))
+
+    await bulk_write_chunked(connection_collection, connection_updates)
+    print(f"{len(linked) - len(missing)} users keep or reuse their address.")
+    if revoked:
+        print(f"{len(revoked)} connections of removed users got new keys.")
+
+    # Addresses are allocated lazily, only users without one get a new one
+    # here unless some free ones are pregenerated.
+    await set_next_offset(max_offset + 1)
+    owners = missing + [None] * pregenerate
+    first_offset = await reserve_offsets(len(owners))
+
+    created = 0
+    start_time = monotonic()
+    async for batch in provision_connections(first_offset, owners, workers):
+        for conn in batch:
+            if conn.discord_user_id is not None:
+                kept[conn.discord_user_id] = conn.id
+
+        created += len(batch)
+        elapsed = monotonic() - start_time
+        print(
+            f"{created}/{len(owners)} connections created, "
+            f"{created / elapsed if elapsed else 0:.0f} keys/s",
+        )
 
-    await ConnectionInfo.delete_all()
+    collection_name = ConnectionInfo.get_collection_name()
+    await bulk_write_chunked(user_collection, [
+        UpdateOne(
+            {"discord_id": discord_id},
+            {"$set": {"connection": DBRef(collection_name, conn_id)}}
+        )
+        for discord_id, conn_id in kept.items()
+        if getattr(linked[discord_id], "id", None) != conn_id
+    ])
 
-    ips = list(WIREGUARD_SUBNET.hosts())[1:]
 
-    def gen_connection(ip: IPv4Address) -> ConnectionInfo:
-        key = WgKey()
-        return ConnectionInfo(
-            private_key=key.privkey,
-            public_key=key.pubkey,
-            ip_address=str(ip),
-        )
+async def setup_keypair(workers: Optional[int] = None, pregenerate: int = 0):
+    from config import WIREGUARD_CONF_PATH, WIREGUARD_INTERFACE
+    from database.database import setup
+    from peer_sync import sync_peers
+    from server_conf import write_server_conf
+
+    CONF_PATH = input(f"Your conf path [{WIREGUARD_CONF_PATH}]: ") or WIREGUARD_CONF_PATH
 
-    connections = list(map(gen_connection, ips))
-
-    await ConnectionInfo.insert_many(connections)
-    connections = await ConnectionInfo.find_all().to_list()
-
-    users = await UserData.find_all().to_list()
-    if len(users) > len(connections):
-        raise RuntimeError("IP Not Enough")
-
-    async def task(user: UserData, conn: ConnectionInfo):
-        conn.discord_user_id = user.discord_id
-        user.connection = conn
-
-        await conn.save()
-        await user.save()
-
-    await gather(*list(map(
-        lambda pair: create_task(task(*pair)),
-        zip(users, connections)
-    )))
-
-    server_ip = list(WIREGUARD_SUBNET.hosts())[0]
-    server_side_config = [
-        f"[Interface]",
-        f"Address = {server_ip}/{WIREGUARD_SUBNET.prefixlen}",
-        f"PrivateKey = {WIREGUARD_PRIVATE_KEY}",
-        f"ListenPort = {WIREGUARD_PORT}",
-        f"MTU = {WIREGUARD_MTU}",
-    ]
-    if WIREGUARD_POST_UP and WIREGUARD_POST_DOWN:
-        server_side_config.append(f"PostUp = {WIREGUARD_POST_UP}")
-        server_side_config.append(f"PostDown = {WIREGUARD_POST_DOWN}")
-
-    for conn in connections:
-        server_side_config.append("")
-        server_side_config.append(conn.gen_server_side_config())
-
-    with open(CONF_PATH, "w", encoding="utf-8") as conf_file:
-        conf_file.write("\n".join(server_side_config))
-
-    print("Restart interface...")
-    run(["wg-quick", "down", WIREGUARD_INTERFACE])
-    run(["wg-quick", "up", WIREGUARD_INTERFACE])
+    await setup()
+    await assign_connections(workers, pregenerate)
+
+    peer_count = await write_server_conf(CONF_PATH)
+    print(f"{peer_count} peers written into {CONF_PATH}.")
+
+    print("Sync peers...")
+    try:
+        # The server config was just rewritten from the database as well.
+        # This also removes the old keys of revoked connections.
+        set_count, remove_count = await sync_peers(True)
+        print(f"{set_count} peers set, {remove_count} peers removed.")
+    except OSError:
+        print("Interface is not up, start interface...")
+        run(["wg-quick", "up", WIREGUARD_INTERFACE])
     print("Finish!")
 
 
@@ -205,10 +264,23 @@ if __name__ == "__main__":
         help="Generate key pairs and setup wireguard conf"
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes used to generate key pairs, all cores by default"
+    )
+    parser.add_argument(
+        "--pregenerate",
+        type=int,
+        default=0,
+        help="Free connections to create in addition to the existing users"
+    )
+
     args = parser.parse_args()
     if args.config:
         setup_config()
     elif args.setup:
-        run_sync(setup_keypair())
+        run_sync(setup_keypair(args.workers, args.pregenerate))
     else:
         parser.print_help()
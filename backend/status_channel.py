@@ -0,0 +1,290 @@
+from orjson import dumps, loads
+
+from asyncio import (
+    CancelledError,
+    Future,
+    IncompleteReadError,
+    StreamReader,
+    StreamWriter,
+    get_event_loop,
+    open_unix_connection,
+    sleep as asleep,
+    start_unix_server,
+    wait,
+    wait_for
+)
+from logging import getLogger
+from os import chmod, remove
+from struct import Struct
+from typing import Any, Optional
+
+from cache import SHARED_CACHES
+from config import WIREGUARD_INTERFACE
+from history import HISTORY
+from metrics import Snapshot, snapshot
+from status_table import StatusTable, table_name
+from wireguard import PeerStatus
+from wireguard_status import PUBLISHER, update_status
+
+logger = getLogger("status_channel")
+
+# Every frame is a big endian length followed by one orjson message.
+FRAME_HEADER = Struct("!I")
+MAX_FRAME_SIZE = 64 << 20
+# A worker which has this much unsent data skips samples until it catches up.
+MAX_WRITE_BUFFER = 16 << 20
+RECONNECT_DELAY = 1
+HISTORY_TIMEOUT = 10
+# Workers which do not send their metrics in time are left out of a scrape.
+METRICS_TIMEOUT = 5
+
+
+def encode_frame(message: Any) -> bytes:
+    body = dumps(message)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader: StreamReader) -> Any:
+    (size,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Status frame of {size} bytes is too large")
+    return loads(await reader.readexactly(size))
+
+
+class ChannelServer():
+    """Poller side of the channel to the API workers.
+
+    Every sample of the interface is sent to all workers, which feed it into
+    their own AutoPublisher. Workers report how many websockets they serve,
+    so the poller only polls fast while somebody is watching, and forward
+    history queries since only the poller records history. For a scrape the
+    poller collects the metrics of every worker. Invalidations of the shared
+    caches are passed on to the other workers.
+
+    With a shared status `table` the peers are written there instead and
+    samples only tell the workers when to read it.
+    """
+
+    def __init__(self, table: Optional[StatusTable] = None):
+        self.workers: dict[StreamWriter, int] = {}
+        self.last_sample: Optional[bytes] = None
+        self.table = table
+        self.metrics_requests: dict[int, dict[StreamWriter, Future]] = {}
+        self.next_id = 0
+
+    async def start(self, path: str):
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        self.path = path
+        self.server = await start_unix_server(self.handle, path)
+        # Anyone who can connect may query the history and metrics.
+        chmod(path, 0o600)
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.workers):
+            writer.close()
+        await self.server.wait_closed()
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def subscribers_changed(self):
+        if any(self.workers.values()):
+            PUBLISHER.has_subscribers.set()
+        else:
+            PUBLISHER.has_subscribers.clear()
+
+    async def handle(self, reader: StreamReader, writer: StreamWriter):
+        self.workers[writer] = 0
+        if self.last_sample is not None:
+            writer.write(self.last_sample)
+
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message["type"] == "subscribers":
+                    self.workers[writer] = message["count"]
+                    self.subscribers_changed()
+                elif message["type"] == "history":
+                    resolution, peers = await get_event_loop().run_in_executor(
+                        None, HISTORY.query, message["start"], message["end"]
+                    )
+                    writer.write(encode_frame({
+                        "type": "history",
+                        "id": message["id"],
+                        "resolution": resolution,
+                        "peers": peers,
+                    }))
+                elif message["type"] == "metrics":
+                    future = self.metrics_requests.get(message["id"], {}).get(writer)
+                    if future is not None and not future.done():
+                        future.set_result(message["metrics"])
+                elif message["type"] == "invalidate":
+                    frame = encode_frame(message)
+                    for other in self.workers:
+                        if other is not writer:
+                            other.write(frame)
+        except (IncompleteReadError, ConnectionError):
+            pass
+        except Exception as error:
+            logger.warning(f"Status channel to a worker failed: {error}")
+        finally:
+            del self.workers[writer]
+            self.subscribers_changed()
+            # A scrape does not wait for a worker which is gone.
+            for futures in self.metrics_requests.values():
+                future = futures.get(writer)
+                if future is not None and not future.done():
+                    future.set_result(None)
+            writer.close()
+
+    async def collect_metrics(self) -> list[Snapshot]:
+        """Metrics of every worker which answers within METRICS_TIMEOUT."""
+        if not self.workers:
+            return []
+
+        self.next_id += 1
+        request_id = self.next_id
+        loop = get_event_loop()
+        futures = self.metrics_requests[request_id] = {
+            writer: loop.create_future() for writer in self.workers
+        }
+        request = encode_frame({"type": "metrics", "id": request_id})
+        for writer in futures:
+            writer.write(request)
+        try:
+            done, _ = await wait(futures.values(), timeout=METRICS_TIMEOUT)
+        finally:
+            del self.metrics_requests[request_id]
+        return [future.result() for future in done if future.result() is not None]
+
+    def publish(self, peers: list[PeerStatus], now: float):
+        """Send a sample to every worker, serialized once."""
+        if self.table is not None:
+            self.table.write(peers)
+            self.last_sample = encode_frame({"type": "sample", "now": now})
+        else:
+            self.last_sample = encode_frame({
+                "type": "sample",
+                "now": now,
+                # Preshared keys stay in the poller.
+                "peers": [peer[:6] for peer in peers],
+            })
+        for writer in self.workers:
+            if writer.transport.get_write_buffer_size() < MAX_WRITE_BUFFER:
+                writer.write(self.last_sample)
+
+
+class ChannelClient():
+    """Worker side of the channel, see ChannelServer."""
+
+    def __init__(self):
+        # Set once the process runs as an API worker.
+        self.enabled = False
+        self.writer: Optional[StreamWriter] = None
+        self.pending: dict[int, Future] = {}
+        self.next_id = 0
+        self.table: Optional[StatusTable] = None
+
+    def read_peers(self, message: dict[str, Any]) -> list[PeerStatus]:
+        if "peers" in message:
+            return [
+                PeerStatus(*peer[:5], tuple(peer[5]))
+                for peer in message["peers"]
+            ]
+
+        if self.table is None:
+            self.table = StatusTable.attach(table_name(WIREGUARD_INTERFACE))
+        return self.table.read()
+
+    def send_subscribers(self, count: int):
+        if self.writer is not None:
+            self.writer.write(encode_frame({"type": "subscribers", "count": count}))
+
+    def send_invalidate(self, cache: str, key: Any):
+        if self.writer is not None:
+            self.writer.write(encode_frame({"type": "invalidate", "cache": cache, "key": key}))
+
+    async def query_history(self, start: int, end: int) -> tuple[int, dict[str, Any]]:
+        if self.writer is None:
+            raise ConnectionError("Status channel is not connected")
+
+        self.next_id += 1
+        request_id = self.next_id
+        future = self.pending[request_id] = get_event_loop().create_future()
+        self.writer.write(encode_frame({
+            "type": "history",
+            "id": request_id,
+            "start": start,
+            "end": end,
+        }))
+        try:
+            message = await wait_for(future, HISTORY_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+        return message["resolution"], message["peers"]
+
+    async def run(self, path: str):
+        """Receive samples until cancelled, reconnecting when the poller
+        restarts."""
+        self.enabled = True
+        PUBLISHER.on_subscribers = self.send_subscribers
+        SHARED_CACHES.on_invalidate = self.send_invalidate
+        while True:
+            try:
+                reader, self.writer = await open_unix_connection(path)
+                self.send_subscribers(len(PUBLISHER.subscribers))
+                # Invalidations sent while disconnected were missed.
+                SHARED_CACHES.clear()
+
+                while True:
+                    message = await read_frame(reader)
+                    if message["type"] == "sample":
+                        update_status(self.read_peers(message), message["now"])
+                        PUBLISHER.send_all()
+                    elif message["type"] == "history":
+                        future = self.pending.get(message["id"])
+                        if future is not None and not future.done():
+                            future.set_result(message)
+                    elif message["type"] == "invalidate":
+                        SHARED_CACHES.receive(message["cache"], message["key"])
+                    elif message["type"] == "metrics":
+                        # Values shared by all processes come from the poller.
+                        self.writer.write(encode_frame({
+                            "type": "metrics",
+                            "id": message["id"],
+                            "metrics": snapshot(shared=False),
+                        }))
+            except CancelledError:
+                if self.table is not None:
+                    self.table.close()
+                return
+            except (OSError, IncompleteReadError, ValueError) as error:
+                logger.warning(f"Status channel disconnected: {error}")
+            finally:
+                if self.writer is not None:
+                    self.writer.close()
+                self.writer = None
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Status channel closed"))
+
+            await asleep(RECONNECT_DELAY)
+
+
+CLIENT = ChannelClient()
+
+
+async def query_history(start: int, end: int) -> tuple[int, dict[str, Any]]:
+    """Query the history of this process, or of the poller in worker mode.
+
+    Raises ConnectionError or asyncio.TimeoutError if the poller does not
+    answer.
+    """
+    if CLIENT.enabled:
+        return await CLIENT.query_history(start, end)
+    return await get_event_loop().run_in_executor(None, HISTORY.query, start, end)
@@ -0,0 +1,68 @@
+from struct import Struct
+
+# Compact binary encoding of the status stream, negotiated with the
+# `wsm.status.binary` websocket subprotocol. Every frame starts with HEADER
+# (frame type, seq) and numbers are little endian.
+#
+# FULL frame, sent on subscribe, on resync and whenever peers come or go:
+#     count u32, count public keys of 44 bytes (the index table),
+#     count VALUE records in the order of the index table.
+# DELTA frame, sent while the set of peers stays the same:
+#     count u32, count DELTA_VALUE records (index first).
+PROTOCOL = "wsm.status.binary"
+
+FULL = 1
+DELTA = 2
+
+HEADER = Struct("<BI")
+COUNT = Struct("<I")
+KEY_SIZE = 44
+# latest handshake, rx bytes, tx bytes, rx rate, tx rate
+VALUE = Struct("<IQQII")
+DELTA_VALUE = Struct("<IIQQII")
+
+U32_MAX = 0xFFFFFFFF
+
+# Same layout as wireguard_status.PeerValue.
+PeerValue = tuple[int, int, int, int, int]
+
+
+def encode_full(seq: int, snapshot: dict[str, PeerValue]) -> bytes:
+    result = [HEADER.pack(FULL, seq), COUNT.pack(len(snapshot))]
+    result.extend(
+        key.encode().ljust(KEY_SIZE, b"\0")[:KEY_SIZE]
+        for key in snapshot
+    )
+    result.extend(
+        VALUE.pack(
+            handshake,
+            rx_bytes,
+            tx_bytes,
+            min(rx_rate, U32_MAX),
+            min(tx_rate, U32_MAX)
+        )
+        for handshake, rx_bytes, tx_bytes, rx_rate, tx_rate in snapshot.values()
+    )
+    return b"".join(result)
+
+
+def encode_delta(
+    seq: int,
+    key_index: dict[str, int],
+    changed: dict[str, PeerValue]
+) -> bytes:
+    """Encode `changed` with the indexes of the last FULL frame, the set of
+    peers must not have changed since."""
+    result = [HEADER.pack(DELTA, seq), COUNT.pack(len(changed))]
+    result.extend(
+        DELTA_VALUE.pack(
+            key_index[key],
+            handshake,
+            rx_bytes,
+            tx_bytes,
+            min(rx_rate, U32_MAX),
+            min(tx_rate, U32_MAX)
+        )
+        for key, (handshake, rx_bytes, tx_bytes, rx_rate, tx_rate) in changed.items()
+    )
+    return b"".join(result)
@@ -0,0 +1,182 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from argparse import ArgumentParser
+from logging import getLogger
+from struct import Struct
+from time import time
+from typing import Optional
+
+from wireguard import PeerStatus
+
+# seq, keys version, capacity, count. The seq is odd while a write is in
+# progress, readers retry until they see the same even seq before and after
+# their copy.
+HEADER = Struct("<QQII")
+KEY_SIZE = 44
+# handshake, rx, tx, endpoint of the peer whose key has the same index.
+RECORD = Struct("<QQQ48s")
+MAX_READ_RETRIES = 10000
+
+logger = getLogger("status_table")
+
+
+class StatusTable():
+    """Peer status in a shared memory segment, written by the poller and
+    read by any process on the host.
+
+    Public keys live in a sidecar area which is only rewritten when the set
+    of peers changes, records are fixed width and indexed like the keys. A
+    snapshot is a single copy of the used part of the segment.
+    """
+
+    def __init__(self, shm: SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.capacity = HEADER.unpack_from(shm.buf)[2]
+        self.records_offset = HEADER.size + self.capacity * KEY_SIZE
+        # Writer: keys currently in the sidecar. Reader: decoded keys cache.
+        self.keys: list[str] = []
+        self.keys_version = 0
+        # Writer: whether the last write had more peers than fit.
+        self.overflowed = False
+
+    @classmethod
+    def create(cls, name: str, capacity: int) -> "StatusTable":
+        size = HEADER.size + capacity * (KEY_SIZE + RECORD.size)
+        try:
+            stale = SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+        shm = SharedMemory(name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, 0, 0, capacity, 0)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name: str) -> "StatusTable":
+        shm = SharedMemory(name)
+        # Only the creator may unlink the segment when it exits.
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return cls(shm, False)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def write(self, peers: list[PeerStatus]):
+        if len(peers) > self.capacity:
+            if not self.overflowed:
+                logger.warning(
+                    f"{len(peers)} peers do not fit the status table of {self.capacity}, "
+                    f"the rest is left out. Raise status_config.shared_memory_capacity."
+                )
+            self.overflowed = True
+            peers = peers[:self.capacity]
+        else:
+            self.overflowed = False
+        buf = self.shm.buf
+        seq, keys_version, capacity, _ = HEADER.unpack_from(buf)
+
+        # Pack everything first, so the seq stays odd only for the copies.
+        keys = [peer.public_key for peer in peers]
+        keys_data = None
+        if keys != self.keys:
+            self.keys = keys
+            keys_version += 1
+            keys_data = b"".join([
+                key.encode().ljust(KEY_SIZE, b"\0")[:KEY_SIZE] for key in keys
+            ])
+        records_data = b"".join([
+            RECORD.pack(
+                peer.latest_handshake,
+                peer.rx_bytes,
+                peer.tx_bytes,
+                (peer.endpoint or "").encode()
+            )
+            for peer in peers
+        ])
+
+        HEADER.pack_into(buf, 0, seq + 1, keys_version, capacity, len(peers))
+        if keys_data is not None:
+            buf[HEADER.size:HEADER.size + len(keys_data)] = keys_data
+        buf[self.records_offset:self.records_offset + len(records_data)] = records_data
+        HEADER.pack_into(buf, 0, seq + 2, keys_version, capacity, len(peers))
+
+    def snapshot(self, keys_version: int = -1) -> tuple[int, Optional[bytes], bytes]:
+        """Copy a consistent (keys version, keys, records) snapshot.
+
+        The keys are only copied if their version differs from
+        `keys_version`, otherwise they are None.
+        """
+        buf = self.shm.buf
+        for _ in range(MAX_READ_RETRIES):
+            seq, current_version, _, count = HEADER.unpack_from(buf)
+            if seq % 2:
+                continue
+
+            keys = None
+            if current_version != keys_version:
+                keys = bytes(buf[HEADER.size:HEADER.size + count * KEY_SIZE])
+            records = bytes(
+                buf[self.records_offset:self.records_offset + count * RECORD.size]
+            )
+            if HEADER.unpack_from(buf)[0] == seq:
+                return current_version, keys, records
+
+        raise TimeoutError("Status table is busy")
+
+    def read(self) -> list[PeerStatus]:
+        keys_version, keys, records = self.snapshot(self.keys_version)
+        if keys is not None:
+            self.keys = [
+                keys[index:index + KEY_SIZE].rstrip(b"\0").decode()
+                for index in range(0, len(keys), KEY_SIZE)
+            ]
+            self.keys_version = keys_version
+
+        return [
+            PeerStatus(
+                public_key,
+                handshake,
+                rx_bytes,
+                tx_bytes,
+                endpoint.rstrip(b"\0").decode() or None,
+                (),
+            )
+            for public_key, (handshake, rx_bytes, tx_bytes, endpoint) in zip(
+                self.keys, RECORD.iter_unpack(records)
+            )
+        ]
+
+
+def table_name(interface: str) -> str:
+    return f"wsm-status-{interface}"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Print the shared status table")
+    parser.add_argument("interface", nargs="?", default="wg0")
+    args = parser.parse_args()
+
+    table: Optional[StatusTable] = None
+    try:
+        table = StatusTable.attach(table_name(args.interface))
+        now = time()
+        for peer in table.read():
+            age = f"{now - peer.latest_handshake:.0f}s" if peer.latest_handshake else "never"
+            print(
+                f"{peer.public_key}\t{peer.endpoint or '(none)'}\t"
+                f"{age}\t{peer.rx_bytes}\t{peer.tx_bytes}"
+            )
+    except FileNotFoundError:
+        print(f"No status table for {args.interface}, is the server running?")
+    finally:
+        if table is not None:
+            table.close()
@@ -0,0 +1,141 @@
+from mongomock import filtering
+from mongomock_motor import AsyncMongoMockCollection
+from orjson import dumps
+import pytest
+
+from asyncio import sleep as asleep
+from functools import wraps
+from os import environ
+from os.path import abspath, dirname, join
+from sys import path
+from tempfile import mkdtemp
+from typing import Any, Awaitable, Callable, Iterator
+from uuid import uuid4
+
+# The backend modules import each other as top level modules.
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+# Set WSM_TEST_MONGODB_URI to run the database tests against a real mongod
+# instead of mongomock.
+TEST_MONGODB_URI = environ.get("WSM_TEST_MONGODB_URI")
+# Set WSM_BENCHMARK to run the benchmarks as well, their results are
+# printed after the test summary.
+RUN_BENCHMARKS = bool(environ.get("WSM_BENCHMARK"))
+BENCHMARK_RESULTS: list[str] = []
+
+TEST_CONFIG = {
+    "jwt_key": "test-jwt-key",
+    "join_key": "test-join-key",
+    "admin_ids": ["admin"],
+    "wireguard_config": {
+        "subnet": "10.80.0.0/16",
+        "public_key": "d3NtLXRlc3Qtc2VydmVyLXB1YmxpYy1rZXlfX19fX18=",
+        "private_key": "d3NtLXRlc3Qtc2VydmVyLXByaXZhdGUta2V5X19fX18=",
+        "preshared_key": "d3NtLXRlc3QtcHJlc2hhcmVkLWtleV9fX19fX19fX18=",
+    },
+    "status_config": {
+        "history_enabled": False,
+    },
+}
+
+# mongomock knows $type "null" but does not implement it.
+filtering.TYPE_MAP["null"] = lambda value: value is None
+
+
+def yield_first(method: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        await asleep(0)
+        return await method(*args, **kwargs)
+    return wrapper
+
+
+# mongomock_motor runs every operation without giving up the event loop,
+# so concurrent requests could never interleave between two round trips.
+for method_name in (
+    "bulk_write",
+    "count_documents",
+    "delete_many",
+    "delete_one",
+    "find_one",
+    "find_one_and_update",
+    "insert_many",
+    "insert_one",
+    "replace_one",
+    "update_many",
+    "update_one",
+):
+    setattr(
+        AsyncMongoMockCollection,
+        method_name,
+        yield_first(getattr(AsyncMongoMockCollection, method_name))
+    )
+
+
+def with_options(self: AsyncMongoMockCollection, *args, **kwargs) -> AsyncMongoMockCollection:
+    # mongomock_motor hands this to mongomock, which returns a sync collection.
+    return AsyncMongoMockCollection(
+        self.database,
+        self._AsyncMongoMockCollection__collection.with_options(*args, **kwargs)
+    )
+
+
+AsyncMongoMockCollection.with_options = with_options
+
+
+def pytest_configure(config: pytest.Config):
+    import config as wsm_config
+
+    wsm_config.CONFIG_PATH = join(mkdtemp(prefix="wsm-test-"), "config.json")
+    with open(wsm_config.CONFIG_PATH, "wb") as config_file:
+        config_file.write(dumps(TEST_CONFIG))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if BENCHMARK_RESULTS:
+        terminalreporter.section("benchmarks")
+        for line in BENCHMARK_RESULTS:
+            terminalreporter.write_line(line)
+
+
+@pytest.fixture
+def benchmark() -> Callable[[str], None]:
+    """Skip the test unless benchmarks are enabled, call it with a line of
+    results."""
+    if not RUN_BENCHMARKS:
+        pytest.skip("set WSM_BENCHMARK=1 to run the benchmarks")
+    return BENCHMARK_RESULTS.append
+
+
+@pytest.fixture
+def database() -> Iterator[Callable[[], Awaitable[Any]]]:
+    """Initialize beanie on an empty database, call it inside the event
+    loop of the test."""
+    name = f"wsm_test_{uuid4().hex}"
+
+    async def init():
+        from beanie import init_beanie
+        from scheams.allocator import IPAllocator
+        from scheams.connection_info import ConnectionInfo
+        from scheams.user import UserData
+
+        if TEST_MONGODB_URI:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            client = AsyncIOMotorClient(TEST_MONGODB_URI)
+        else:
+            from mongomock_motor import AsyncMongoMockClient
+            client = AsyncMongoMockClient()
+
+        db = client[name]
+        await init_beanie(
+            database=db,
+            document_models=[ConnectionInfo, IPAllocator, UserData]
+        )
+        return db
+
+    yield init
+
+    if TEST_MONGODB_URI:
+        from pymongo import MongoClient
+        with MongoClient(TEST_MONGODB_URI) as client:
+            client.drop_database(name)
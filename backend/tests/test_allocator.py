@@ -0,0 +1,46 @@
+import pytest
+
+from asyncio import run
+from os import cpu_count, environ
+from time import perf_counter
+from typing import Optional
+
+# mongomock checks the unique index by scanning the collection on every
+# insert, so the inserts only scale against a real mongod.
+CONNECTIONS = 20000 if environ.get("WSM_TEST_MONGODB_URI") else 2000
+
+
+@pytest.mark.parametrize("workers", [1, 4, None])
+def test_provision_connections_speed(database, benchmark, workers: Optional[int]):
+    pytest.importorskip("pywgkey")
+    from allocator import provision_connections
+    from scheams.connection_info import ConnectionInfo
+    from wireguard.keys import iter_keypairs
+
+    count = CONNECTIONS
+
+    async def main():
+        await database()
+
+        start = perf_counter()
+        generated = 0
+        async for keypairs in iter_keypairs(count, workers):
+            generated += len(keypairs)
+        keys_only = perf_counter() - start
+        assert generated == count
+
+        start = perf_counter()
+        async for _ in provision_connections(0, [None] * count, workers):
+            pass
+        provisioned = perf_counter() - start
+
+        public_keys = await ConnectionInfo.get_motor_collection().distinct("public_key")
+        assert len(public_keys) == count
+
+        benchmark(
+            f"{count} keys on {workers or cpu_count()} cores: "
+            f"{count / keys_only:.0f} keys/s generated, "
+            f"{count / provisioned:.0f} connections/s provisioned"
+        )
+
+    run(main())
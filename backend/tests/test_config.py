@@ -0,0 +1,111 @@
+import pytest
+from orjson import dumps, loads
+
+import subprocess
+import sys
+from os.path import dirname
+from pathlib import Path
+from typing import Iterator
+
+import config
+from conftest import TEST_CONFIG
+
+
+@pytest.fixture
+def config_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    """Point the loader at a file of its own, with nothing cached."""
+    path = tmp_path / "config.json"
+    monkeypatch.setattr(config, "CONFIG_PATH", str(path))
+    config.load_config.cache_clear()
+    config.settings.cache_clear()
+    yield path
+    config.load_config.cache_clear()
+    config.settings.cache_clear()
+
+
+def test_missing_file_exits(config_path: Path, capsys: pytest.CaptureFixture):
+    with pytest.raises(SystemExit) as error:
+        config.load_config()
+
+    assert error.value.code == 0
+    assert "please run `python3 setup.py` first" in capsys.readouterr().out
+
+
+def test_broken_json_exits_with_a_message(config_path: Path, capsys: pytest.CaptureFixture):
+    config_path.write_text('{"port": 8080,')
+
+    with pytest.raises(SystemExit) as error:
+        config.load_config()
+
+    assert error.value.code == 1
+    assert f"Config file {config_path} is not valid JSON" in capsys.readouterr().out
+
+
+def test_invalid_values_exit_with_a_message(config_path: Path, capsys: pytest.CaptureFixture):
+    config_path.write_bytes(dumps({**TEST_CONFIG, "port": "not a port"}))
+
+    with pytest.raises(SystemExit) as error:
+        config.load_config()
+
+    assert error.value.code == 1
+    out = capsys.readouterr().out
+    assert f"Config file {config_path} is invalid" in out
+    assert "port" in out
+
+
+def test_partial_file_is_backfilled_and_rewritten(config_path: Path):
+    config_path.write_bytes(dumps(TEST_CONFIG))
+
+    loaded = config.load_config()
+
+    written = loads(config_path.read_bytes())
+    assert written == loaded.model_dump()
+    assert written["jwt_key"] == TEST_CONFIG["jwt_key"]
+    assert written["status_config"]["queue_size"] == 8
+    assert written["wireguard_config"]["interface_name"] == "wg0"
+
+
+def test_complete_file_is_not_rewritten(config_path: Path):
+    config_path.write_bytes(dumps(TEST_CONFIG))
+    complete = dumps(config.load_config().model_dump())
+    # Compact, unlike the indented file the loader writes.
+    config_path.write_bytes(complete)
+    config.load_config.cache_clear()
+
+    config.load_config()
+
+    assert config_path.read_bytes() == complete
+
+
+def test_settings_are_module_attributes(config_path: Path):
+    config_path.write_bytes(dumps(TEST_CONFIG))
+
+    assert config.JOIN_KEY == TEST_CONFIG["join_key"]
+    assert str(config.WIREGUARD_SUBNET) == TEST_CONFIG["wireguard_config"]["subnet"]
+    with pytest.raises(AttributeError):
+        config.NOT_A_SETTING
+    with pytest.raises(AttributeError):
+        config.join_key
+
+
+def test_import_time(benchmark):
+    """`-X importtime` of config and of main, which must not load the API
+    stack of a worker it does not run."""
+    results = []
+    for module in ("config", "main"):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=dirname(config.CONFIG_PATH),
+            env={"PYTHONPATH": dirname(dirname(__file__))},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times = {}
+        for line in process.stderr.splitlines()[1:]:
+            _, cumulative, name = line.split("|")
+            times[name.strip()] = int(cumulative.split(":")[-1])
+        assert "fastapi" not in times
+        results.append(f"{module} {times[module] / 1000:.1f} ms")
+
+    benchmark(f"import time: {', '.join(results)}")
@@ -0,0 +1,182 @@
+import pytest
+from orjson import loads
+
+from asyncio import run
+from io import BytesIO
+from typing import Iterator
+from zipfile import ZipFile
+
+from cache import SHARED_CACHES
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch: pytest.MonkeyPatch) -> Iterator[list[tuple]]:
+    """Invalidations which would be sent to the other workers."""
+    sent: list[tuple] = []
+    monkeypatch.setattr(SHARED_CACHES, "on_invalidate", lambda *args: sent.append(args))
+    SHARED_CACHES.clear()
+    yield sent
+    SHARED_CACHES.clear()
+
+
+async def add_users(user_ids: list[int]):
+    """Users named after their id, every one with its own connection."""
+    from allocator import offset_to_ip
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+
+    for user_id in user_ids:
+        connection = await ConnectionInfo(
+            private_key=f"private-{user_id}",
+            public_key=f"public-{user_id}",
+            ip_address=offset_to_ip(user_id),
+            discord_user_id=str(user_id),
+        ).insert()
+        await UserData(
+            discord_id=str(user_id),
+            username=f"user{user_id}",
+            refresh_token=f"refresh-{user_id}",
+            connection=connection,
+        ).insert()
+
+
+def test_user_list_pages_follow_the_cursor(database):
+    from routers.connection import get_users
+
+    async def main():
+        await database()
+        await add_users(list(range(1, 6)))
+
+        pages, cursor = [], None
+        while True:
+            response = await get_users(cursor=cursor, limit=2)
+            assert response.status_code == 200
+            pages.append([user["discord_id"] for user in loads(response.body)])
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+
+        assert pages == [["1", "2"], ["3", "4"], ["5"]]
+        user = loads((await get_users(cursor="4", limit=2)).body)[0]
+        assert user["display_name"] == "user5"
+        assert user["connection"]["public_key"] == "public-5"
+        # Tokens never leave the database.
+        assert "refresh_token" not in user and "access_token" not in user
+
+    run(main())
+
+
+def test_user_list_etag(database):
+    from cache import USER_LIST_CACHE
+    from routers.connection import get_users
+
+    async def main():
+        await database()
+        await add_users([1, 2])
+
+        response = await get_users(limit=10)
+        etag = response.headers["ETag"]
+
+        not_modified = await get_users(limit=10, if_none_match=f'"other", {etag}')
+        assert not_modified.status_code == 304
+        assert not_modified.headers["ETag"] == etag
+        assert not_modified.body == b""
+        assert (await get_users(limit=10, if_none_match='"other"')).status_code == 200
+
+        # The page is cached until a join invalidates it.
+        await add_users([3])
+        assert (await get_users(limit=10, if_none_match=etag)).status_code == 304
+        USER_LIST_CACHE.invalidate()
+        response = await get_users(limit=10, if_none_match=etag)
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert len(loads(response.body)) == 3
+
+    run(main())
+
+
+def test_client_conf_is_cached_until_invalidated(database, caches: list[tuple]):
+    from cache import CLIENT_CONF_CACHE
+    from routers.connection import get_connection_string
+    from scheams.connection_info import ConnectionInfo
+    from scheams.jwt import JWTPayload
+
+    async def main():
+        await database()
+        await add_users([1])
+        user = JWTPayload(discord_id="1", username="user1")
+
+        client_conf = await get_connection_string(user)
+        assert "PrivateKey = private-1" in client_conf
+        await ConnectionInfo.find_one(ConnectionInfo.discord_user_id == "1").set(
+            {ConnectionInfo.private_key: "private-new"}
+        )
+        assert await get_connection_string(user) == client_conf
+
+        CLIENT_CONF_CACHE.invalidate("1")
+        assert caches == [("client_conf", "1")]
+        assert "PrivateKey = private-new" in await get_connection_string(user)
+
+    run(main())
+
+
+def test_export_streams_every_assigned_client_conf(database):
+    from allocator import offset_to_ip
+    from routers.connection import export_connections
+    from scheams.connection_info import ConnectionInfo
+
+    async def main():
+        await database()
+        await add_users([1, 2, 3])
+        # Free connections are not exported.
+        await ConnectionInfo(private_key="free", public_key="free", ip_address=offset_to_ip(9)).insert()
+
+        response = await export_connections()
+        chunks = [chunk async for chunk in response.body_iterator]
+        assert response.media_type == "application/zip"
+        # Written out connection by connection, not at the end.
+        assert len([chunk for chunk in chunks if chunk]) > 1
+
+        client_confs = {
+            f"{connection.ip_address}.conf": connection.to_client_conf()
+            async for connection in ConnectionInfo.find(ConnectionInfo.discord_user_id != None)
+        }
+        with ZipFile(BytesIO(b"".join(chunks))) as zip_file:
+            assert zip_file.testzip() is None
+            assert sorted(zip_file.namelist()) == sorted(client_confs)
+            for name, client_conf in client_confs.items():
+                assert zip_file.read(name).decode() == client_conf
+
+    run(main())
+
+
+def test_user_list_reads_with_the_list_read_preference(database, monkeypatch: pytest.MonkeyPatch):
+    from pymongo import ReadPreference
+
+    from database import database as wsm_database
+    from routers import connection
+    from routers.connection import get_users
+
+    # The default, a cached page must not come from a lagging secondary.
+    assert wsm_database.LIST_READ_PREFERENCE == ReadPreference.PRIMARY
+
+    monkeypatch.setattr(wsm_database, "LIST_READ_PREFERENCE", ReadPreference.SECONDARY_PREFERRED)
+    used = []
+
+    def read_collection(model):
+        collection = wsm_database.read_collection(model)
+        used.append((model.__name__, collection.read_preference))
+        return collection
+
+    monkeypatch.setattr(connection, "read_collection", read_collection)
+
+    async def main():
+        await database()
+        await add_users([1])
+        assert len(loads((await get_users(limit=10)).body)) == 1
+
+    run(main())
+    assert used == [
+        ("UserData", ReadPreference.SECONDARY_PREFERRED),
+        ("ConnectionInfo", ReadPreference.SECONDARY_PREFERRED),
+    ]
@@ -0,0 +1,117 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from asyncio import gather, run
+from time import monotonic
+from typing import Awaitable, Callable
+
+from discord_api import DiscordClient, TokenBucket
+
+
+class StubDiscord():
+    """Answers `users/@me` with one request per token every `reset_after`
+    seconds, and `rate-limited` with a 429 on the first try."""
+
+    def __init__(self, reset_after: float = 0.3):
+        self.reset_after = reset_after
+        self.peers: set = set()
+        self.requests: list[str] = []
+        self.limited = False
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/users/@me", self.me)
+        app.router.add_get("/api/rate-limited", self.rate_limited)
+        return app
+
+    async def me(self, request: web.Request) -> web.Response:
+        self.peers.add(request.transport.get_extra_info("peername"))
+        self.requests.append(request.headers["Authorization"])
+        return web.json_response({"id": request.headers["Authorization"]}, headers={
+            "X-RateLimit-Limit": "1",
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset-After": str(self.reset_after),
+        })
+
+    async def rate_limited(self, request: web.Request) -> web.Response:
+        if not self.limited:
+            self.limited = True
+            return web.json_response({"retry_after": 0.2, "global": False}, status=429)
+        return web.json_response({"ok": True})
+
+
+def with_client(test: Callable[[DiscordClient, StubDiscord], Awaitable[None]]):
+    async def main():
+        stub = StubDiscord()
+        async with TestServer(stub.app()) as server:
+            client = DiscordClient(str(server.make_url("/api")))
+            try:
+                await test(client, stub)
+            finally:
+                await client.close()
+
+    run(main())
+
+
+def me(client: DiscordClient, token: str):
+    return client.request("GET", "users/@me", headers={"Authorization": f"Bearer {token}"})
+
+
+def test_requests_share_one_connection():
+    async def test(client: DiscordClient, stub: StubDiscord):
+        for token in ("a", "b", "c"):
+            assert await me(client, token) == (200, {"id": f"Bearer {token}"})
+        assert len(stub.peers) == 1
+
+    with_client(test)
+
+
+def test_tokens_have_their_own_buckets():
+    async def test(client: DiscordClient, stub: StubDiscord):
+        await me(client, "a")
+
+        start = monotonic()
+        await me(client, "b")
+        assert monotonic() - start < stub.reset_after / 2
+
+        await me(client, "a")
+        assert monotonic() - start >= stub.reset_after * 0.9
+
+    with_client(test)
+
+
+def test_parallel_requests_of_one_token_queue_up():
+    async def test(client: DiscordClient, stub: StubDiscord):
+        await me(client, "a")
+
+        start = monotonic()
+        results = await gather(me(client, "a"), me(client, "a"))
+        assert [status for status, _ in results] == [200, 200]
+        assert monotonic() - start >= stub.reset_after * 0.9
+
+    with_client(test)
+
+
+def test_retries_after_429():
+    async def test(client: DiscordClient, stub: StubDiscord):
+        start = monotonic()
+        assert await client.request("GET", "rate-limited") == (200, {"ok": True})
+        assert monotonic() - start >= 0.2
+
+    with_client(test)
+
+
+def test_bucket_keeps_reset_after_of_the_server():
+    bucket = TokenBucket(50)
+    bucket.update({
+        "X-RateLimit-Limit": "5",
+        "X-RateLimit-Remaining": "0",
+        "X-RateLimit-Reset-After": "60",
+    })
+    assert bucket.reset_at - monotonic() > 59
+
+    # The window passed, the next one is as long as the server's.
+    bucket.reset_at = monotonic()
+    run(bucket.acquire())
+    assert bucket.remaining == 4
+    assert bucket.reset_at - monotonic() > 59
@@ -0,0 +1,140 @@
+import pytest
+
+from array import array
+from asyncio import get_event_loop, run, sleep as asleep
+from time import perf_counter
+from types import SimpleNamespace
+
+from history import HistoryStore, TIERS
+
+# The start of a day, so every tier starts a bucket here.
+T0 = 1700006400
+
+
+def sample(store: HistoryStore, now: float, transferred: dict[str, int]):
+    """Record every peer of `transferred` with its total received bytes,
+    all of them online."""
+    store.record({
+        key: SimpleNamespace(latest_handshake=now, rx_bytes=rx, tx_bytes=rx // 2)
+        for key, rx in transferred.items()
+    }, now)
+
+
+def test_query_adds_up_the_samples():
+    store = HistoryStore(4)
+    for second in range(11):
+        sample(store, T0 + second, {"a": 1000 * second, "b": 10 * second * second})
+
+    resolution, peers = store.query(T0, T0 + 10)
+
+    assert resolution == 1
+    assert peers["a"] == {
+        "online_minutes": 10 / 60,
+        "rx_bytes": 10000,
+        "tx_bytes": 5000,
+        "p95_throughput": 1500,
+    }
+    assert peers["b"]["rx_bytes"] == 1000
+    # 190 bytes received and 95 sent in the last second.
+    assert peers["b"]["p95_throughput"] == 285
+
+
+def test_query_uses_the_finest_tier_covering_the_start():
+    store = HistoryStore(1)
+    now = T0 + 2 * 86400
+    sample(store, now, {"a": 0})
+
+    (seconds, seconds_length), (minutes, minutes_length), (hours, _) = TIERS
+    assert store.query(now - seconds * seconds_length, now)[0] == seconds
+    assert store.query(now - seconds * seconds_length - 1, now)[0] == minutes
+    assert store.query(now - minutes * minutes_length, now)[0] == minutes
+    assert store.query(now - minutes * minutes_length - 1, now)[0] == hours
+    assert store.query(0, now)[0] == hours
+
+
+def test_new_peer_reuses_the_slot_seen_least_recently():
+    store = HistoryStore(2)
+    sample(store, T0, {"a": 0, "b": 0})
+    sample(store, T0 + 1, {"a": 100, "b": 100})
+    sample(store, T0 + 2, {"a": 200})
+    b_slot = store.slots["b"]
+
+    sample(store, T0 + 3, {"a": 300, "c": 5000})
+
+    assert store.slots == {"a": 1 - b_slot, "c": b_slot}
+    _, peers = store.query(T0, T0 + 3)
+    assert peers["a"]["rx_bytes"] == 300
+    # The slot starts over, nothing of b and no jump of c's counter.
+    assert peers["c"]["rx_bytes"] == 0
+    assert peers["c"]["online_minutes"] == 1 / 60
+
+    # Every slot is taken by a peer of this sample, d is left out.
+    sample(store, T0 + 4, {"a": 400, "c": 5100, "d": 0})
+    assert set(store.slots) == {"a", "c"}
+    assert store.dropped == 1
+
+
+def test_snapshot_survives_a_restart(tmp_path):
+    path = str(tmp_path / "history.bin")
+    store = HistoryStore(4)
+    for second in range(5):
+        sample(store, T0 + second, {"a": 100 * second, "b": second})
+    store.save(path)
+
+    loaded = HistoryStore(4)
+    loaded.load(path)
+
+    assert loaded.keys == store.keys
+    assert loaded.last_sample == store.last_sample
+    assert loaded.query(T0, T0 + 4) == store.query(T0, T0 + 4)
+    # Counters continue from the snapshot.
+    sample(loaded, T0 + 5, {"a": 500, "b": 5})
+    assert loaded.query(T0, T0 + 5)[1]["a"]["rx_bytes"] == 500
+
+
+def test_snapshot_of_more_peers_is_ignored(tmp_path):
+    path = str(tmp_path / "history.bin")
+    store = HistoryStore(4)
+    sample(store, T0, {"a": 0, "b": 0, "c": 0})
+    store.save(path)
+
+    loaded = HistoryStore(2)
+    loaded.load(path)
+
+    assert loaded.keys == []
+    assert loaded.query(T0, T0)[1] == {}
+
+
+@pytest.mark.parametrize("tier", [0, 1])
+def test_query_of_a_full_store(benchmark, tier: int):
+    peers = 5000
+    store = HistoryStore(peers)
+    for peer in range(peers):
+        store.slot(str(peer), T0)
+    # Every bucket sampled, without recording them one by one.
+    resolution, length = TIERS[tier]
+    history = store.tiers[tier]
+    history.buckets = array("q", range(T0 // resolution, T0 // resolution + length))
+    history.seconds = array("I", [resolution]) * length
+    history.rx = array("Q", range(peers * length))
+    history.tx = array("Q", range(peers * length))
+    store.last_sample = T0 + (length - 1) * resolution
+
+    async def main() -> tuple[float, float]:
+        """Run the query like the API does, and the longest the event loop
+        was stuck meanwhile."""
+        start = perf_counter()
+        query = get_event_loop().run_in_executor(None, store.query, T0, store.last_sample)
+        lag = 0.0
+        while not query.done():
+            tick = perf_counter()
+            await asleep(0.01)
+            lag = max(lag, perf_counter() - tick - 0.01)
+        assert len((await query)[1]) == peers
+        return perf_counter() - start, lag
+
+    elapsed, lag = run(main())
+    benchmark(
+        f"history query of {peers} peers over {length} buckets of {resolution} s: "
+        f"{elapsed * 1000:.0f} ms, event loop lag at most {lag * 1000:.1f} ms"
+    )
@@ -0,0 +1,183 @@
+import pytest
+
+from asyncio import gather, run, sleep as asleep
+from os import environ
+from time import perf_counter
+from typing import Any
+
+from config import JOIN_KEY
+
+# mongomock scans the whole collection for every query, so it only gets a
+# smaller burst. The latencies are only meaningful against a real mongod.
+JOINS = 1000 if environ.get("WSM_TEST_MONGODB_URI") else 200
+# Far above the p99 of either, only joins that queue up behind each other
+# get near it.
+JOIN_P99_SECONDS = 5
+
+
+def p99(durations: list[float]) -> float:
+    durations = sorted(durations)
+    return durations[min(int(len(durations) * 0.99), len(durations) - 1)]
+
+
+async def add_free_connections(count: int):
+    from allocator import offset_to_ip
+    from scheams.connection_info import ConnectionInfo
+
+    await ConnectionInfo.insert_many([
+        ConnectionInfo(
+            private_key=f"private-{offset}",
+            public_key=f"public-{offset}",
+            ip_address=offset_to_ip(offset),
+        )
+        for offset in range(count)
+    ])
+
+
+class FakeDiscord():
+    """Answers the two calls of a login, a code `code-N` belongs to the
+    Discord user `N`. Every call yields to the event loop like a real
+    request would."""
+
+    async def request(self, method: str, route: str, **kwargs) -> tuple[int, Any]:
+        await asleep(0)
+        if route == "oauth2/token":
+            code = kwargs["data"].get("code") or kwargs["data"]["refresh_token"]
+            user_id = code.split("-", 1)[1]
+            return 200, {
+                "access_token": f"access-{user_id}",
+                "token_type": "Bearer",
+                "expires_in": 604800,
+                "refresh_token": f"refresh-{user_id}",
+                "scope": "identify",
+            }
+        if route == "users/@me":
+            user_id = kwargs["headers"]["Authorization"].split("-", 1)[1]
+            return 200, {"id": user_id, "username": f"user{user_id}"}
+        return 404, None
+
+
+@pytest.fixture
+def discord(monkeypatch: pytest.MonkeyPatch) -> FakeDiscord:
+    from routers import oauth
+
+    fake = FakeDiscord()
+
+    async def add_peers(connections: list):
+        pass
+
+    monkeypatch.setattr(oauth.DISCORD, "request", fake.request)
+    monkeypatch.setattr(oauth, "add_peers", add_peers)
+    return fake
+
+
+def test_parallel_claims_are_unique(database):
+    from allocator import claim_connection
+    from scheams.connection_info import ConnectionInfo
+
+    async def main():
+        await database()
+        await add_free_connections(JOINS)
+
+        connections = await gather(*[
+            claim_connection(str(user_id)) for user_id in range(JOINS)
+        ])
+
+        assert all(connection is not None for connection in connections)
+        assert len({connection.id for connection in connections}) == JOINS
+        assert len({connection.ip_address for connection in connections}) == JOINS
+        assert [connection.discord_user_id for connection in connections] == \
+            [str(user_id) for user_id in range(JOINS)]
+        assert await ConnectionInfo.find(ConnectionInfo.discord_user_id == None).count() == 0
+
+    run(main())
+
+
+def test_parallel_joins_get_distinct_connections(database, discord: FakeDiscord):
+    from routers.oauth import valid_code
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+
+    async def join(user_id: int) -> float:
+        start = perf_counter()
+        await valid_code(code=f"code-{user_id}", join_key=JOIN_KEY)
+        return perf_counter() - start
+
+    async def main():
+        await database()
+        await add_free_connections(JOINS)
+
+        durations = await gather(*[join(user_id) for user_id in range(JOINS)])
+        assert p99(durations) < JOIN_P99_SECONDS
+
+        users = await UserData.find_all().to_list()
+        assert len(users) == JOINS
+        connection_ids = {user.connection.ref.id for user in users}
+        assert len(connection_ids) == JOINS
+
+        owners = {
+            connection.id: connection.discord_user_id
+            async for connection in ConnectionInfo.find_all()
+        }
+        for user in users:
+            assert owners[user.connection.ref.id] == user.discord_id
+
+    run(main())
+
+
+def test_concurrent_joins_of_one_user(database, discord: FakeDiscord):
+    from routers.oauth import valid_code
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+
+    async def main():
+        await database()
+        await add_free_connections(10)
+
+        users = await gather(*[
+            valid_code(code="code-42", join_key=JOIN_KEY) for _ in range(10)
+        ])
+
+        assert {user.discord_id for user in users} == {"42"}
+        assert await UserData.find_all().count() == 1
+        # The connections claimed by the losing requests are free again.
+        assert await ConnectionInfo.find(ConnectionInfo.discord_user_id == "42").count() == 1
+        assert await ConnectionInfo.find(ConnectionInfo.discord_user_id == None).count() == 9
+
+    run(main())
+
+
+def test_join_needs_join_key(database, discord: FakeDiscord):
+    from fastapi import HTTPException
+    from routers.oauth import valid_code
+    from scheams.connection_info import ConnectionInfo
+
+    async def main():
+        await database()
+        await add_free_connections(1)
+
+        with pytest.raises(HTTPException) as error:
+            await valid_code(code="code-1", join_key="wrong")
+        assert error.value.status_code == 403
+        assert await ConnectionInfo.find(ConnectionInfo.discord_user_id == None).count() == 1
+
+    run(main())
+
+
+def test_joins_allocate_when_no_connection_is_free(database, discord: FakeDiscord):
+    pytest.importorskip("pywgkey")
+    from routers.oauth import valid_code
+    from scheams.connection_info import ConnectionInfo
+
+    async def main():
+        await database()
+
+        await gather(*[
+            valid_code(code=f"code-{user_id}", join_key=JOIN_KEY)
+            for user_id in range(100)
+        ])
+
+        ips = [connection.ip_address async for connection in ConnectionInfo.find_all()]
+        assert len(ips) == len(set(ips)) == 100
+
+    run(main())
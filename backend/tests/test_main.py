@@ -0,0 +1,66 @@
+import pytest
+
+from asyncio import create_task, run, sleep as asleep
+from subprocess import Popen
+from sys import executable
+from typing import Callable
+
+import main
+from main import supervise_workers
+
+
+def spawner(code: str) -> tuple[list[Popen], Callable[[], Popen]]:
+    spawned: list[Popen] = []
+
+    def spawn() -> Popen:
+        spawned.append(Popen([executable, "-c", code]))
+        return spawned[-1]
+
+    return spawned, spawn
+
+
+def supervise_for(seconds: float, workers: list[Popen], spawn: Callable[[], Popen]):
+    async def run_supervisor():
+        supervisor = create_task(supervise_workers(workers, spawn))
+        await asleep(seconds)
+        supervisor.cancel()
+
+    run(run_supervisor())
+
+
+@pytest.fixture(autouse=True)
+def fast_checks(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "WORKER_CHECK_INTERVAL", 0.05)
+    monkeypatch.setattr(main, "WORKER_RESTART_DELAY", 0.3)
+
+
+def test_exited_worker_is_restarted(caplog: pytest.LogCaptureFixture):
+    spawned, spawn = spawner("import time; time.sleep(60)")
+    workers = [spawn(), spawn()]
+    crashed = workers[0]
+    crashed.kill()
+    crashed.wait()
+    try:
+        supervise_for(0.5, workers, spawn)
+
+        assert len(spawned) == 3
+        assert workers[0] is spawned[2] and workers[0].poll() is None
+        assert workers[1] is spawned[1]
+        assert f"API worker {crashed.pid} exited with -9" in caplog.text
+    finally:
+        for worker in spawned:
+            worker.kill()
+            worker.wait()
+
+
+def test_crashing_worker_does_not_spin():
+    spawned, spawn = spawner("exit(3)")
+    workers = [spawn()]
+    try:
+        supervise_for(1, workers, spawn)
+
+        # Started at 0 s, restarted at about 0.3, 0.6 and 0.9 s.
+        assert 3 <= len(spawned) <= 5
+    finally:
+        for worker in spawned:
+            worker.wait()
@@ -0,0 +1,132 @@
+from asyncio import create_task, open_connection, run, sleep as asleep
+from time import perf_counter
+
+from metrics import Counter, serve_metrics
+
+REQUESTS = Counter("wsm_test_requests_total", "Requests of the metrics tests.", ("kind",))
+
+
+async def get(port: int, target: str, method: str = "GET") -> tuple[bytes, bytes]:
+    reader, writer = await open_connection("127.0.0.1", port)
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return head.split(b"\r\n", 1)[0], body
+
+
+def test_metrics_are_served_on_their_own_listener():
+    REQUESTS.inc(("scrape",))
+
+    async def main():
+        server = await serve_metrics("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, body = await get(port, "/metrics")
+            assert status == b"HTTP/1.1 200 OK"
+            assert b'wsm_test_requests_total{kind="scrape"} 1' in body
+
+            assert (await get(port, "/"))[0] == b"HTTP/1.1 404 Not Found"
+            assert (await get(port, "/metrics", "POST"))[0] == \
+                b"HTTP/1.1 405 Method Not Allowed"
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    run(main())
+
+
+def test_merge_adds_up_processes():
+    from metrics import Histogram, merge, snapshot
+
+    latency = Histogram("wsm_test_latency_seconds", "Latency of the metrics tests.", buckets=(1, 2))
+    latency.observe(0.5)
+    latency.observe(1.5)
+    worker = snapshot(shared=False)
+    worker["wsm_test_only_in_worker_total"] = {
+        "kind": "counter", "help": "Only in a worker.", "labelnames": [], "rows": [[[], 3]],
+    }
+
+    merged = merge([snapshot(), worker])
+
+    assert merged["wsm_test_latency_seconds"]["values"][()] == ([2, 2, 0], 4.0)
+    assert merged["wsm_test_only_in_worker_total"]["values"][()] == 3
+
+
+def test_poller_collects_worker_metrics(tmp_path, monkeypatch):
+    from metrics import GaugeFunc, render
+    from status_channel import ChannelClient, ChannelServer
+    from wireguard_status import PUBLISHER
+
+    monkeypatch.setattr(PUBLISHER, "on_subscribers", None)
+    GaugeFunc("wsm_test_interface_peers", "Shared by all processes.", lambda: [((), 7)], shared=True)
+    REQUESTS.inc(("collect",))
+
+    async def main():
+        path = str(tmp_path / "status.sock")
+        server = ChannelServer()
+        await server.start(path)
+        client = ChannelClient()
+        channel = create_task(client.run(path))
+        try:
+            while not server.workers:
+                await asleep(0.01)
+
+            # The worker runs in this process too, so its values double.
+            body = render(await server.collect_metrics())
+            assert 'wsm_test_requests_total{kind="collect"} 2' in body
+            assert "wsm_test_interface_peers 7\n" in body
+        finally:
+            channel.cancel()
+            await server.close()
+
+    run(main())
+
+
+def test_metrics_overhead(benchmark):
+    from metrics import MetricsMiddleware
+
+    requests = 100000
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    async def call(handler) -> float:
+        scope = {"type": "http", "method": "GET"}
+        start = perf_counter()
+        for _ in range(requests):
+            await handler(scope, None, send)
+        return (perf_counter() - start) / requests
+
+    # Series of a busy process, e.g. one per peer.
+    series = Counter("wsm_test_series_total", "Series of the metrics benchmark.", ("peer",))
+    for peer in range(1000):
+        series.inc((str(peer),))
+
+    async def main():
+        bare = await call(app)
+        timed = await call(MetricsMiddleware(app))
+
+        server = await serve_metrics("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            start = perf_counter()
+            for _ in range(100):
+                status, body = await get(port, "/metrics")
+            scrape = (perf_counter() - start) / 100
+            assert status == b"HTTP/1.1 200 OK"
+            lines = body.count(b"\n")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        benchmark(
+            f"MetricsMiddleware adds {(timed - bare) * 1e6:.1f} us per request, "
+            f"a scrape of {lines} lines takes {scrape * 1000:.1f} ms"
+        )
+
+    run(main())
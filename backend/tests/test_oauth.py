@@ -0,0 +1,142 @@
+import pytest
+from jwt import encode
+
+from asyncio import gather, run, sleep as asleep
+from time import sleep, time
+from timeit import timeit
+from typing import Any, Iterator
+
+from config import JWT_KEY
+
+
+@pytest.fixture
+def token_cache() -> Iterator[Any]:
+    from routers.oauth import TOKEN_CACHE
+
+    TOKEN_CACHE.clear()
+    yield TOKEN_CACHE
+    TOKEN_CACHE.clear()
+
+
+def token(**claims: Any) -> str:
+    from scheams.jwt import JWTPayload
+
+    return encode(JWTPayload(**claims).model_dump(), key=JWT_KEY)
+
+
+@pytest.mark.parametrize("profile", [
+    {"discord_id": "1", "username": "user"},
+    {"discord_id": "2", "username": "user", "global_name": "User", "avatar": "abc"},
+])
+def test_payload_from_claims_equals_a_validated_one(profile: dict[str, Any]):
+    from routers.oauth import JWT_DECODER
+    from scheams.jwt import JWTPayload
+
+    claims = JWT_DECODER.decode(token(**profile), key=JWT_KEY, algorithms=["HS256"])
+
+    constructed = JWTPayload.from_claims(claims)
+    validated = JWTPayload.model_validate(claims)
+    assert constructed == validated
+    assert constructed.model_dump() == validated.model_dump()
+    assert constructed.display_name == validated.display_name
+
+
+def test_cached_token_expires_at_exp(token_cache):
+    from fastapi import HTTPException
+    from routers.oauth import valid_token_string
+
+    exp = int(time()) + 2
+    jwt = token(discord_id="1", username="user", exp=exp)
+
+    payload = valid_token_string(jwt)
+    assert valid_token_string(jwt) is payload
+    assert len(token_cache) == 1
+
+    sleep(max(exp - time(), 0) + 0.1)
+    with pytest.raises(HTTPException) as error:
+        valid_token_string(jwt)
+    assert error.value.status_code == 401
+    assert len(token_cache) == 0
+
+
+def test_token_validation_speed(token_cache, benchmark):
+    from routers.oauth import JWT_DECODER, valid_token_string
+    from scheams.jwt import JWTPayload
+
+    count = 20000
+    jwt = token(discord_id="1", username="user", global_name="User", avatar="abc")
+    claims = JWT_DECODER.decode(jwt, key=JWT_KEY, algorithms=["HS256"])
+
+    def uncached():
+        token_cache.clear()
+        valid_token_string(jwt)
+
+    cold = timeit(uncached, number=count)
+    cached = timeit(lambda: valid_token_string(jwt), number=count)
+    validated = timeit(lambda: JWTPayload.model_validate(claims), number=count)
+    constructed = timeit(lambda: JWTPayload.from_claims(claims), number=count)
+
+    benchmark(
+        f"token validation per call: uncached {cold / count * 1e6:.1f} us, "
+        f"cached {cached / count * 1e6:.1f} us; payload model_validate "
+        f"{validated / count * 1e6:.1f} us, from_claims {constructed / count * 1e6:.1f} us"
+    )
+
+
+class CountingDiscord():
+    """Refreshes the tokens of any user, or fails while `failing`, and
+    counts the token requests."""
+
+    def __init__(self):
+        self.refreshes = 0
+        self.failing = False
+
+    async def request(self, method: str, route: str, **kwargs) -> tuple[int, Any]:
+        # Long enough for every concurrent caller to arrive.
+        await asleep(0.01)
+        if route == "oauth2/token":
+            self.refreshes += 1
+            if self.failing:
+                return 500, None
+            return 200, {"access_token": "access", "refresh_token": "refresh", "scope": "identify"}
+        return 200, {"id": "1", "username": "user"}
+
+
+def test_concurrent_refreshes_call_discord_once(database, monkeypatch: pytest.MonkeyPatch):
+    from fastapi import HTTPException
+    from routers import oauth
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+
+    discord = CountingDiscord()
+    monkeypatch.setattr(oauth.DISCORD, "request", discord.request)
+    oauth.PROFILE_CACHE.clear()
+
+    async def main():
+        await database()
+        connection = await ConnectionInfo(
+            private_key="private", public_key="public", ip_address="10.80.0.2", discord_user_id="1"
+        ).insert()
+        await UserData(discord_id="1", username="user", connection=connection).insert()
+
+        # Errors reach every waiting caller and are not cached.
+        discord.failing = True
+        results = await gather(*[oauth.refresh_user("1") for _ in range(20)], return_exceptions=True)
+        assert discord.refreshes == 1
+        assert all(isinstance(result, HTTPException) for result in results)
+        assert oauth.PROFILE_CACHE.get("1") is None
+        assert not oauth.PROFILE_REFRESH.calls
+
+        discord.failing = False
+        users = await gather(*[oauth.refresh_user("1") for _ in range(20)])
+        assert discord.refreshes == 2
+        assert all(user is users[0] for user in users)
+
+        # Served from the profile cache until it expires.
+        assert await oauth.refresh_user("1") is users[0]
+        assert discord.refreshes == 2
+
+    try:
+        run(main())
+    finally:
+        oauth.PROFILE_CACHE.clear()
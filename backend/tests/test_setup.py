@@ -0,0 +1,119 @@
+import pytest
+
+from asyncio import run
+from itertools import count
+from os import environ
+from time import perf_counter
+
+# mongomock scans the collection for every unique index check, the full
+# seed only runs against a real mongod.
+SEED_USERS = 50000 if environ.get("WSM_TEST_MONGODB_URI") else 2000
+
+
+@pytest.fixture
+def fake_keys(monkeypatch: pytest.MonkeyPatch):
+    from wireguard import keys
+
+    numbers = count()
+
+    async def iter_keypairs(total: int, workers=None):
+        indexes = [next(numbers) for _ in range(total)]
+        yield [(f"new-private-{index}", f"new-public-{index}") for index in indexes]
+
+    monkeypatch.setattr(keys, "iter_keypairs", iter_keypairs)
+
+
+def test_freed_connections_get_new_keys(database, fake_keys, capsys: pytest.CaptureFixture):
+    from bson import DBRef
+
+    from allocator import offset_to_ip
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+    from setup import assign_connections
+
+    async def main():
+        await database()
+        connections = ConnectionInfo.get_motor_collection()
+        await connections.insert_many([
+            {"_id": "kept", "private_key": "private-0", "public_key": "public-0",
+             "ip_address": offset_to_ip(0), "discord_user_id": "alice"},
+            {"_id": "gone", "private_key": "private-1", "public_key": "public-1",
+             "ip_address": offset_to_ip(1), "discord_user_id": "mallory"},
+            {"_id": "left", "private_key": "private-2", "public_key": "public-2",
+             "ip_address": offset_to_ip(2), "discord_user_id": "trudy"},
+            {"_id": "free", "private_key": "private-3", "public_key": "public-3",
+             "ip_address": offset_to_ip(3), "discord_user_id": None},
+        ])
+        await UserData.get_motor_collection().insert_many([
+            {"discord_id": "alice", "connection": DBRef("ConnectionInfo", "kept")},
+            {"discord_id": "bob", "connection": None},
+        ])
+
+        await assign_connections()
+
+        result = {conn["_id"]: conn async for conn in connections.find({})}
+        assert result["kept"]["public_key"] == "public-0"
+        assert result["free"]["public_key"] == "public-3"
+        # Whoever had the connections of removed users, their keys are gone.
+        assert {result["gone"]["public_key"], result["left"]["public_key"]} == \
+            {"new-public-0", "new-public-1"}
+        assert {result["gone"]["private_key"], result["left"]["private_key"]} == \
+            {"new-private-0", "new-private-1"}
+        assert result["gone"]["discord_user_id"] == "bob"
+        assert result["left"]["discord_user_id"] is None
+
+        bob = await UserData.get_motor_collection().find_one({"discord_id": "bob"})
+        assert bob["connection"].id == "gone"
+
+    run(main())
+    assert "2 connections of removed users got new keys." in capsys.readouterr().out
+
+
+def test_assign_connections_of_a_large_seed(database, fake_keys, benchmark, monkeypatch):
+    from bson import DBRef
+
+    import allocator
+    from allocator import offset_to_ip
+    from scheams.connection_info import ConnectionInfo
+    from scheams.user import UserData
+    from setup import assign_connections
+    from wireguard import keys
+
+    monkeypatch.setattr(allocator, "iter_keypairs", keys.iter_keypairs)
+    users = SEED_USERS
+
+    async def main():
+        await database()
+        connections = ConnectionInfo.get_motor_collection()
+        user_collection = UserData.get_motor_collection()
+
+        # Half of the users keep their connection, a tenth of the connections
+        # belong to users who are gone and the rest get a new one.
+        start = perf_counter()
+        await connections.insert_many([
+            {"_id": f"conn-{index}", "private_key": f"private-{index}",
+             "public_key": f"public-{index}", "ip_address": offset_to_ip(index),
+             "discord_user_id": str(index) if index < users // 2 else f"gone-{index}"}
+            for index in range(users // 2 + users // 10)
+        ])
+        await user_collection.insert_many([
+            {"discord_id": str(index), "username": f"user{index}",
+             "connection": DBRef("Connections", f"conn-{index}") if index < users // 2 else None}
+            for index in range(users)
+        ])
+        seeded = perf_counter() - start
+
+        start = perf_counter()
+        await assign_connections()
+        assigned = perf_counter() - start
+
+        linked = [user["connection"].id async for user in user_collection.find({})]
+        assert len(set(linked)) == users
+        assert await connections.count_documents({"discord_user_id": {"$ne": None}}) == users
+
+        benchmark(
+            f"assign_connections of {users} users: seeded in {seeded:.1f} s, "
+            f"assigned in {assigned:.1f} s"
+        )
+
+    run(main())
@@ -0,0 +1,94 @@
+import pytest
+
+from asyncio import (
+    TimeoutError as WaitTimeout,
+    create_task,
+    open_unix_connection,
+    run,
+    sleep as asleep,
+    wait_for
+)
+from os import stat
+from stat import S_IMODE
+
+from status_channel import ChannelClient, ChannelServer, encode_frame, read_frame
+
+
+def test_socket_is_private(tmp_path):
+    async def main():
+        path = str(tmp_path / "status.sock")
+        server = ChannelServer()
+        await server.start(path)
+        try:
+            assert S_IMODE(stat(path).st_mode) == 0o600
+        finally:
+            await server.close()
+
+    run(main())
+
+
+def test_cache_invalidations_reach_the_other_workers(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    from cache import SHARED_CACHES, USER_LIST_CACHE
+    from wireguard_status import PUBLISHER
+
+    monkeypatch.setattr(PUBLISHER, "on_subscribers", None)
+    monkeypatch.setattr(SHARED_CACHES, "on_invalidate", None)
+
+    async def main():
+        path = str(tmp_path / "status.sock")
+        server = ChannelServer()
+        await server.start(path)
+        client = ChannelClient()
+        channel = create_task(client.run(path))
+        reader, writer = await open_unix_connection(path)
+        try:
+            while client.writer is None or len(server.workers) < 2:
+                await asleep(0.01)
+            USER_LIST_CACHE.set((None, 10), ("etag", b"[]", None))
+
+            # Another worker had a user join.
+            writer.write(encode_frame({"type": "invalidate", "cache": "user_list", "key": None}))
+            while len(USER_LIST_CACHE):
+                await asleep(0.01)
+            # The invalidation is not sent back to where it came from.
+            with pytest.raises(WaitTimeout):
+                await wait_for(reader.read(1), 0.1)
+
+            # And the other way round.
+            USER_LIST_CACHE.set((None, 10), ("etag", b"[]", None))
+            USER_LIST_CACHE.invalidate()
+            assert not len(USER_LIST_CACHE)
+            assert await wait_for(read_frame(reader), 1) == \
+                {"type": "invalidate", "cache": "user_list", "key": None}
+        finally:
+            writer.close()
+            channel.cancel()
+            await server.close()
+            USER_LIST_CACHE.clear()
+
+    run(main())
+
+
+def test_scrape_does_not_wait_for_a_disconnected_worker(tmp_path):
+    import status_channel
+
+    async def main():
+        path = str(tmp_path / "status.sock")
+        server = ChannelServer()
+        await server.start(path)
+        reader, writer = await open_unix_connection(path)
+        try:
+            while not server.workers:
+                await asleep(0.01)
+
+            scrape = create_task(server.collect_metrics())
+            # The worker goes away instead of answering.
+            assert (await read_frame(reader))["type"] == "metrics"
+            writer.close()
+            assert await wait_for(scrape, status_channel.METRICS_TIMEOUT / 2) == []
+            assert not server.metrics_requests
+        finally:
+            writer.close()
+            await server.close()
+
+    run(main())
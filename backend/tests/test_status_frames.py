@@ -0,0 +1,78 @@
+import pytest
+from orjson import dumps
+
+from base64 import b64encode
+from timeit import timeit
+from zlib import compress
+
+from status_frames import (
+    COUNT,
+    DELTA,
+    DELTA_VALUE,
+    FULL,
+    HEADER,
+    KEY_SIZE,
+    U32_MAX,
+    VALUE,
+    encode_delta,
+    encode_full,
+)
+
+KEYS = ["A" * 43 + "=", "B" * 43 + "="]
+
+
+def test_full_frame_layout():
+    frame = encode_full(7, {
+        KEYS[0]: (1700000000, 1 << 40, 3, 4, U32_MAX + 1),
+        KEYS[1]: (0, 0, 0, 0, 0),
+    })
+
+    assert HEADER.unpack_from(frame) == (FULL, 7)
+    assert COUNT.unpack_from(frame, HEADER.size) == (2,)
+    keys_offset = HEADER.size + COUNT.size
+    assert frame[keys_offset:keys_offset + 2 * KEY_SIZE].decode() == "".join(KEYS)
+    values = list(VALUE.iter_unpack(frame[keys_offset + 2 * KEY_SIZE:]))
+    # Rates are clamped to u32.
+    assert values == [(1700000000, 1 << 40, 3, 4, U32_MAX), (0, 0, 0, 0, 0)]
+
+
+def test_delta_frame_uses_the_full_frame_indexes():
+    frame = encode_delta(8, {KEYS[0]: 0, KEYS[1]: 1}, {KEYS[1]: (5, 6, 7, 8, 9)})
+
+    assert HEADER.unpack_from(frame) == (DELTA, 8)
+    assert COUNT.unpack_from(frame, HEADER.size) == (1,)
+    assert list(DELTA_VALUE.iter_unpack(frame[HEADER.size + COUNT.size:])) == \
+        [(1, 5, 6, 7, 8, 9)]
+
+
+@pytest.mark.parametrize("count", [1000, 10000])
+def test_frames_against_json(benchmark, count: int):
+    keys = [b64encode(index.to_bytes(32, "big")).decode() for index in range(count)]
+    snapshot = {
+        key: (1700000000 + index, 10**9 + index * 7919, 10**8 + index * 104729, index * 13, index * 3)
+        for index, key in enumerate(keys)
+    }
+    # A tenth of the peers transferred something since the last tick.
+    changed = dict(list(snapshot.items())[::10])
+    key_index = {key: index for index, key in enumerate(keys)}
+
+    encoders = {
+        "full": (
+            lambda: encode_full(1, snapshot),
+            lambda: dumps({"type": "full", "seq": 1, "data": snapshot}),
+        ),
+        "delta": (
+            lambda: encode_delta(2, key_index, changed),
+            lambda: dumps({"type": "delta", "seq": 2, "data": changed, "removed": []}),
+        ),
+    }
+    results = []
+    for kind, (binary, json) in encoders.items():
+        for name, encode in (("binary", binary), ("json", json)):
+            data = encode()
+            seconds = timeit(encode, number=20) / 20
+            results.append(
+                f"{kind} {name} {len(data) / 1024:.0f} KiB "
+                f"({len(compress(data)) / 1024:.0f} KiB deflated) in {seconds * 1000:.2f} ms"
+            )
+    benchmark(f"status frames of {count} peers: " + ", ".join(results))
@@ -0,0 +1,132 @@
+import pytest
+
+from asyncio import create_task, run, sleep as asleep
+from time import time
+from typing import Awaitable, Callable, Iterator, Optional
+
+import wireguard_status
+from history import HistoryStore
+from wireguard import PeerStatus
+from wireguard_status import AutoPublisher, PeerRecord, STATUS, status_update_task
+
+
+class FakeBackend():
+    """Counts its dumps, the transferred bytes grow in the first
+    `changing` ones."""
+
+    def __init__(self, changing: int = 0):
+        self.changing = changing
+        self.dumps: list[float] = []
+
+    def dump(self) -> list[PeerStatus]:
+        self.dumps.append(time())
+        rx_bytes = min(len(self.dumps), self.changing)
+        return [PeerStatus(public_key="peer", rx_bytes=rx_bytes)]
+
+    def close(self):
+        pass
+
+
+def sample(rx_bytes: int, tx_bytes: int) -> PeerStatus:
+    return PeerStatus(
+        public_key="peer", latest_handshake=1700000000, rx_bytes=rx_bytes, tx_bytes=tx_bytes
+    )
+
+
+def test_first_sample_has_no_rate():
+    record = PeerRecord(sample(10**9, 10**6), 100)
+
+    assert record.value() == (1700000000, 10**9, 10**6, 0, 0)
+
+
+def test_rates_between_samples():
+    record = PeerRecord(sample(1000, 500), 100)
+
+    record.update(sample(4000, 1500), 102)
+    assert (record.rx_rate, record.tx_rate) == (1500, 500)
+    # Rounded to whole bytes per second.
+    record.update(sample(5000, 1500), 102.3)
+    assert (record.rx_rate, record.tx_rate) == (3333, 0)
+    # A repeated sample of the same moment keeps the rates.
+    record.update(sample(5000, 1500), 102.3)
+    assert (record.rx_rate, record.tx_rate) == (3333, 0)
+
+
+def test_counter_reset_is_not_a_negative_rate():
+    record = PeerRecord(sample(10**6, 10**6), 100)
+
+    # The peer was removed and added again, its counters start over.
+    record.update(sample(200, 100), 101)
+    assert record.value() == (1700000000, 200, 100, 0, 0)
+    record.update(sample(1200, 300), 102)
+    assert (record.rx_rate, record.tx_rate) == (1000, 200)
+
+
+@pytest.fixture
+def poller(monkeypatch: pytest.MonkeyPatch) -> Iterator[AutoPublisher]:
+    publisher = AutoPublisher()
+    monkeypatch.setattr(wireguard_status, "PUBLISHER", publisher)
+    monkeypatch.setattr(wireguard_status, "HISTORY", None)
+    monkeypatch.setattr(wireguard_status, "STATUS_POLL_INTERVAL_MIN", 0.02)
+    monkeypatch.setattr(wireguard_status, "STATUS_POLL_INTERVAL_MAX", 0.16)
+    STATUS.clear()
+    yield publisher
+    STATUS.clear()
+
+
+def poll_for(seconds: float, before: Optional[Callable[[], Awaitable[None]]] = None):
+    async def main():
+        task = create_task(status_update_task())
+        if before is not None:
+            await before()
+        await asleep(seconds)
+        task.cancel()
+
+    run(main())
+
+
+def test_interval_adapts_to_changes(poller: AutoPublisher, monkeypatch: pytest.MonkeyPatch):
+    backend = FakeBackend(changing=3)
+    monkeypatch.setattr(wireguard_status, "BACKEND", backend)
+    poller.has_subscribers.set()
+
+    poll_for(0.8)
+
+    intervals = [b - a for a, b in zip(backend.dumps, backend.dumps[1:])]
+    # Changed status keeps the minimum, the fourth sample still changes the
+    # rate back to zero. Then it doubles up to the maximum.
+    expected = [0.02, 0.02, 0.02, 0.02, 0.04, 0.08, 0.16, 0.16]
+    assert len(intervals) >= len(expected)
+    for interval, bound in zip(intervals, expected):
+        assert bound * 0.9 <= interval < bound + 0.03
+
+
+def test_idle_without_history_does_not_poll(poller: AutoPublisher, monkeypatch: pytest.MonkeyPatch):
+    backend = FakeBackend()
+    monkeypatch.setattr(wireguard_status, "BACKEND", backend)
+
+    async def subscribe_later():
+        await asleep(0.3)
+        assert backend.dumps == []
+        poller.has_subscribers.set()
+
+    poll_for(0.1, subscribe_later)
+
+    assert len(backend.dumps) >= 2
+
+
+def test_idle_with_history_samples_once_per_bucket(
+    poller: AutoPublisher, monkeypatch: pytest.MonkeyPatch
+):
+    backend = FakeBackend(changing=100)
+    monkeypatch.setattr(wireguard_status, "BACKEND", backend)
+    monkeypatch.setattr(wireguard_status, "HISTORY", HistoryStore(4))
+    monkeypatch.setattr(wireguard_status, "IDLE_INTERVAL", 0.1)
+
+    poll_for(0.55)
+
+    # The first sample is taken right away, the others at the start of a
+    # bucket even though the status keeps changing.
+    assert 5 <= len(backend.dumps) <= 7
+    for sampled_at in backend.dumps[1:]:
+        assert sampled_at % 0.1 < 0.03
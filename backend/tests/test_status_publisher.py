@@ -0,0 +1,371 @@
+import pytest
+from orjson import loads
+
+import tracemalloc
+from asyncio import Queue, create_task, gather, run, sleep as asleep
+from base64 import b64encode
+from time import perf_counter
+from typing import Any, Iterator, Optional
+
+from wireguard import PeerStatus
+from wireguard_status import AutoPublisher, STATUS, update_status
+
+
+def key(number: int) -> str:
+    return b64encode(number.to_bytes(32, "big")).decode()
+
+
+def peers(count: int, tick: int = 0, changed: int = 0) -> list[PeerStatus]:
+    """`count` peers, the first `changed` of them transferred a byte more
+    in every tick."""
+    return [
+        PeerStatus(public_key=key(index), rx_bytes=tick if index < changed else 0)
+        for index in range(count)
+    ]
+
+
+class FakeWebSocket():
+    """Keeps what the publisher sends, optionally taking `delay` seconds
+    for every message."""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.sent: list[bytes] = []
+        self.closed = False
+
+    async def send_bytes(self, data: bytes):
+        if self.closed:
+            raise RuntimeError("closed")
+        if self.delay:
+            await asleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+    def messages(self) -> list[dict[str, Any]]:
+        return [loads(data) for data in self.sent]
+
+
+@pytest.fixture
+def status() -> Iterator[dict]:
+    STATUS.clear()
+    yield STATUS
+    STATUS.clear()
+
+
+async def drain(publisher: AutoPublisher):
+    """Let the writer tasks send everything up to the current tick."""
+    while any(
+        subscriber.last_seq < publisher.seq
+        for subscriber in publisher.subscribers.values()
+    ):
+        await asleep(0)
+
+
+def test_deltas_follow_the_full_snapshot_without_gaps(status):
+    async def main():
+        publisher = AutoPublisher()
+        update_status(peers(3), 0)
+        publisher.send_all()
+        ws = FakeWebSocket()
+        publisher.add_subscriber(ws)
+        await drain(publisher)
+
+        for tick in range(1, 6):
+            update_status(peers(3, tick, changed=1), tick)
+            assert publisher.send_all()
+            await drain(publisher)
+        # Nothing changed, nothing is sent.
+        assert not publisher.send_all()
+
+        messages = ws.messages()
+        assert messages[0]["type"] == "full"
+        assert [message["type"] for message in messages[1:]] == ["delta"] * 5
+        assert [message["seq"] for message in messages] == list(range(1, 7))
+        assert messages[-1]["data"] == {key(0): [0, 5, 0, 1, 0]}
+        assert messages[-1]["removed"] == []
+        publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+def test_deltas_applied_to_the_snapshot_give_the_current_state(status):
+    async def main():
+        publisher = AutoPublisher()
+        update_status(peers(4), 0)
+        publisher.send_all()
+        ws = FakeWebSocket()
+        publisher.add_subscriber(ws)
+        await drain(publisher)
+
+        ticks = [
+            peers(4, 1, changed=2),
+            # Two peers join.
+            peers(6, 2, changed=3),
+            # Peers leave from the middle and the end.
+            [peer for index, peer in enumerate(peers(6, 3, changed=6)) if index not in (1, 5)],
+            # One comes back while another leaves.
+            [peer for index, peer in enumerate(peers(6, 4, changed=1)) if index != 0],
+            [],
+            peers(2, 5, changed=2),
+        ]
+        for tick, current in enumerate(ticks, 1):
+            update_status(current, tick)
+            publisher.send_all()
+            await drain(publisher)
+
+            full, *deltas = ws.messages()
+            state = full["data"]
+            for delta in deltas:
+                state.update(delta["data"])
+                for key in delta["removed"]:
+                    del state[key]
+            assert state == {peer: list(value) for peer, value in publisher.snapshot.items()}
+            assert set(state) == {peer.public_key for peer in current}
+
+        assert [message["type"] for message in ws.messages()] == ["full"] + ["delta"] * len(ticks)
+        publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+def test_resync_sends_a_full_snapshot(status):
+    async def main():
+        publisher = AutoPublisher()
+        ws = FakeWebSocket()
+        publisher.add_subscriber(ws)
+        update_status(peers(2), 0)
+        publisher.send_all()
+        await drain(publisher)
+
+        # The client missed a delta and asks for the current state.
+        update_status(peers(2, 1, changed=2), 1)
+        publisher.send_all()
+        publisher.resync(ws)
+        while len(ws.sent) < 3:
+            await asleep(0)
+
+        full = ws.messages()[-1]
+        assert full["type"] == "full"
+        assert full["seq"] == publisher.seq
+        assert full["data"] == {peer: list(value) for peer, value in publisher.snapshot.items()}
+
+        update_status(peers(2, 2, changed=1), 2)
+        publisher.send_all()
+        await drain(publisher)
+        assert ws.messages()[-1]["seq"] == full["seq"] + 1
+        publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+def test_overflowing_queue_coalesces_into_one_full_snapshot(status):
+    from config import STATUS_QUEUE_SIZE
+
+    async def main():
+        publisher = AutoPublisher()
+        ws = FakeWebSocket()
+        publisher.add_subscriber(ws)
+
+        # The writer does not get to run before the queue overflows.
+        ticks = STATUS_QUEUE_SIZE * 3
+        for tick in range(1, ticks + 1):
+            update_status(peers(4, tick, changed=tick % 4 + 1), tick)
+            publisher.send_all()
+        await drain(publisher)
+
+        messages = ws.messages()
+        assert [message["type"] for message in messages] == ["full"]
+        assert messages[0]["seq"] == publisher.seq == ticks
+        assert messages[0]["data"] == \
+            {peer: list(value) for peer, value in publisher.snapshot.items()}
+        publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_fan_out_to_10k_websockets(status, benchmark, binary: bool):
+    subscribers, peer_count, changed, ticks = 10000, 5000, 500, 10
+
+    async def main():
+        publisher = AutoPublisher()
+        update_status(peers(peer_count), 0)
+        publisher.send_all()
+        sockets = [FakeWebSocket() for _ in range(subscribers)]
+        for ws in sockets:
+            publisher.add_subscriber(ws, binary)
+        await drain(publisher)
+
+        fan_out = delivery = 0.0
+        for tick in range(1, ticks + 1):
+            update_status(peers(peer_count, tick, changed), tick)
+            start = perf_counter()
+            publisher.send_all()
+            queued = perf_counter()
+            await drain(publisher)
+            fan_out += queued - start
+            delivery += perf_counter() - start
+
+        assert all(len(ws.sent) == ticks + 1 for ws in sockets)
+        benchmark(
+            f"fan-out {'binary' if binary else 'json'} to {subscribers} websockets, "
+            f"{changed} of {peer_count} peers changed: "
+            f"send_all {fan_out / ticks * 1000:.1f} ms, "
+            f"delivered in {delivery / ticks * 1000:.1f} ms"
+        )
+        for ws in sockets:
+            publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+class ClientWebSocket(FakeWebSocket):
+    """The server side of a websocket whose client sent `token` and then
+    waits, until `disconnect`."""
+
+    def __init__(self, token: str, delay: float = 0):
+        super().__init__(delay)
+        self.scope: dict[str, Any] = {"subprotocols": []}
+        self.token = token
+        self.incoming: Queue[dict[str, Any]] = Queue()
+
+    async def accept(self, subprotocol: Optional[str] = None):
+        pass
+
+    async def receive_text(self) -> str:
+        return self.token
+
+    async def receive(self) -> dict[str, Any]:
+        return await self.incoming.get()
+
+    def disconnect(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+
+@pytest.fixture
+def publisher(monkeypatch: pytest.MonkeyPatch) -> AutoPublisher:
+    """A publisher of its own for the websocket route."""
+    from routers import connection
+
+    publisher = AutoPublisher()
+    monkeypatch.setattr(connection, "PUBLISHER", publisher)
+    return publisher
+
+
+def user_token() -> str:
+    from jwt import encode
+
+    from config import JWT_KEY
+    from scheams.jwt import JWTPayload
+
+    return encode(JWTPayload(discord_id="1", username="user").model_dump(), key=JWT_KEY)
+
+
+def test_slow_and_closed_sockets_are_dropped_without_blocking_others(
+    status, monkeypatch: pytest.MonkeyPatch
+):
+    import wireguard_status
+
+    monkeypatch.setattr(wireguard_status, "STATUS_SEND_TIMEOUT", 0.2)
+
+    async def main():
+        publisher = AutoPublisher()
+        update_status(peers(2), 0)
+        publisher.send_all()
+        fast = [FakeWebSocket() for _ in range(3)]
+        slow, closed = FakeWebSocket(delay=60), FakeWebSocket()
+        closed.closed = True
+        for ws in (*fast, slow, closed):
+            publisher.add_subscriber(ws)
+
+        start = perf_counter()
+        while not all(ws.sent for ws in fast) or closed in publisher.subscribers:
+            await asleep(0)
+        assert perf_counter() - start < 0.1
+        assert closed.closed
+
+        update_status(peers(2, 1, changed=1), 1)
+        publisher.send_all()
+        while not all(len(ws.sent) == 2 for ws in fast):
+            await asleep(0)
+        assert perf_counter() - start < 0.1
+
+        await asleep(0.3)
+        assert set(publisher.subscribers) == set(fast)
+        assert slow.closed and not slow.sent
+        for ws in fast:
+            publisher.remove_subscriber(ws)
+
+    run(main())
+
+
+def test_disconnected_socket_is_removed(status, publisher: AutoPublisher):
+    from routers.connection import subscribe
+
+    async def main():
+        ws = ClientWebSocket(user_token())
+        handler = create_task(subscribe(ws))
+        while not ws.sent:
+            await asleep(0)
+        writer = publisher.subscribers[ws].task
+        assert publisher.has_subscribers.is_set()
+
+        ws.disconnect()
+        await handler
+        assert not publisher.subscribers
+        assert not publisher.has_subscribers.is_set()
+        await asleep(0)
+        assert writer.done()
+
+    run(main())
+
+
+def test_10k_idle_subscribers(status, publisher: AutoPublisher, benchmark):
+    from routers.connection import subscribe
+
+    count = 10000
+
+    async def main():
+        update_status(peers(100), 0)
+        publisher.send_all()
+        token = user_token()
+        sockets = [ClientWebSocket(token) for _ in range(count)]
+
+        tracemalloc.start()
+        start = perf_counter()
+        handlers = [create_task(subscribe(ws)) for ws in sockets]
+        while len(publisher.subscribers) < count:
+            await asleep(0)
+        await drain(publisher)
+        connected = perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Idle subscribers cost nothing between ticks.
+        loop_start = perf_counter()
+        await asleep(0.5)
+        idle = perf_counter() - loop_start - 0.5
+
+        update_status(peers(100, 1, changed=10), 1)
+        start = perf_counter()
+        publisher.send_all()
+        await drain(publisher)
+        tick = perf_counter() - start
+
+        writers = [subscriber.task for subscriber in publisher.subscribers.values()]
+        for ws in sockets:
+            ws.disconnect()
+        await gather(*handlers)
+        await asleep(0)
+        assert not publisher.subscribers
+        assert all(writer.done() for writer in writers)
+
+        benchmark(
+            f"{count} idle subscribers: connected in {connected * 1000:.0f} ms, "
+            f"{memory / count / 1024:.1f} KiB each, idle loop lag {idle * 1000:.1f} ms, "
+            f"tick delivered in {tick * 1000:.0f} ms"
+        )
+
+    run(main())
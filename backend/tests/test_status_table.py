@@ -0,0 +1,71 @@
+import pytest
+
+from multiprocessing.shared_memory import SharedMemory
+from timeit import timeit
+from uuid import uuid4
+
+from status_table import StatusTable
+from wireguard import PeerStatus
+
+
+def test_workers_read_what_the_poller_writes(caplog: pytest.LogCaptureFixture):
+    name = f"wsm-test-{uuid4().hex[:8]}"
+    table = StatusTable.create(name, 4)
+    # Not StatusTable.attach, it unregisters the segment from the resource
+    # tracker which the creator shares here.
+    reader = StatusTable(SharedMemory(name), False)
+    try:
+        peers = [
+            PeerStatus("A" * 43 + "=", 1700000000, 10, 20, "203.0.113.7:51820"),
+            PeerStatus("B" * 43 + "=", 0, 0, 0, None),
+        ]
+        table.write(peers)
+        assert reader.read() == peers
+
+        # Same peers, only the records are copied again.
+        peers[1] = peers[1]._replace(rx_bytes=5)
+        table.write(peers)
+        version = reader.keys_version
+        assert reader.read() == peers
+        assert reader.keys_version == version
+
+        # Peers beyond the capacity are dropped, with one warning until
+        # they fit again.
+        more = [PeerStatus(f"{index:043d}=") for index in range(6)]
+        table.write(more)
+        table.write(more)
+        assert reader.read() == more[:4]
+        assert reader.keys_version == version + 1
+        assert caplog.text.count("6 peers do not fit the status table of 4") == 1
+        table.write(peers)
+        table.write(more)
+        assert caplog.text.count("6 peers do not fit the status table of 4") == 2
+    finally:
+        reader.close()
+        table.close()
+
+
+@pytest.mark.parametrize("count", [5000, 65536])
+def test_snapshot_speed(benchmark, count: int):
+    name = f"wsm-test-{uuid4().hex[:8]}"
+    table = StatusTable.create(name, count)
+    reader = StatusTable(SharedMemory(name), False)
+    try:
+        peers = [
+            PeerStatus(f"{index:043d}=", 1700000000, index, index, "203.0.113.7:51820")
+            for index in range(count)
+        ]
+        table.write(peers)
+        assert reader.read() == peers
+
+        number = 100
+        write = timeit(lambda: table.write(peers), number=number) / number
+        snapshot = timeit(lambda: reader.snapshot(reader.keys_version), number=number) / number
+        read = timeit(reader.read, number=number) / number
+        benchmark(
+            f"status table of {count} peers: write {write * 1000:.2f} ms, "
+            f"snapshot {snapshot * 1000:.2f} ms, read {read * 1000:.2f} ms"
+        )
+    finally:
+        reader.close()
+        table.close()
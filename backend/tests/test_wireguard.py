@@ -0,0 +1,164 @@
+import pytest
+
+from base64 import b64encode
+
+from wireguard import AutoBackend, FakeNetlinkSocket, NetlinkBackend, PeerConfig, PeerStatus
+from wireguard.cli import CliBackend
+from wireguard.netlink import (
+    GENL_HEADER,
+    NLA_F_NESTED,
+    NLM_F_MULTI,
+    WG_CMD_GET_DEVICE,
+    WG_GENL_VERSION,
+    WGDEVICE_A_IFNAME,
+    WGDEVICE_A_PEERS,
+    WGPEER_A_ALLOWEDIPS,
+    WGPEER_A_PUBLIC_KEY,
+    pack_allowed_ip,
+    pack_attr,
+    pack_message,
+)
+from wireguard.sync import diff_peers
+
+
+def key(number: int) -> str:
+    return b64encode(number.to_bytes(32, "big")).decode()
+
+
+PRESHARED_KEY = key(0xffff)
+
+
+def backend_for(sock: FakeNetlinkSocket) -> NetlinkBackend:
+    return NetlinkBackend(sock.interface, socket_factory=lambda: sock)
+
+
+def test_dump_parses_peers():
+    peers = [
+        PeerStatus(
+            public_key=key(1),
+            latest_handshake=1700000000,
+            rx_bytes=1 << 40,
+            tx_bytes=12345,
+            endpoint="203.0.113.7:51820",
+            allowed_ips=("10.0.0.2/32",),
+            preshared_key=PRESHARED_KEY,
+        ),
+        PeerStatus(
+            public_key=key(2),
+            endpoint="[2001:db8::1]:4242",
+            allowed_ips=("10.0.0.3/32", "fd00::3/128"),
+        ),
+    ]
+    backend = backend_for(FakeNetlinkSocket("wg0", peers))
+
+    assert backend.dump() == peers
+
+
+def test_dump_joins_multiple_messages():
+    peers = [
+        PeerStatus(public_key=key(index), allowed_ips=(f"10.0.{index // 256}.{index % 256}/32",))
+        for index in range(300)
+    ]
+    sock = FakeNetlinkSocket("wg0", peers, peers_per_message=7)
+    backend = backend_for(sock)
+
+    assert backend.dump() == peers
+    # The socket stays open for the next poll.
+    assert backend.dump() == peers
+    assert not sock.closed
+
+
+class SplitPeerSocket(FakeNetlinkSocket):
+    """Sends the allowed ips of the last peer in a second message, like the
+    kernel does when a peer does not fit into one message."""
+
+    def dump_messages(self, seq: int) -> list[bytes]:
+        result = super().dump_messages(seq)
+        extra = pack_attr(WGPEER_A_PUBLIC_KEY, bytes(31) + b"\x01") + \
+            pack_attr(NLA_F_NESTED | WGPEER_A_ALLOWEDIPS, pack_attr(
+                NLA_F_NESTED, pack_allowed_ip("10.1.0.0/16")
+            ))
+        result.insert(-1, pack_message(
+            self.family_id, NLM_F_MULTI, seq,
+            GENL_HEADER.pack(WG_CMD_GET_DEVICE, WG_GENL_VERSION, 0) +
+            pack_attr(WGDEVICE_A_IFNAME, self.interface.encode() + b"\0") +
+            pack_attr(NLA_F_NESTED | WGDEVICE_A_PEERS, pack_attr(NLA_F_NESTED, extra))
+        ))
+        return result
+
+
+def test_dump_merges_continued_peer():
+    sock = SplitPeerSocket("wg0", [PeerStatus(public_key=key(1), allowed_ips=("10.0.0.2/32",))])
+
+    [peer] = backend_for(sock).dump()
+
+    assert peer.allowed_ips == ("10.0.0.2/32", "10.1.0.0/16")
+
+
+def test_apply_sets_and_removes_peers():
+    sock = FakeNetlinkSocket("wg0", [
+        PeerStatus(public_key=key(index), allowed_ips=(f"10.0.1.{index}/32",))
+        for index in range(200)
+    ])
+    backend = backend_for(sock)
+
+    # More peers than fit into one WG_CMD_SET_DEVICE message.
+    set_peers = [
+        PeerConfig(key(index), PRESHARED_KEY, (f"10.0.2.{index % 256}/32",))
+        for index in range(200, 500)
+    ]
+    backend.apply(set_peers, [key(index) for index in range(150)])
+
+    live = {peer.public_key: peer for peer in backend.dump()}
+    assert set(live) == {key(index) for index in range(150, 500)}
+    assert live[key(150)].preshared_key is None
+    assert live[key(300)].allowed_ips == ("10.0.2.44/32",)
+    assert live[key(300)].preshared_key == PRESHARED_KEY
+
+
+def test_wrong_interface_raises_and_reconnects():
+    sock = FakeNetlinkSocket("wg1", [])
+    backend = NetlinkBackend("wg0", socket_factory=lambda: sock)
+
+    with pytest.raises(OSError):
+        backend.dump()
+    assert sock.closed
+    assert backend.sock is None
+
+    sock.interface = "wg0"
+    sock.closed = False
+    assert backend.dump() == []
+
+
+def test_auto_backend_falls_back_to_cli(monkeypatch: pytest.MonkeyPatch):
+    peers = [PeerStatus(public_key=key(1))]
+    monkeypatch.setattr(CliBackend, "dump", lambda self: peers)
+
+    backend = AutoBackend("wg0")
+    backend.backend = NetlinkBackend(
+        "wg0", socket_factory=lambda: FakeNetlinkSocket("wg1", [])
+    )
+
+    assert backend.dump() == peers
+    assert isinstance(backend.backend, CliBackend)
+
+
+def test_diff_peers():
+    live = [
+        PeerStatus(public_key=key(1), allowed_ips=("10.0.0.2",), preshared_key=PRESHARED_KEY),
+        PeerStatus(public_key=key(2), allowed_ips=("10.0.0.3/32",), preshared_key=PRESHARED_KEY),
+        PeerStatus(public_key=key(3), allowed_ips=("10.0.0.4/32",), preshared_key=PRESHARED_KEY),
+        PeerStatus(public_key=key(4), allowed_ips=("10.0.0.5/32",)),
+    ]
+    desired = {
+        # Same network, only spelled differently.
+        key(1): PeerConfig(key(1), PRESHARED_KEY, ("10.0.0.2/32",)),
+        key(2): PeerConfig(key(2), PRESHARED_KEY, ("10.0.0.9/32",)),
+        key(3): PeerConfig(key(3), key(0xfffe), ("10.0.0.4/32",)),
+        key(5): PeerConfig(key(5), PRESHARED_KEY, ("10.0.0.6/32",)),
+    }
+
+    set_peers, remove_peers = diff_peers(desired, live)
+
+    assert [peer.public_key for peer in set_peers] == [key(2), key(3), key(5)]
+    assert remove_peers == [key(4)]
@@ -0,0 +1,51 @@
+from logging import getLogger
+
+from .backend import PeerConfig, PeerStatus, StatusBackend
+from .cli import CliBackend
+from .netlink import FakeNetlinkSocket, NetlinkBackend
+
+logger = getLogger("wireguard")
+
+
+class AutoBackend(StatusBackend):
+    """Use netlink and permanently fall back to the `wg` CLI if it fails."""
+
+    def __init__(self, interface: str):
+        super().__init__(interface)
+        self.backend: StatusBackend = NetlinkBackend(interface)
+
+    def fallback(self, error: OSError):
+        logger.warning(
+            f"Netlink status backend unavailable ({error}), fall back to wg CLI."
+        )
+        self.backend.close()
+        self.backend = CliBackend(self.interface)
+
+    def dump(self) -> list[PeerStatus]:
+        if isinstance(self.backend, NetlinkBackend):
+            try:
+                return self.backend.dump()
+            except OSError as error:
+                self.fallback(error)
+
+        return self.backend.dump()
+
+    def apply(self, set_peers: list[PeerConfig], remove_peers: list[str]):
+        if isinstance(self.backend, NetlinkBackend):
+            try:
+                return self.backend.apply(set_peers, remove_peers)
+            except OSError as error:
+                self.fallback(error)
+
+        return self.backend.apply(set_peers, remove_peers)
+
+    def close(self):
+        self.backend.close()
+
+
+def get_backend(name: str, interface: str) -> StatusBackend:
+    if name == "netlink":
+        return NetlinkBackend(interface)
+    if name == "cli":
+        return CliBackend(interface)
+    return AutoBackend(interface)
@@ -0,0 +1,39 @@
+from typing import NamedTuple, Optional
+
+
+class PeerStatus(NamedTuple):
+    public_key: str
+    latest_handshake: int = 0
+    rx_bytes: int = 0
+    tx_bytes: int = 0
+    endpoint: Optional[str] = None
+    allowed_ips: tuple[str, ...] = ()
+    preshared_key: Optional[str] = None
+
+
+class PeerConfig(NamedTuple):
+    public_key: str
+    preshared_key: str
+    allowed_ips: tuple[str, ...]
+
+
+class StatusBackend():
+    """Read and change the live peer table of a wireguard interface.
+
+    All methods are blocking and are meant to be run in an executor.
+    """
+    interface: str
+
+    def __init__(self, interface: str):
+        self.interface = interface
+
+    def dump(self) -> list[PeerStatus]:
+        raise NotImplementedError
+
+    def apply(self, set_peers: list[PeerConfig], remove_peers: list[str]):
+        """Add or update `set_peers` and remove `remove_peers` in place,
+        without touching any other peer."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,83 @@
+from os import remove, write, close
+from subprocess import run, PIPE, DEVNULL
+from tempfile import mkstemp
+
+from .backend import PeerConfig, PeerStatus, StatusBackend
+
+# Peers per `wg set` call, keeps the command line well below ARG_MAX.
+SET_BATCH_SIZE = 512
+
+
+class CliBackend(StatusBackend):
+    """Fallback backend which drives the `wg` command line tool."""
+
+    def dump(self) -> list[PeerStatus]:
+        proc = run(
+            args=["wg", "show", self.interface, "dump"],
+            stdout=PIPE,
+            stderr=DEVNULL
+        )
+        if proc.returncode != 0:
+            raise OSError(f"wg show {self.interface} exited with {proc.returncode}")
+
+        # The first line describes the interface itself.
+        lines = proc.stdout.decode().strip().split("\n")[1:]
+
+        result = []
+        for line in lines:
+            fields = line.split("\t")
+            if len(fields) < 8:
+                continue
+
+            preshared_key = fields[1]
+            endpoint = fields[2]
+            allowed_ips = fields[3]
+            result.append(PeerStatus(
+                public_key=fields[0],
+                latest_handshake=int(fields[4]),
+                rx_bytes=int(fields[5]),
+                tx_bytes=int(fields[6]),
+                endpoint=None if endpoint == "(none)" else endpoint,
+                allowed_ips=() if allowed_ips == "(none)" else tuple(
+                    allowed_ips.split(",")
+                ),
+                preshared_key=None if preshared_key == "(none)" else preshared_key,
+            ))
+
+        return result
+
+    def apply(self, set_peers: list[PeerConfig], remove_peers: list[str]):
+        peers_args = [
+            ["peer", public_key, "remove"]
+            for public_key in remove_peers
+        ]
+
+        # `wg` only reads preshared keys from files.
+        psk_files: dict[str, str] = {}
+        try:
+            for peer in set_peers:
+                if peer.preshared_key not in psk_files:
+                    fd, path = mkstemp(prefix="wsm-psk-")
+                    write(fd, peer.preshared_key.encode())
+                    close(fd)
+                    psk_files[peer.preshared_key] = path
+
+                peers_args.append([
+                    "peer", peer.public_key,
+                    "preshared-key", psk_files[peer.preshared_key],
+                    "allowed-ips", ",".join(peer.allowed_ips),
+                ])
+
+            for start in range(0, len(peers_args), SET_BATCH_SIZE):
+                args = ["wg", "set", self.interface]
+                for peer_args in peers_args[start:start + SET_BATCH_SIZE]:
+                    args.extend(peer_args)
+
+                proc = run(args=args, stdout=DEVNULL, stderr=PIPE)
+                if proc.returncode != 0:
+                    raise OSError(
+                        f"wg set {self.interface} failed: {proc.stderr.decode().strip()}"
+                    )
+        finally:
+            for path in psk_files.values():
+                remove(path)
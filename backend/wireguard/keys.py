@@ -0,0 +1,45 @@
+from asyncio import FIRST_COMPLETED, Future, get_event_loop, wait
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from typing import AsyncIterator, Optional
+
+# Key pairs generated by one worker task.
+KEY_CHUNK_SIZE = 256
+
+
+def gen_keypairs(count: int) -> list[tuple[str, str]]:
+    """Return `count` (private key, public key) pairs."""
+    from pywgkey import WgKey
+
+    result = []
+    for _ in range(count):
+        key = WgKey()
+        result.append((key.privkey, key.pubkey))
+    return result
+
+
+async def iter_keypairs(
+    count: int,
+    workers: Optional[int] = None
+) -> AsyncIterator[list[tuple[str, str]]]:
+    """Generate `count` key pairs on a process pool and yield them chunk by
+    chunk as soon as they are ready, in no particular order.
+
+    Only a couple of chunks per worker are in flight at once, so memory does
+    not grow with `count`.
+    """
+    workers = workers or cpu_count() or 1
+    loop = get_event_loop()
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending: set[Future] = set()
+        remaining = count
+        while remaining or pending:
+            while remaining and len(pending) < workers * 2:
+                size = min(remaining, KEY_CHUNK_SIZE)
+                pending.add(loop.run_in_executor(executor, gen_keypairs, size))
+                remaining -= size
+
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,474 @@
+from base64 import b64decode, b64encode
+from errno import EINVAL
+from ipaddress import ip_network
+from os import strerror
+from socket import inet_ntop, inet_pton, socket, AF_INET, AF_INET6, SOCK_RAW
+from struct import Struct
+from threading import RLock
+from typing import Callable, Iterator, Optional
+
+from .backend import PeerConfig, PeerStatus, StatusBackend
+
+# Numbers from <linux/netlink.h>, <linux/genetlink.h> and <linux/wireguard.h>.
+# They are spelled out here so this module also imports on non-Linux hosts.
+AF_NETLINK = 16
+NETLINK_GENERIC = 16
+
+NLM_F_REQUEST = 0x01
+NLM_F_MULTI = 0x02
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+
+NLMSG_ERROR = 0x02
+NLMSG_DONE = 0x03
+
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+WG_GENL_NAME = b"wireguard"
+WG_GENL_VERSION = 1
+WG_CMD_GET_DEVICE = 0
+WG_CMD_SET_DEVICE = 1
+
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_FLAGS = 3
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+
+WGPEER_F_REMOVE_ME = 1
+WGPEER_F_REPLACE_ALLOWEDIPS = 2
+
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+NLMSG_HEADER = Struct("=IHHII")
+NLA_HEADER = Struct("=HH")
+GENL_HEADER = Struct("=BBH")
+ERRNO = Struct("=i")
+U8 = Struct("=B")
+U16 = Struct("=H")
+U32 = Struct("=I")
+U64 = Struct("=Q")
+TIMESPEC = Struct("=qq")
+PORT = Struct(">H")
+
+# Reported for peers without a preshared key.
+NO_PRESHARED_KEY = b"\0" * 32
+
+RECV_SIZE = 1 << 16
+# Peers per WG_CMD_SET_DEVICE message.
+SET_BATCH_SIZE = 128
+
+
+def align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def pack_attr(attr_type: int, value: bytes) -> bytes:
+    length = NLA_HEADER.size + len(value)
+    padding = b"\0" * (align(length) - length)
+    return NLA_HEADER.pack(length, attr_type) + value + padding
+
+
+def iter_attrs(data: bytes) -> Iterator[tuple[int, bytes]]:
+    offset = 0
+    while offset + NLA_HEADER.size <= len(data):
+        length, attr_type = NLA_HEADER.unpack_from(data, offset)
+        if length < NLA_HEADER.size:
+            return
+        yield attr_type & NLA_TYPE_MASK, data[offset + NLA_HEADER.size:offset + length]
+        offset += align(length)
+
+
+def pack_message(msg_type: int, flags: int, seq: int, payload: bytes) -> bytes:
+    return NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), msg_type, flags, seq, 0) + payload
+
+
+def parse_endpoint(data: bytes) -> Optional[str]:
+    if len(data) < 4:
+        return None
+
+    family = U16.unpack_from(data)[0]
+    port = PORT.unpack_from(data, 2)[0]
+    if family == AF_INET and len(data) >= 8:
+        return f"{inet_ntop(AF_INET, data[4:8])}:{port}"
+    if family == AF_INET6 and len(data) >= 24:
+        return f"[{inet_ntop(AF_INET6, data[8:24])}]:{port}"
+    return None
+
+
+def pack_endpoint(endpoint: str) -> bytes:
+    host, port = endpoint.rsplit(":", 1)
+    if host.startswith("["):
+        return U16.pack(AF_INET6) + PORT.pack(int(port)) + b"\0" * 4 + \
+            inet_pton(AF_INET6, host[1:-1]) + b"\0" * 4
+    return U16.pack(AF_INET) + PORT.pack(int(port)) + inet_pton(AF_INET, host) + b"\0" * 8
+
+
+def parse_allowed_ip(data: bytes) -> Optional[str]:
+    attrs = dict(iter_attrs(data))
+    if WGALLOWEDIP_A_FAMILY not in attrs:
+        return None
+
+    family = U16.unpack_from(attrs[WGALLOWEDIP_A_FAMILY])[0]
+    address = attrs.get(WGALLOWEDIP_A_IPADDR, b"")
+    cidr = U8.unpack_from(attrs.get(WGALLOWEDIP_A_CIDR_MASK, b"\0"))[0]
+    if family == AF_INET and len(address) == 4:
+        return f"{inet_ntop(AF_INET, address)}/{cidr}"
+    if family == AF_INET6 and len(address) == 16:
+        return f"{inet_ntop(AF_INET6, address)}/{cidr}"
+    return None
+
+
+def parse_preshared_key(data: bytes) -> Optional[str]:
+    if data == NO_PRESHARED_KEY:
+        return None
+    return b64encode(data).decode()
+
+
+def pack_allowed_ip(allowed_ip: str) -> bytes:
+    network = ip_network(allowed_ip, strict=False)
+    family = AF_INET if network.version == 4 else AF_INET6
+    return pack_attr(WGALLOWEDIP_A_FAMILY, U16.pack(family)) + \
+        pack_attr(WGALLOWEDIP_A_IPADDR, network.network_address.packed) + \
+        pack_attr(WGALLOWEDIP_A_CIDR_MASK, U8.pack(network.prefixlen))
+
+
+def pack_peer_config(peer: PeerConfig) -> bytes:
+    allowed_ips = b"".join(
+        pack_attr(NLA_F_NESTED | index, pack_allowed_ip(allowed_ip))
+        for index, allowed_ip in enumerate(peer.allowed_ips)
+    )
+    return pack_attr(WGPEER_A_PUBLIC_KEY, b64decode(peer.public_key)) + \
+        pack_attr(WGPEER_A_PRESHARED_KEY, b64decode(peer.preshared_key)) + \
+        pack_attr(WGPEER_A_FLAGS, U32.pack(WGPEER_F_REPLACE_ALLOWEDIPS)) + \
+        pack_attr(NLA_F_NESTED | WGPEER_A_ALLOWEDIPS, allowed_ips)
+
+
+def pack_peer_removal(public_key: str) -> bytes:
+    return pack_attr(WGPEER_A_PUBLIC_KEY, b64decode(public_key)) + \
+        pack_attr(WGPEER_A_FLAGS, U32.pack(WGPEER_F_REMOVE_ME))
+
+
+def open_netlink_socket():
+    sock = socket(AF_NETLINK, SOCK_RAW, NETLINK_GENERIC)
+    sock.bind((0, 0))
+    return sock
+
+
+class NetlinkBackend(StatusBackend):
+    """Talk to the kernel directly: WG_CMD_GET_DEVICE dumps for reading,
+    WG_CMD_SET_DEVICE for in-place peer changes."""
+    socket_factory: Callable
+    family_id: Optional[int]
+
+    def __init__(self, interface: str, socket_factory: Optional[Callable] = None):
+        super().__init__(interface)
+        self.socket_factory = socket_factory or open_netlink_socket
+        self.sock = None
+        self.family_id = None
+        self.seq = 0
+        self.lock = RLock()
+
+    def connect(self):
+        if self.sock is not None:
+            return
+
+        self.sock = self.socket_factory()
+        try:
+            self.family_id = self.resolve_family()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+            self.sock = None
+            self.family_id = None
+
+    def request(self, msg_type: int, flags: int, payload: bytes) -> list[bytes]:
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.sock.send(pack_message(
+            msg_type, NLM_F_REQUEST | flags, self.seq, payload
+        ))
+
+        messages = []
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise OSError("Netlink socket closed")
+
+            offset = 0
+            finished = False
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, reply_type, reply_flags, seq, _ = NLMSG_HEADER.unpack_from(
+                    data, offset
+                )
+                if length < NLMSG_HEADER.size:
+                    raise OSError("Malformed netlink message")
+
+                body = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += align(length)
+                if seq != self.seq:
+                    continue
+
+                if reply_type == NLMSG_ERROR:
+                    errno = -ERRNO.unpack_from(body)[0]
+                    if errno:
+                        raise OSError(errno, strerror(errno))
+                    return messages
+                if reply_type == NLMSG_DONE:
+                    return messages
+
+                messages.append(body)
+                if not reply_flags & NLM_F_MULTI and not flags & NLM_F_ACK:
+                    finished = True
+
+            if finished:
+                return messages
+
+    def resolve_family(self) -> int:
+        payload = GENL_HEADER.pack(CTRL_CMD_GETFAMILY, 1, 0) + \
+            pack_attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME + b"\0")
+
+        for message in self.request(GENL_ID_CTRL, 0, payload):
+            for attr_type, value in iter_attrs(message[GENL_HEADER.size:]):
+                if attr_type == CTRL_ATTR_FAMILY_ID:
+                    return U16.unpack_from(value)[0]
+
+        raise OSError(EINVAL, "Wireguard netlink family not found")
+
+    def dump(self) -> list[PeerStatus]:
+        with self.lock:
+            self.connect()
+
+            payload = GENL_HEADER.pack(WG_CMD_GET_DEVICE, WG_GENL_VERSION, 0) + \
+                pack_attr(WGDEVICE_A_IFNAME, self.interface.encode() + b"\0")
+            try:
+                messages = self.request(self.family_id, NLM_F_DUMP, payload)
+            except:
+                self.close()
+                raise
+
+            # A peer with many allowed ips continues in the next message with
+            # only its public key and the rest of the allowed ips.
+            result: dict[str, PeerStatus] = {}
+            for message in messages:
+                for attr_type, value in iter_attrs(message[GENL_HEADER.size:]):
+                    if attr_type != WGDEVICE_A_PEERS:
+                        continue
+                    for _, peer_data in iter_attrs(value):
+                        peer = self.parse_peer(peer_data)
+                        if peer is None:
+                            continue
+
+                        previous = result.get(peer.public_key)
+                        if previous is not None:
+                            peer = previous._replace(
+                                allowed_ips=previous.allowed_ips + peer.allowed_ips
+                            )
+                        result[peer.public_key] = peer
+
+            return list(result.values())
+
+    def apply(self, set_peers: list[PeerConfig], remove_peers: list[str]):
+        with self.lock:
+            self.connect()
+
+            peers = list(map(pack_peer_removal, remove_peers)) + \
+                list(map(pack_peer_config, set_peers))
+            try:
+                for start in range(0, len(peers), SET_BATCH_SIZE):
+                    payload = GENL_HEADER.pack(WG_CMD_SET_DEVICE, WG_GENL_VERSION, 0) + \
+                        pack_attr(WGDEVICE_A_IFNAME, self.interface.encode() + b"\0") + \
+                        pack_attr(NLA_F_NESTED | WGDEVICE_A_PEERS, b"".join(
+                            pack_attr(NLA_F_NESTED | index, peer)
+                            for index, peer in enumerate(peers[start:start + SET_BATCH_SIZE])
+                        ))
+                    self.request(self.family_id, NLM_F_ACK, payload)
+            except:
+                self.close()
+                raise
+
+    @staticmethod
+    def parse_peer(data: bytes) -> Optional[PeerStatus]:
+        public_key = None
+        latest_handshake = 0
+        rx_bytes = 0
+        tx_bytes = 0
+        endpoint = None
+        allowed_ips = []
+        preshared_key = None
+
+        for attr_type, value in iter_attrs(data):
+            if attr_type == WGPEER_A_PUBLIC_KEY:
+                public_key = b64encode(value).decode()
+            elif attr_type == WGPEER_A_LAST_HANDSHAKE_TIME:
+                latest_handshake = TIMESPEC.unpack_from(value)[0]
+            elif attr_type == WGPEER_A_RX_BYTES:
+                rx_bytes = U64.unpack_from(value)[0]
+            elif attr_type == WGPEER_A_TX_BYTES:
+                tx_bytes = U64.unpack_from(value)[0]
+            elif attr_type == WGPEER_A_PRESHARED_KEY:
+                preshared_key = parse_preshared_key(value)
+            elif attr_type == WGPEER_A_ENDPOINT:
+                endpoint = parse_endpoint(value)
+            elif attr_type == WGPEER_A_ALLOWEDIPS:
+                for _, allowed_ip_data in iter_attrs(value):
+                    allowed_ip = parse_allowed_ip(allowed_ip_data)
+                    if allowed_ip is not None:
+                        allowed_ips.append(allowed_ip)
+
+        if public_key is None:
+            return None
+        return PeerStatus(
+            public_key=public_key,
+            latest_handshake=latest_handshake,
+            rx_bytes=rx_bytes,
+            tx_bytes=tx_bytes,
+            endpoint=endpoint,
+            allowed_ips=tuple(allowed_ips),
+            preshared_key=preshared_key,
+        )
+
+
+class FakeNetlinkSocket():
+    """In-memory stand-in for a generic netlink socket.
+
+    It answers the family lookup and WG_CMD_GET_DEVICE dumps from `peers`,
+    splitting the dump into messages of `peers_per_message` peers, and
+    applies WG_CMD_SET_DEVICE to `peers`, so the netlink backend can be
+    exercised without a real interface.
+    """
+
+    def __init__(
+        self,
+        interface: str,
+        peers: list[PeerStatus],
+        family_id: int = 0x20,
+        peers_per_message: int = 64
+    ):
+        self.interface = interface
+        self.peers = peers
+        self.family_id = family_id
+        self.peers_per_message = peers_per_message
+        self.pending: list[bytes] = []
+        self.closed = False
+
+    def send(self, data: bytes) -> int:
+        _, msg_type, _, seq, _ = NLMSG_HEADER.unpack_from(data)
+        body = data[NLMSG_HEADER.size:]
+        cmd = GENL_HEADER.unpack_from(body)[0]
+        attrs = dict(iter_attrs(body[GENL_HEADER.size:]))
+
+        if msg_type == GENL_ID_CTRL and cmd == CTRL_CMD_GETFAMILY:
+            if attrs.get(CTRL_ATTR_FAMILY_NAME) != WG_GENL_NAME + b"\0":
+                self.pending.append(self.error(seq, -2))
+            else:
+                self.pending.append(pack_message(
+                    GENL_ID_CTRL, 0, seq,
+                    GENL_HEADER.pack(CTRL_CMD_GETFAMILY, 1, 0) +
+                    pack_attr(CTRL_ATTR_FAMILY_ID, U16.pack(self.family_id))
+                ))
+        elif msg_type == self.family_id and cmd == WG_CMD_GET_DEVICE:
+            if attrs.get(WGDEVICE_A_IFNAME) != self.interface.encode() + b"\0":
+                self.pending.append(self.error(seq, -19))
+            else:
+                self.pending.extend(self.dump_messages(seq))
+        elif msg_type == self.family_id and cmd == WG_CMD_SET_DEVICE:
+            if attrs.get(WGDEVICE_A_IFNAME) != self.interface.encode() + b"\0":
+                self.pending.append(self.error(seq, -19))
+            else:
+                self.set_device(attrs.get(WGDEVICE_A_PEERS, b""))
+                self.pending.append(self.error(seq, 0))
+        else:
+            self.pending.append(self.error(seq, -EINVAL))
+
+        return len(data)
+
+    def recv(self, bufsize: int) -> bytes:
+        return self.pending.pop(0) if self.pending else b""
+
+    def close(self):
+        self.closed = True
+
+    def set_device(self, data: bytes):
+        peers = {peer.public_key: peer for peer in self.peers}
+        for _, peer_data in iter_attrs(data):
+            attrs = dict(iter_attrs(peer_data))
+            public_key = b64encode(attrs[WGPEER_A_PUBLIC_KEY]).decode()
+            flags = U32.unpack_from(attrs.get(WGPEER_A_FLAGS, b"\0" * 4))[0]
+            if flags & WGPEER_F_REMOVE_ME:
+                peers.pop(public_key, None)
+                continue
+
+            allowed_ips = tuple(
+                parse_allowed_ip(allowed_ip_data)
+                for _, allowed_ip_data in iter_attrs(attrs.get(WGPEER_A_ALLOWEDIPS, b""))
+            )
+            peer = peers.get(public_key, PeerStatus(public_key=public_key))
+            if not flags & WGPEER_F_REPLACE_ALLOWEDIPS:
+                allowed_ips = peer.allowed_ips + allowed_ips
+            preshared_key = peer.preshared_key
+            if WGPEER_A_PRESHARED_KEY in attrs:
+                preshared_key = parse_preshared_key(attrs[WGPEER_A_PRESHARED_KEY])
+            peers[public_key] = peer._replace(
+                allowed_ips=allowed_ips, preshared_key=preshared_key
+            )
+
+        self.peers = list(peers.values())
+
+    @staticmethod
+    def error(seq: int, errno: int) -> bytes:
+        return pack_message(NLMSG_ERROR, 0, seq, ERRNO.pack(errno) + b"\0" * 16)
+
+    def dump_messages(self, seq: int) -> list[bytes]:
+        result = []
+        step = max(self.peers_per_message, 1)
+        for start in range(0, max(len(self.peers), 1), step):
+            peers = b"".join(
+                pack_attr(NLA_F_NESTED | index, self.pack_peer(peer))
+                for index, peer in enumerate(self.peers[start:start + step])
+            )
+            result.append(pack_message(
+                self.family_id, NLM_F_MULTI, seq,
+                GENL_HEADER.pack(WG_CMD_GET_DEVICE, WG_GENL_VERSION, 0) +
+                pack_attr(WGDEVICE_A_IFNAME, self.interface.encode() + b"\0") +
+                pack_attr(NLA_F_NESTED | WGDEVICE_A_PEERS, peers)
+            ))
+        result.append(pack_message(NLMSG_DONE, NLM_F_MULTI, seq, ERRNO.pack(0)))
+        return result
+
+    @staticmethod
+    def pack_peer(peer: PeerStatus) -> bytes:
+        preshared_key = NO_PRESHARED_KEY
+        if peer.preshared_key:
+            preshared_key = b64decode(peer.preshared_key)
+        result = pack_attr(WGPEER_A_PUBLIC_KEY, b64decode(peer.public_key)) + \
+            pack_attr(WGPEER_A_LAST_HANDSHAKE_TIME, TIMESPEC.pack(peer.latest_handshake, 0)) + \
+            pack_attr(WGPEER_A_RX_BYTES, U64.pack(peer.rx_bytes)) + \
+            pack_attr(WGPEER_A_TX_BYTES, U64.pack(peer.tx_bytes)) + \
+            pack_attr(WGPEER_A_PRESHARED_KEY, preshared_key)
+        if peer.endpoint:
+            result += pack_attr(WGPEER_A_ENDPOINT, pack_endpoint(peer.endpoint))
+        if peer.allowed_ips:
+            result += pack_attr(NLA_F_NESTED | WGPEER_A_ALLOWEDIPS, b"".join(
+                pack_attr(NLA_F_NESTED | index, pack_allowed_ip(allowed_ip))
+                for index, allowed_ip in enumerate(peer.allowed_ips)
+            ))
+        return result
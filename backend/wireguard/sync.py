@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+from ipaddress import ip_network
+from os import chmod, close, fsync, open as os_open, remove, replace, O_RDONLY
+from os.path import abspath, basename, dirname
+from tempfile import mkstemp
+from typing import Iterable, Iterator, TextIO
+
+from .backend import PeerConfig, PeerStatus
+
+
+def normalize_ips(allowed_ips: Iterable[str]) -> set[str]:
+    return set(str(ip_network(ip, strict=False)) for ip in allowed_ips)
+
+
+def diff_peers(
+    desired: dict[str, PeerConfig],
+    live: list[PeerStatus]
+) -> tuple[list[PeerConfig], list[str]]:
+    """Return the peers to add or update and the public keys to remove so
+    that `live` matches `desired`."""
+    live_peers = {peer.public_key: peer for peer in live}
+
+    set_peers = [
+        peer
+        for public_key, peer in desired.items()
+        if public_key not in live_peers or
+        live_peers[public_key].preshared_key != peer.preshared_key or
+        normalize_ips(live_peers[public_key].allowed_ips) != normalize_ips(peer.allowed_ips)
+    ]
+    remove_peers = [
+        public_key
+        for public_key in live_peers
+        if public_key not in desired
+    ]
+
+    return set_peers, remove_peers
+
+
+@contextmanager
+def atomic_writer(path: str) -> Iterator[TextIO]:
+    """Open a temporary file next to `path` for writing, then fsync it and
+    rename it over `path`, so readers never see a partial file."""
+    directory = dirname(abspath(path))
+    fd, temp_path = mkstemp(dir=directory, prefix=f".{basename(path)}.")
+    try:
+        with open(fd, "w", encoding="utf-8") as temp_file:
+            yield temp_file
+            temp_file.flush()
+            fsync(temp_file.fileno())
+
+        chmod(temp_path, 0o600)
+        replace(temp_path, path)
+    except:
+        remove(temp_path)
+        raise
+
+    dir_fd = os_open(directory, O_RDONLY)
+    try:
+        fsync(dir_fd)
+    finally:
+        close(dir_fd)
+
+
+def write_atomic(path: str, chunks: Iterable[str]):
+    with atomic_writer(path) as file:
+        for chunk in chunks:
+            file.write(chunk)
@@ -1,77 +1,411 @@
-from fastapi import WebSocket
 from orjson import dumps
 
 from asyncio import (
     CancelledError,
+    Event,
+    Queue,
+    QueueFull,
+    Task,
+    TimeoutError as WaitTimeout,
     create_task,
-    gather,
     get_event_loop,
-    sleep as asleep
+    sleep as asleep,
+    wait_for
 )
-from subprocess import run, PIPE, DEVNULL
+from heapq import nlargest
+from sys import intern
+from time import perf_counter, time
+from typing import Callable, Optional, TYPE_CHECKING
 
-from config import WIREGUARD_INTERFACE
+from config import (
+    METRICS_MAX_PEERS,
+    STATUS_BACKEND,
+    STATUS_POLL_INTERVAL_MAX,
+    STATUS_POLL_INTERVAL_MIN,
+    STATUS_QUEUE_SIZE,
+    STATUS_SEND_TIMEOUT,
+    WIREGUARD_INTERFACE
+)
+from history import HISTORY, IDLE_INTERVAL
+from metrics import GaugeFunc, Histogram, Labels
+from status_frames import encode_delta, encode_full
+from wireguard import get_backend, PeerStatus
+
+if TYPE_CHECKING:
+    from fastapi import WebSocket
+
+# Published per peer as
+# [latest_handshake, rx_bytes, tx_bytes, rx_rate, tx_rate]. Endpoints are the
+# home addresses of the users, so they are only served to admins, see
+# peer_endpoints.
+PeerValue = tuple[int, int, int, int, int]
+
+
+class PeerRecord():
+    __slots__ = (
+        "latest_handshake",
+        "rx_bytes",
+        "tx_bytes",
+        "rx_rate",
+        "tx_rate",
+        "endpoint",
+        "sampled_at",
+    )
+
+    latest_handshake: int
+    rx_bytes: int
+    tx_bytes: int
+    # Bytes per second between the last two samples.
+    rx_rate: int
+    tx_rate: int
+    endpoint: Optional[str]
+    sampled_at: float
+
+    def __init__(self, peer: PeerStatus, now: float):
+        self.latest_handshake = peer.latest_handshake
+        self.rx_bytes = peer.rx_bytes
+        self.tx_bytes = peer.tx_bytes
+        self.rx_rate = 0
+        self.tx_rate = 0
+        self.endpoint = peer.endpoint
+        self.sampled_at = now
+
+    def update(self, peer: PeerStatus, now: float):
+        elapsed = now - self.sampled_at
+        if elapsed > 0:
+            # Counters restart from zero when the peer is re-added.
+            self.rx_rate = round(max(peer.rx_bytes - self.rx_bytes, 0) / elapsed)
+            self.tx_rate = round(max(peer.tx_bytes - self.tx_bytes, 0) / elapsed)
+
+        self.latest_handshake = peer.latest_handshake
+        self.rx_bytes = peer.rx_bytes
+        self.tx_bytes = peer.tx_bytes
+        self.endpoint = peer.endpoint
+        self.sampled_at = now
+
+    def value(self) -> PeerValue:
+        return (
+            self.latest_handshake,
+            self.rx_bytes,
+            self.tx_bytes,
+            self.rx_rate,
+            self.tx_rate,
+        )
+
+
+STATUS: dict[str, PeerRecord] = {}
+
+
+def update_status(peers: list[PeerStatus], now: Optional[float] = None):
+    now = time() if now is None else now
+
+    removed = set(STATUS)
+    for peer in peers:
+        record = STATUS.get(peer.public_key)
+        if record is None:
+            STATUS[intern(peer.public_key)] = PeerRecord(peer, now)
+        else:
+            record.update(peer, now)
+            removed.discard(peer.public_key)
 
-STATUS: dict[str, int] = {}
+    for public_key in removed:
+        del STATUS[public_key]
+
+
+def peer_endpoints() -> dict[str, Optional[str]]:
+    return {key: record.endpoint for key, record in STATUS.items()}
+
+
+STATUS_POLL_SECONDS = Histogram(
+    "wsm_status_poll_duration_seconds",
+    "Duration of reading the peer status from the interface.",
+)
+STATUS_FANOUT_SECONDS = Histogram(
+    "wsm_status_fanout_duration_seconds",
+    "Duration of diffing the status and queueing it for every subscriber.",
+)
+
+
+class Subscriber():
+    __slots__ = ("ws", "binary", "queue", "task", "last_seq")
+
+    ws: "WebSocket"
+    # Uses the frames of status_frames instead of JSON.
+    binary: bool
+    # `None` stands for "send the latest full snapshot".
+    queue: Queue[Optional[tuple[int, bytes]]]
+    task: Optional[Task]
+    last_seq: int
+
+    def __init__(self, ws: "WebSocket", binary: bool = False):
+        self.ws = ws
+        self.binary = binary
+        self.queue = Queue(maxsize=STATUS_QUEUE_SIZE)
+        self.task = None
+        self.last_seq = -1
 
 
 class AutoPublisher():
-    websockets: list[WebSocket]
+    """Broadcast STATUS to subscribers as sequenced deltas.
 
-    def __init__(self):
-        self.websockets = []
+    Subscribers get one `full` message when they join or ask for a resync,
+    afterwards only `delta` messages with the changed and removed keys. The
+    `seq` of every delta is one more than the previous message, so a client
+    which sees a gap should send `resync` to get a new full snapshot.
 
-    async def add_subscriber(self, ws: WebSocket):
-        await ws.send_bytes(dumps(STATUS))
-        self.websockets.append(ws)
+    Every tick is serialized once and put into the bounded queue of each
+    subscriber, which is drained by its own writer task. When a queue is
+    full the pending deltas are coalesced into one full snapshot, and a
+    subscriber which can not take a message within the send timeout is
+    dropped. Subscribers of the binary subprotocol get the same stream as
+    status_frames FULL and DELTA frames.
+    """
+    subscribers: dict["WebSocket", Subscriber]
+    snapshot: dict[str, PeerValue]
+    seq: int
+    has_subscribers: Event
+    # Called with the number of subscribers whenever it changes.
+    on_subscribers: Optional[Callable[[int], None]]
 
-    async def send_all(self):
-        message = dumps(STATUS)
-        results = await gather(*list(map(
-            lambda ws: create_task(ws.send_bytes(message)),
-            self.websockets
-        )), return_exceptions=True)
+    def __init__(self):
+        self.subscribers = {}
+        self.has_subscribers = Event()
+        self.on_subscribers = None
+        self.snapshot = {}
+        self.seq = 0
+        # Index of every key in the binary FULL frames of the current set
+        # of peers.
+        self.key_index: dict[str, int] = {}
+        self._full_message: tuple[int, bytes] = (-1, b"")
+        self._full_frame: tuple[int, bytes] = (-1, b"")
 
-        failed_ws = list(filter(
-            lambda pair: results[pair[0]] is not None,
-            enumerate(self.websockets)
-        ))
-        await gather(*list(map(
-            lambda pair: create_task(pair[1].close()),
-            failed_ws
-        )), return_exceptions=None)
+    def full_message(self, binary: bool = False) -> tuple[int, bytes]:
+        if binary:
+            if self._full_frame[0] != self.seq:
+                self._full_frame = (self.seq, encode_full(self.seq, self.snapshot))
+            return self._full_frame
 
-        for _, ws in failed_ws:
-            self.remove_subscriber(ws)
+        if self._full_message[0] != self.seq:
+            self._full_message = (self.seq, dumps({
+                "type": "full",
+                "seq": self.seq,
+                "data": self.snapshot
+            }))
+        return self._full_message
 
-    def remove_subscriber(self, ws: WebSocket):
-        if ws in self.websockets:
-            self.websockets.remove(ws)
+    def add_subscriber(self, ws: "WebSocket", binary: bool = False):
+        subscriber = Subscriber(ws, binary)
+        subscriber.queue.put_nowait(None)
+        subscriber.task = create_task(self.writer(subscriber))
+        self.subscribers[ws] = subscriber
+        self.subscribers_changed()
 
+    def resync(self, ws: "WebSocket"):
+        subscriber = self.subscribers.get(ws)
+        if subscriber is not None:
+            self.enqueue(subscriber, None)
 
-PUBLISHER = AutoPublisher()
+    def remove_subscriber(self, ws: "WebSocket"):
+        subscriber = self.subscribers.pop(ws, None)
+        if subscriber is not None and subscriber.task is not None:
+            subscriber.task.cancel()
+        self.subscribers_changed()
 
+    def subscribers_changed(self):
+        if self.subscribers:
+            self.has_subscribers.set()
+        else:
+            self.has_subscribers.clear()
+        if self.on_subscribers is not None:
+            self.on_subscribers(len(self.subscribers))
 
-async def status_update_task():
-    loop = get_event_loop()
-    while True:
+    @staticmethod
+    def enqueue(subscriber: Subscriber, message: Optional[tuple[int, bytes]]):
         try:
-            proc = await loop.run_in_executor(None, lambda: run(
-                args=["wg", "show", WIREGUARD_INTERFACE, "latest-handshakes"],
-                stdout=PIPE,
-                stderr=DEVNULL
-            ))
-            results = proc.stdout.decode().strip().split("\n")
-
-            if results and len(results[0]) > 0:
-                for result in results:
-                    public_key, time = result.split("\t")
-                    STATUS[public_key] = int(time)
-
-                await PUBLISHER.send_all()
+            subscriber.queue.put_nowait(message)
+        except QueueFull:
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(None)
+
+    async def writer(self, subscriber: Subscriber):
+        ws = subscriber.ws
+        try:
+            # wait_for before Python 3.12 loses the cancel of
+            # remove_subscriber when the send finishes at the same moment.
+            while self.subscribers.get(ws) is subscriber:
+                message = await subscriber.queue.get()
+                seq, data = message or self.full_message(subscriber.binary)
+                # Deltas which are already covered by a full snapshot.
+                if message is not None and seq <= subscriber.last_seq:
+                    continue
+
+                await wait_for(ws.send_bytes(data), STATUS_SEND_TIMEOUT)
+                subscriber.last_seq = seq
         except CancelledError:
             return
         except:
-            pass
+            if self.subscribers.get(ws) is subscriber:
+                del self.subscribers[ws]
+                self.subscribers_changed()
+            try:
+                await ws.close()
+            except:
+                pass
+
+    @STATUS_FANOUT_SECONDS.time()
+    def send_all(self) -> bool:
+        snapshot = {key: record.value() for key, record in STATUS.items()}
+        changed = {
+            key: value
+            for key, value in snapshot.items()
+            if self.snapshot.get(key) != value
+        }
+        removed = [key for key in self.snapshot if key not in snapshot]
+        if not changed and not removed:
+            return False
+
+        previous = self.snapshot
+        self.snapshot = snapshot
+        self.seq += 1
+
+        # Binary deltas refer to the index table, which only changes with
+        # the set of peers. Binary subscribers get a new FULL frame then.
+        peers_changed = bool(removed) or any(key not in previous for key in changed)
+        if peers_changed:
+            self.key_index = {key: index for index, key in enumerate(snapshot)}
+
+        # Both formats are encoded at most once per tick, and only if some
+        # subscriber uses them.
+        message: Optional[tuple[int, bytes]] = None
+        frame: Optional[tuple[int, bytes]] = None
+        for subscriber in self.subscribers.values():
+            if not subscriber.binary:
+                if message is None:
+                    message = (self.seq, dumps({
+                        "type": "delta",
+                        "seq": self.seq,
+                        "data": changed,
+                        "removed": removed
+                    }))
+                self.enqueue(subscriber, message)
+            elif peers_changed:
+                self.enqueue(subscriber, self.full_message(True))
+            else:
+                if frame is None:
+                    frame = (self.seq, encode_delta(
+                        self.seq, self.key_index, changed
+                    ))
+                self.enqueue(subscriber, frame)
+
+        return True
+
+
+PUBLISHER = AutoPublisher()
+BACKEND = get_backend(STATUS_BACKEND, WIREGUARD_INTERFACE)
+
+
+def active_peers() -> list[tuple[str, PeerRecord]]:
+    """Peers with the latest handshakes, which keeps the number of per peer
+    series bounded."""
+    return nlargest(
+        METRICS_MAX_PEERS,
+        STATUS.items(),
+        key=lambda item: item[1].latest_handshake
+    )
+
+
+def peer_handshake_ages() -> list[tuple[Labels, float]]:
+    now = time()
+    return [
+        ((key,), now - record.latest_handshake)
+        for key, record in active_peers()
+        if record.latest_handshake
+    ]
+
+
+GaugeFunc(
+    "wsm_status_subscribers",
+    "Connected status websockets.",
+    lambda: [((), len(PUBLISHER.subscribers))],
+)
+GaugeFunc(
+    "wsm_peers",
+    "Peers on the interface.",
+    lambda: [((), len(STATUS))],
+    shared=True,
+)
+GaugeFunc(
+    "wsm_peer_handshake_age_seconds",
+    "Seconds since the latest handshake of the most recently active peers.",
+    peer_handshake_ages,
+    ("public_key",),
+    shared=True,
+)
+GaugeFunc(
+    "wsm_peer_rx_bytes",
+    "Received bytes of the most recently active peers.",
+    lambda: [((key,), record.rx_bytes) for key, record in active_peers()],
+    ("public_key",),
+    shared=True,
+)
+GaugeFunc(
+    "wsm_peer_tx_bytes",
+    "Sent bytes of the most recently active peers.",
+    lambda: [((key,), record.tx_bytes) for key, record in active_peers()],
+    ("public_key",),
+    shared=True,
+)
+
+
+async def status_update_task(
+    on_sample: Optional[Callable[[list[PeerStatus], float], None]] = None
+):
+    """Poll the interface only while somebody is watching.
+
+    The interval drops to the minimum whenever the status changed and
+    doubles up to the maximum while it stays the same. Without subscribers
+    the history is sampled once per IDLE_INTERVAL, at the start of each
+    bucket of its minute tier, and nothing at all without history. Every
+    sample is also handed to `on_sample`, e.g. to forward it to the API
+    workers.
+    """
+    loop = get_event_loop()
+    interval = STATUS_POLL_INTERVAL_MIN
+    try:
+        while True:
+            try:
+                if HISTORY is None and not PUBLISHER.has_subscribers.is_set():
+                    await PUBLISHER.has_subscribers.wait()
+                    interval = STATUS_POLL_INTERVAL_MIN
+
+                start = perf_counter()
+                peers = await loop.run_in_executor(None, BACKEND.dump)
+                STATUS_POLL_SECONDS.observe(perf_counter() - start)
+                now = time()
+                update_status(peers, now)
+                if on_sample is not None:
+                    on_sample(peers, now)
+                if HISTORY is not None:
+                    HISTORY.record(STATUS, now)
+
+                if PUBLISHER.send_all():
+                    interval = STATUS_POLL_INTERVAL_MIN
+                else:
+                    interval = min(interval * 2, STATUS_POLL_INTERVAL_MAX)
+            except CancelledError:
+                raise
+            except:
+                interval = STATUS_POLL_INTERVAL_MAX
 
-        await asleep(15)
+            if PUBLISHER.has_subscribers.is_set():
+                await asleep(interval)
+            else:
+                timeout = None if HISTORY is None else IDLE_INTERVAL - time() % IDLE_INTERVAL
+                try:
+                    await wait_for(PUBLISHER.has_subscribers.wait(), timeout)
+                    interval = STATUS_POLL_INTERVAL_MIN
+                except WaitTimeout:
+                    pass
+    finally:
+        BACKEND.close()
@@ -9,4 +9,19 @@ export function timeParser(time: number): string {
     const hours = Math.round(minutes / 60);
     if (hours < 24) return `${hours} 小時前`;
     return `${Math.round(hours / 24)} 天前`;
+}
+
+function sizeParser(size: number): string {
+    const units = ["B", "KB", "MB", "GB", "TB"];
+    let index = 0;
+    while (size >= 1024 && index < units.length - 1) {
+        size /= 1024;
+        index++;
+    }
+    return `${size.toFixed(index ? 1 : 0)} ${units[index]}`;
+}
+
+export function rateParser(status?: [number, number, number, number, number]): string {
+    if (!status) return "-";
+    return `↓ ${sizeParser(status[3])}/s ↑ ${sizeParser(status[4])}/s`;
 }
\ No newline at end of file
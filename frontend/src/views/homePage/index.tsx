@@ -6,7 +6,7 @@ import req from "@/config/axios";
 import JWT from "@/schemas/jwt";
 import UserData from "@/schemas/userData";
 import UserWithConnection from "@/schemas/userWithConnection";
-import { timeParser } from "@/utils/timeParser";
+import { rateParser, timeParser } from "@/utils/timeParser";
 
 
 import CopyBox from "@/components/copyBox";
@@ -34,8 +34,24 @@ async function getUserData(): Promise<UserData> {
 }
 
 async function getUsers(): Promise<Array<UserWithConnection>> {
-    const response = await req.get("/connection");
-    return response.data;
+    const users: Array<UserWithConnection> = [];
+    let cursor: string | undefined;
+    do {
+        const response = await req.get("/connection", { params: { cursor } });
+        users.push(...response.data);
+        cursor = response.headers["x-next-cursor"];
+    } while (cursor);
+    return users;
+}
+
+// Only admins may see the endpoints of other peers.
+async function getEndpoints(): Promise<{ [publicKey: string]: string | null }> {
+    try {
+        const response = await req.get("/connection/endpoints");
+        return response.data;
+    } catch {
+        return {};
+    }
 }
 
 async function getConnectionString(): Promise<string> {
@@ -43,9 +59,19 @@ async function getConnectionString(): Promise<string> {
     return btoa(response.data);
 }
 
-function getStatus(key: string, status?: { [key: string]: number }): "live" | "dead" | "unknow" {
+// [latest_handshake, rx_bytes, tx_bytes, rx_rate, tx_rate]
+type PeerStatus = [number, number, number, number, number];
+
+interface StatusMessage {
+    type: "full" | "delta",
+    seq: number,
+    data: { [publicKey: string]: PeerStatus },
+    removed?: Array<string>,
+};
+
+function getStatus(key: string, status?: { [key: string]: PeerStatus }): "live" | "dead" | "unknow" {
     if (status === undefined || status[key] === undefined) return "unknow";
-    const delta = Date.now() - (status[key] * 1000);
+    const delta = Date.now() - (status[key][0] * 1000);
     if (delta > 180 * 1000) return "dead";
     return "live";
 }
@@ -54,7 +80,8 @@ export default function HomePage(): ReactNode {
     const [userData, setUserData] = useState<UserData>();
     const [connectionString, setConnectionString] = useState<string>("");
     const [userList, setUserList] = useState<Array<UserWithConnection>>([]);
-    const [status, setStatus] = useState<{ [publicKey: string]: number }>();
+    const [status, setStatus] = useState<{ [publicKey: string]: PeerStatus }>();
+    const [endpoints, setEndpoints] = useState<{ [publicKey: string]: string | null }>({});
     const [, setWs] = useState<WebSocket>();
 
     const navigate = useNavigate();
@@ -72,10 +99,32 @@ export default function HomePage(): ReactNode {
             endPoint = `${location.origin}${endPoint}`;
 
         const ws = new WebSocket(`${endPoint.replace("http", "ws")}/connection/ws`);
+        let seq: number | undefined;
         ws.onopen = () => ws.send(localStorage.getItem("access_token") ?? "")
         ws.onmessage = message => {
             const rawData: Blob = message.data;
-            rawData.text().then(dataString => setStatus(JSON.parse(dataString)));
+            rawData.text().then(dataString => {
+                const update: StatusMessage = JSON.parse(dataString);
+                if (update.type === "full") {
+                    seq = update.seq;
+                    setStatus(update.data);
+                    return;
+                }
+
+                if (seq === undefined || update.seq <= seq) return;
+                if (update.seq !== seq + 1) {
+                    seq = undefined;
+                    ws.send("resync");
+                    return;
+                }
+
+                seq = update.seq;
+                setStatus(status => {
+                    const newStatus = { ...status, ...update.data };
+                    update.removed?.forEach(key => delete newStatus[key]);
+                    return newStatus;
+                });
+            });
         }
         ws.onerror = () => ws.close();
         ws.onclose = () => {
@@ -95,6 +144,7 @@ export default function HomePage(): ReactNode {
             setUserData(userData)
             getUsers().then(response => setUserList(response));
             getConnectionString().then(response => setConnectionString(response));
+            getEndpoints().then(response => setEndpoints(response));
             connectWs();
         }).catch(() => {
             navigate("/login");
@@ -171,7 +221,14 @@ export default function HomePage(): ReactNode {
                         <div className={style.key}>Last Seen</div>
                         <div
                             className={style.value}
-                        >{status ? timeParser(status[data.connection.public_key]) : "Loading..."}</div>
+                        >{status ? timeParser(status[data.connection.public_key]?.[0]) : "Loading..."}</div>
+                    </div>
+                    <div className={style.transfer}>
+                        <div className={style.key}>Transfer</div>
+                        <div
+                            className={style.value}
+                            title={endpoints[data.connection.public_key] ?? undefined}
+                        >{status ? rateParser(status[data.connection.public_key]) : "Loading..."}</div>
                     </div>
                 </div>)
             }